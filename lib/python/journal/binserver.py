@@ -0,0 +1,169 @@
+"""
+Length-prefixed binary protocol listener
+
+Frames are a !I length followed by a json object, the same framing as
+journal_cli. Requests carry a correlation id echoed in their reply:
+    {"id": 1, "op": "write", "txid": .., "step": .., "msg": ..}
+        -> {"id": 1, "rc": 0}
+    {"id": 2, "op": "status", "txid": ..}
+        -> {"id": 2, "status": .., "code": 200}
+    errors -> {"id": .., "error": "message"}
+Requests of a connection are pipelined: they run concurrently and are
+answered as they complete, not in order.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import json
+import logging
+import os
+import struct
+import threading
+
+_LOG = logging.getLogger(__name__)
+
+FRAME = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+
+# Journal calls running at once, and requests in flight per connection
+CONCURRENCY = 16
+MAX_INFLIGHT = 256
+
+
+class BinaryServer():
+    """
+    Unix socket listener answering binary protocol requests
+    with a mjournal.Journal
+    """
+    def __init__(self, path, journal, concurrency=None):
+        self.path = path
+        self.journal = journal
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            concurrency or CONCURRENCY)
+        self.loop = None
+        self.thread = None
+        self.lockfile = None
+
+    def _dispatch(self, request):
+        """
+        Run a request against the journal, return the reply
+        """
+        op = request.get('op')
+        if op == 'write':
+            rc = self.journal.write(request['txid'], request['step'],
+                                    request.get('msg'))
+            return {'rc': rc}
+        if op == 'status':
+            (resp, code) = self.journal.status(request['txid'])
+            return {'status': resp, 'code': code}
+        return {'error': 'Unknown op {0!r}'.format(op)}
+
+    async def _reply(self, request, writer, lock, inflight):
+        try:
+            reply = await self.loop.run_in_executor(
+                self.executor, functools.partial(self._dispatch, request))
+        except KeyError as err:
+            reply = {'error': 'Missing {0}'.format(err)}
+        except Exception as err:  # pylint: disable=W0703
+            _LOG.exception('Error in binary request %r', request.get('op'))
+            reply = {'error': str(err)}
+        finally:
+            inflight.release()
+        reply['id'] = request.get('id')
+        body = json.dumps(reply).encode()
+        async with lock:
+            writer.write(FRAME.pack(len(body)) + body)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        inflight = asyncio.Semaphore(MAX_INFLIGHT)
+        tasks = set()
+        try:
+            while True:
+                header = await reader.readexactly(FRAME.size)
+                (length,) = FRAME.unpack(header)
+                if length > MAX_FRAME:
+                    _LOG.error('Binary frame too big: %d', length)
+                    break
+                data = await reader.readexactly(length)
+                try:
+                    request = json.loads(data.decode())
+                    if not isinstance(request, dict):
+                        raise ValueError('not an object')
+                except ValueError as err:
+                    _LOG.error('Bad binary frame: %s', err)
+                    break
+                await inflight.acquire()
+                task = self.loop.create_task(
+                    self._reply(request, writer, lock, inflight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        if tasks:
+            await asyncio.wait(tasks)
+        writer.close()
+
+    def try_start(self):
+        """
+        Listen unless another process does, return whether listening.
+        The socket is served by this process until it exits.
+        """
+        with contextlib.ExitStack() as stack:
+            lockfile = stack.enter_context(open(self.path + '.lock', 'a'))
+            try:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            self.start()
+            # Held until stop
+            stack.pop_all()
+        self.lockfile = lockfile
+        return True
+
+    def start(self):
+        """
+        Listen in a background thread
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.loop = asyncio.new_event_loop()
+        server = self.loop.run_until_complete(
+            asyncio.start_unix_server(self._handle, path=self.path))
+        _LOG.info('Binary protocol listening on %s', self.path)
+        self.thread = threading.Thread(target=self._run, args=(server,),
+                                       name='binserver', daemon=True)
+        self.thread.start()
+
+    def _run(self, server):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        """
+        Stop listening
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+        if self.lockfile is not None:
+            self.lockfile.close()
+            self.lockfile = None
+
+
+__all__ = (
+    'BinaryServer',
+)
@@ -0,0 +1,126 @@
+"""
+Content-addressed store for large journal payloads
+
+Payloads bigger than the threshold are written once to a directory
+on local disk or NFS, named by their sha256, and the journal message
+keeps a reference {'$blob': <sha256>, 'size': <bytes>} instead.
+Smaller payloads which could be taken for a reference are kept as
+{'$escaped': <payload>}, so references only come from the store.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+_LOG = logging.getLogger(__name__)
+
+BLOB_THRESHOLD = 64 * 1024
+BLOB_KEY = '$blob'
+ESCAPE_KEY = '$escaped'
+
+
+def is_ref(payload):
+    """
+    Whether a payload is a blob reference
+    """
+    return isinstance(payload, dict) and BLOB_KEY in payload
+
+
+def _is_escaped(payload):
+    return isinstance(payload, dict) and list(payload) == [ESCAPE_KEY]
+
+
+def _needs_escape(payload):
+    return isinstance(payload, dict) and (BLOB_KEY in payload or
+                                          ESCAPE_KEY in payload)
+
+
+class BlobStore():
+    """
+    Payload store addressed by content hash
+    """
+    def __init__(self, path, threshold=None):
+        self.path = path
+        self.threshold = threshold or BLOB_THRESHOLD
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        """
+        Store data, return its sha256
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob_path(digest)
+        if os.path.exists(blob):
+            return digest
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                suffix='-XXXXX.tmp',
+                dir=os.path.dirname(blob),
+                delete=False, mode='wb'
+        ) as outfile:
+            outfile.write(data)
+        os.rename(outfile.name, blob)
+        return digest
+
+    def get(self, digest):
+        """
+        Data stored under digest, None if missing
+        """
+        try:
+            with open(self._blob_path(digest), 'rb') as fin:
+                return fin.read()
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                raise
+        return None
+
+    def offload(self, msg):
+        """
+        Message with its payload replaced by a reference if large,
+        escaped if it could be taken for one
+        """
+        payload = msg.get('payload')
+        if payload is None:
+            return msg
+        data = json.dumps(payload).encode()
+        if len(data) <= self.threshold:
+            if _needs_escape(payload):
+                msg = dict(msg)
+                msg['payload'] = {ESCAPE_KEY: payload}
+            return msg
+        msg = dict(msg)
+        msg['payload'] = {BLOB_KEY: self.put(data), 'size': len(data)}
+        return msg
+
+    def rehydrate(self, msg):
+        """
+        Message with a payload reference replaced by the payload
+        """
+        if msg is not None and _is_escaped(msg.get('payload')):
+            msg = dict(msg)
+            msg['payload'] = msg['payload'][ESCAPE_KEY]
+            return msg
+        if msg is None or not is_ref(msg.get('payload')):
+            return msg
+        digest = msg['payload'][BLOB_KEY]
+        try:
+            data = self.get(digest)
+        except (IOError, OSError):
+            _LOG.exception('Error reading payload blob %s', digest)
+            return msg
+        if data is None:
+            _LOG.error('Payload blob %s missing', digest)
+            return msg
+        msg = dict(msg)
+        msg['payload'] = json.loads(data.decode())
+        return msg
+
+
+__all__ = (
+    'BlobStore',
+    'is_ref',
+)
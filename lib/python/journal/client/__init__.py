@@ -0,0 +1,12 @@
+"""
+Client of the journal server unix socket
+"""
+
+from journal.client.aio import AsyncJournalClient
+from journal.client.sync import JournalClient, JournalError
+
+__all__ = (
+    'AsyncJournalClient',
+    'JournalClient',
+    'JournalError',
+)
@@ -0,0 +1,149 @@
+"""
+Asyncio journal client, talking to the server on asyncio streams:
+requests of the coroutines waiting on the server take no thread
+"""
+import asyncio
+import logging
+
+from journal.client import connection
+from journal.client import protocol
+from journal.client import sync
+
+_LOG = logging.getLogger(__name__)
+
+
+class AsyncJournalClient():
+    """
+    Asyncio client of the journal server unix socket, used from
+    one event loop
+    """
+    def __init__(self, path, poolsize=None, timeout=None,
+                 batchsize=None, batchinterval=None):
+        """
+        Client of the server listening on path, keeping up to poolsize
+        idle connections. Writes submitted are sent in batches of
+        batchsize, waiting up to batchinterval seconds to fill them.
+        """
+        self.pool = connection.AsyncConnectionPool(path, poolsize, timeout)
+        self.batchsize = batchsize or sync.BATCH_SIZE
+        self.batchinterval = batchinterval or sync.BATCH_INTERVAL
+        self.pending = []
+        self.cond = None
+        self.closed = False
+        self.batcher = None
+
+    async def _request(self, method, url, body=None):
+        (status, data) = await self.pool.request(method, url,
+                                                 protocol.encode(body),
+                                                 protocol.HEADERS)
+        return (status, protocol.decode(data))
+
+    async def write(self, txid, step, msg):
+        """
+        Write a journal entry, raise JournalError if not saved
+        """
+        protocol.write_result(
+            *await self._request(*protocol.write_request(txid, step, msg)))
+
+    async def write_batch(self, entries):
+        """
+        Write (txid, step, msg) entries in one request,
+        return the rc of each entry, 0 when saved
+        """
+        return protocol.batch_result(
+            *await self._request(*protocol.batch_request(entries)))
+
+    async def submit(self, txid, step, msg):
+        """
+        Queue a journal entry for the next batch, return its rc
+        """
+        if self.closed:
+            raise RuntimeError('Journal client closed')
+        if self.cond is None:
+            # Made in the loop of the client
+            self.cond = asyncio.Condition()
+        future = asyncio.get_event_loop().create_future()
+        async with self.cond:
+            self.pending.append(((txid, step, msg), future))
+            if self.batcher is None:
+                self.batcher = asyncio.ensure_future(self._run())
+            self.cond.notify()
+        return await future
+
+    async def _run(self):
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(
+                    lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                try:
+                    await asyncio.wait_for(self.cond.wait_for(
+                        lambda: (len(self.pending) >= self.batchsize or
+                                 self.closed)), self.batchinterval)
+                except asyncio.TimeoutError:
+                    pass
+                batch = self.pending[:self.batchsize]
+                del self.pending[:self.batchsize]
+            await self._send(batch)
+
+    async def _send(self, batch):
+        try:
+            rcs = await self.write_batch([entry for (entry, _) in batch])
+        except Exception as err:  # pylint: disable=W0703
+            _LOG.exception('Error writing journal batch')
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for ((_, future), rc) in zip(batch, rcs):
+            if not future.done():
+                future.set_result(rc)
+
+    async def status(self, txid, wait=None):
+        """
+        Status of txid as (status, code), waiting on the server up to
+        wait seconds for the transaction to finish
+        """
+        return protocol.status_result(
+            *await self._request(*protocol.status_request(txid, wait)))
+
+    async def status_many(self, txids):
+        """
+        Status of txids in one request, {txid: (status, code)}
+        """
+        return protocol.status_many_result(
+            *await self._request(*protocol.status_many_request(txids)))
+
+    async def wait_for(self, txid, timeout=None):
+        """
+        Wait for txid to be committed or aborted, return its last
+        (status, code), still pending if timeout seconds went by
+        """
+        until = protocol.deadline(timeout)
+        while True:
+            (resp, code) = await self.status(txid, protocol.next_wait(until))
+            if protocol.waited(code, until):
+                return (resp, code)
+
+    async def close(self):
+        """
+        Send the queued entries and close the connections
+        """
+        self.closed = True
+        if self.batcher is not None:
+            async with self.cond:
+                self.cond.notify()
+            await self.batcher
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+__all__ = (
+    'AsyncJournalClient',
+)
@@ -0,0 +1,214 @@
+"""
+Keep-alive http connections to the journal unix socket, blocking or
+asyncio streams
+"""
+import asyncio
+import collections
+import http.client
+import socket
+import threading
+
+POOL_SIZE = 8
+TIMEOUT = 60
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a unix socket
+    """
+    def __init__(self, path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost',
+                                                 timeout=timeout or TIMEOUT)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ConnectionPool():
+    """
+    Pool of idle keep-alive connections, at most size kept
+    """
+    def __init__(self, path, size=None, timeout=None):
+        self.path = path
+        self.size = size or POOL_SIZE
+        self.timeout = timeout
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        return (UnixHTTPConnection(self.path, self.timeout), False)
+
+    def _put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request, return (status, body).
+        A pooled connection closed by the server is retried once on a
+        new connection.
+        """
+        while True:
+            (conn, reused) = self._get()
+            try:
+                conn.request(method, url, body, headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected,
+                    http.client.BadStatusLine,
+                    BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            return (resp.status, data)
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+
+class AsyncConnectionPool():
+    """
+    Pool of idle keep-alive asyncio connections, at most size kept.
+    Used from one event loop.
+    """
+    def __init__(self, path, size=None, timeout=None):
+        self.path = path
+        self.size = size or POOL_SIZE
+        self.timeout = timeout or TIMEOUT
+        # (reader, writer) of the idle connections
+        self.idle = collections.deque()
+
+    async def _get(self):
+        if self.idle:
+            return (self.idle.pop(), True)
+        conn = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.path), self.timeout)
+        return (conn, False)
+
+    def _put(self, conn):
+        if len(self.idle) < self.size:
+            self.idle.append(conn)
+            return
+        conn[1].close()
+
+    async def request(self, method, url, body=None, headers=None):
+        """
+        Send a request, return (status, body).
+        A pooled connection closed by the server is retried once on a
+        new connection.
+        """
+        while True:
+            (conn, reused) = await self._get()
+            try:
+                (status, data, keepalive) = await asyncio.wait_for(
+                    _exchange(conn, method, url, body, headers or {}),
+                    self.timeout)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                conn[1].close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                # Timed out or cancelled half way: not reusable
+                conn[1].close()
+                raise
+            if keepalive:
+                self._put(conn)
+            else:
+                conn[1].close()
+            return (status, data)
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+async def _exchange(conn, method, url, body, headers):
+    """
+    Send a request on conn, return (status, body, whether the
+    connection can be reused)
+    """
+    (reader, writer) = conn
+    lines = ['{0} {1} HTTP/1.1'.format(method, url), 'Host: localhost']
+    lines.extend('{0}: {1}'.format(name, value)
+                 for (name, value) in headers.items())
+    if body is not None:
+        lines.append('Content-Length: {0}'.format(len(body)))
+    writer.write('\r\n'.join(lines + ['', '']).encode('latin-1') +
+                 (body or b''))
+    await writer.drain()
+    statusline = await reader.readline()
+    if not statusline:
+        raise http.client.RemoteDisconnected(
+            'Remote end closed connection without response')
+    (version, status) = statusline.decode('latin-1').split(None, 2)[:2]
+    replyheaders = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, _, value) = line.decode('latin-1').partition(':')
+        replyheaders[name.strip().lower()] = value.strip()
+    keepalive = (version == 'HTTP/1.1' and
+                 replyheaders.get('connection', '').lower() != 'close')
+    if replyheaders.get('transfer-encoding', '').lower() == 'chunked':
+        data = await _read_chunked(reader)
+    elif 'content-length' in replyheaders:
+        data = await reader.readexactly(
+            int(replyheaders['content-length']))
+    else:
+        # Body up to the end of the connection
+        data = await reader.read()
+        keepalive = False
+    return (int(status), data, keepalive)
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+    # Trailers up to the empty line
+    while (await reader.readline()).strip():
+        pass
+    return b''.join(chunks)
+
+
+__all__ = (
+    'AsyncConnectionPool',
+    'ConnectionPool',
+    'UnixHTTPConnection',
+)
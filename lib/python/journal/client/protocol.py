@@ -0,0 +1,172 @@
+"""
+Requests and replies of the journal server http api, shared by the
+blocking and the asyncio clients
+"""
+import http.client
+import json
+import time
+import urllib.parse
+
+# Longest long-poll the server accepts
+MAX_WAIT = 30
+
+# The server only takes json requests
+HEADERS = {'Content-Type': 'application/json',
+           'Accept': 'application/json'}
+
+# Status codes of transactions not finished yet
+PENDING = (http.client.PROCESSING, http.client.NOT_FOUND)
+
+
+class JournalError(Exception):
+    """
+    Error answered by the journal server
+    """
+    def __init__(self, message, status_code=None):
+        super(JournalError, self).__init__(message, status_code)
+        self.message = message
+        self.status_code = status_code
+
+
+def encode(body):
+    """
+    Request body as json, None without body
+    """
+    if body is None:
+        return None
+    return json.dumps(body).encode()
+
+
+def decode(data):
+    """
+    Reply body from json, as text if not json, None if empty
+    """
+    if not data:
+        return None
+    try:
+        return json.loads(data.decode())
+    except ValueError:
+        return data.decode(errors='replace')
+
+
+def write_request(txid, step, msg):
+    """
+    (method, url, body) writing a journal entry
+    """
+    return ('POST', '/{0}/{1}'.format(_quote(txid), _quote(step)), msg)
+
+
+def write_result(status, data):
+    """
+    Raise JournalError if the entry was not saved
+    """
+    if status != http.client.CREATED:
+        raise JournalError(_message(data), status)
+
+
+def batch_request(entries):
+    """
+    (method, url, body) writing (txid, step, msg) entries
+    """
+    body = [{'txid': txid, 'step': step, 'msg': msg}
+            for (txid, step, msg) in entries]
+    return ('POST', '/batch', body)
+
+
+def batch_result(status, data):
+    """
+    rc of each entry of a batch, 0 when saved
+    """
+    if isinstance(data, dict) and 'rcs' in data:
+        return data['rcs']
+    raise JournalError(_message(data), status)
+
+
+def status_request(txid, wait=None):
+    """
+    (method, url, body) of the status of txid, long-polling up to
+    wait seconds
+    """
+    url = '/status/{0}'.format(_quote(txid))
+    if wait:
+        url += '?wait={0}'.format(min(wait, MAX_WAIT))
+    return ('GET', url, None)
+
+
+def status_result(status, data):
+    """
+    (status, code) of a txid
+    """
+    return (data, status)
+
+
+def status_many_request(txids):
+    """
+    (method, url, body) of the status of txids
+    """
+    return ('POST', '/status', list(txids))
+
+
+def status_many_result(status, data):
+    """
+    {txid: (status, code)}
+    """
+    if status != http.client.OK:
+        raise JournalError(_message(data), status)
+    return {txid: (result['status'], result['code'])
+            for (txid, result) in data.items()}
+
+
+def deadline(timeout):
+    """
+    Deadline of a wait for a txid, None without timeout
+    """
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def next_wait(until):
+    """
+    Seconds the next status long-poll waits before the deadline
+    """
+    if until is None:
+        return MAX_WAIT
+    return min(MAX_WAIT, max(until - time.monotonic(), 0))
+
+
+def waited(code, until):
+    """
+    Whether a wait for a txid is over: finished or past the deadline
+    """
+    return (code not in PENDING or
+            (until is not None and time.monotonic() >= until))
+
+
+def _quote(value):
+    return urllib.parse.quote(value, safe='')
+
+
+def _message(data):
+    if isinstance(data, dict):
+        return data.get('message', data)
+    return data
+
+
+__all__ = (
+    'HEADERS',
+    'JournalError',
+    'MAX_WAIT',
+    'PENDING',
+    'batch_request',
+    'batch_result',
+    'deadline',
+    'decode',
+    'encode',
+    'next_wait',
+    'status_many_request',
+    'status_many_result',
+    'status_request',
+    'status_result',
+    'waited',
+    'write_request',
+    'write_result',
+)
@@ -0,0 +1,153 @@
+"""
+Journal client
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+
+from journal.client import connection
+from journal.client import protocol
+from journal.client.protocol import JournalError
+
+_LOG = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+BATCH_INTERVAL = 0.01
+
+
+class JournalClient():
+    """
+    Client of the journal server unix socket, thread safe
+    """
+    def __init__(self, path, poolsize=None, timeout=None,
+                 batchsize=None, batchinterval=None):
+        """
+        Client of the server listening on path, keeping up to poolsize
+        idle connections. Writes submitted are sent in batches of
+        batchsize, waiting up to batchinterval seconds to fill them.
+        """
+        self.pool = connection.ConnectionPool(path, poolsize, timeout)
+        self.batchsize = batchsize or BATCH_SIZE
+        self.batchinterval = batchinterval or BATCH_INTERVAL
+        self.pending = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.batcher = None
+
+    def _request(self, method, url, body=None):
+        (status, data) = self.pool.request(method, url,
+                                           protocol.encode(body),
+                                           protocol.HEADERS)
+        return (status, protocol.decode(data))
+
+    def write(self, txid, step, msg):
+        """
+        Write a journal entry, raise JournalError if not saved
+        """
+        protocol.write_result(
+            *self._request(*protocol.write_request(txid, step, msg)))
+
+    def write_batch(self, entries):
+        """
+        Write (txid, step, msg) entries in one request,
+        return the rc of each entry, 0 when saved
+        """
+        return protocol.batch_result(
+            *self._request(*protocol.batch_request(entries)))
+
+    def submit(self, txid, step, msg):
+        """
+        Queue a journal entry for the next batch,
+        return a concurrent.futures.Future of its rc
+        """
+        future = concurrent.futures.Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('Journal client closed')
+            self.pending.append(((txid, step, msg), future))
+            if self.batcher is None:
+                self.batcher = threading.Thread(target=self._run,
+                                                name='journal-batch',
+                                                daemon=True)
+                self.batcher.start()
+            self.cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                deadline = time.monotonic() + self.batchinterval
+                while len(self.pending) < self.batchsize and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.pending[:self.batchsize]
+                del self.pending[:self.batchsize]
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            rcs = self.write_batch([entry for (entry, _) in batch])
+        except Exception as err:  # pylint: disable=W0703
+            _LOG.exception('Error writing journal batch')
+            for (_, future) in batch:
+                future.set_exception(err)
+            return
+        for ((_, future), rc) in zip(batch, rcs):
+            future.set_result(rc)
+
+    def status(self, txid, wait=None):
+        """
+        Status of txid as (status, code), waiting on the server up to
+        wait seconds for the transaction to finish
+        """
+        return protocol.status_result(
+            *self._request(*protocol.status_request(txid, wait)))
+
+    def status_many(self, txids):
+        """
+        Status of txids in one request, {txid: (status, code)}
+        """
+        return protocol.status_many_result(
+            *self._request(*protocol.status_many_request(txids)))
+
+    def wait_for(self, txid, timeout=None):
+        """
+        Wait for txid to be committed or aborted, return its last
+        (status, code), still pending if timeout seconds went by
+        """
+        until = protocol.deadline(timeout)
+        while True:
+            (resp, code) = self.status(txid, protocol.next_wait(until))
+            if protocol.waited(code, until):
+                return (resp, code)
+
+    def close(self):
+        """
+        Send the queued entries and close the connections
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+            batcher = self.batcher
+        if batcher is not None:
+            batcher.join()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+__all__ = (
+    'JournalClient',
+    'JournalError',
+)
@@ -0,0 +1,81 @@
+"""
+Window batching begin steps
+
+Begin steps of the requests arriving within a short window are
+journaled together in one batch write, e.g. pipelined zookeeper
+multi-ops. A begin is acknowledged once its batch is written, so it is
+never lost with the process and any worker or server reading the
+journal sees the txid in progress.
+"""
+import logging
+import threading
+import time
+
+_LOG = logging.getLogger(__name__)
+
+
+class BeginWindow():
+    """
+    Begin steps batched for window seconds
+    """
+    def __init__(self, window, flush):
+        """
+        flush(entries) journals (txid, 'begin', msg) entries,
+        returning the rc of each
+        """
+        self.window = window
+        self.flush = flush
+        # [entry, rc, written event] of the begins waiting for a batch
+        self.queue = []
+        self.cond = threading.Condition()
+        self.flusher = None
+
+    def start(self):
+        """
+        Start the flusher thread of this process
+        """
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self._run,
+                                            name='begin-flush', daemon=True)
+            self.flusher.start()
+
+    def write(self, txid, msg):
+        """
+        Journal the begin of txid with the others of its window,
+        return its rc once written
+        """
+        # No thread survives a fork
+        self.start()
+        waiter = [(txid, 'begin', msg), 1, threading.Event()]
+        with self.cond:
+            self.queue.append(waiter)
+            self.cond.notify()
+        waiter[2].wait()
+        return waiter[1]
+
+    def _batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+        # Let the window fill up
+        time.sleep(self.window)
+        with self.cond:
+            (batch, self.queue) = (self.queue, [])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            try:
+                rcs = self.flush([entry for (entry, _, _) in batch])
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception('Error writing %d begins', len(batch))
+                rcs = [1] * len(batch)
+            for (waiter, rc) in zip(batch, rcs):
+                waiter[1] = rc
+                waiter[2].set()
+
+
+__all__ = (
+    'BeginWindow',
+)
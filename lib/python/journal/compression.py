@@ -0,0 +1,218 @@
+"""
+Compression codecs for journal payloads
+
+Nodes written with a dictionary or a codec other than zlib start
+with a header holding the codec id and the dictionary id, plain zlib
+nodes have no header. A zlib stream never starts with a 0 byte so
+both can be told apart.
+"""
+import json
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block as _lz4
+except ImportError:
+    _lz4 = None
+
+HEADER = struct.Struct('!BBI')
+MARKER = 0
+
+ZLIB = 1
+ZSTD = 2
+LZ4 = 3
+
+CODECS = {
+    'zlib': ZLIB,
+    'zstd': ZSTD,
+    'lz4': LZ4,
+}
+
+# Default dictionary, a journal message with all the known keys.
+# zlib favours matches at the end of the dictionary.
+DEFAULT_DICTIONARY = json.dumps({
+    'host': '', 'user_id': '', 'authuser_id': '', 'role': None,
+    'resourcegroup': '', 'resource': '', 'verb': 'get',
+    'resourcepk': None, 'payload': None, 'cm': None,
+    'date': '2017-06-13 16:47:55',
+    'request_id': '00000000-0000-0000-0000-000000000000',
+    'transaction_id': '00000000-0000-0000-0000-000000000000',
+    'step': 'begin',
+}).encode() + b'"step": "commit"' + b'"step": "abort"'
+
+
+def dictionary_id(dictionary):
+    """
+    Id of a dictionary, 0 means no dictionary
+    """
+    if not dictionary:
+        return 0
+    return zlib.crc32(dictionary) & 0xffffffff or 1
+
+
+DEFAULT_DICTIONARY_ID = dictionary_id(DEFAULT_DICTIONARY)
+
+
+def _zlib_compress(data, dictionary):
+    if dictionary is None:
+        return zlib.compress(data)
+    compressor = zlib.compressobj(zdict=dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(data, dictionary):
+    if dictionary is None:
+        return zlib.decompress(data)
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+_ZSTD_DICTS = {}
+
+
+def _zstd_dict(dictionary):
+    dict_id = dictionary_id(dictionary)
+    if dict_id not in _ZSTD_DICTS:
+        _ZSTD_DICTS[dict_id] = zstandard.ZstdCompressionDict(dictionary)
+    return _ZSTD_DICTS[dict_id]
+
+
+def _zstd_compress(data, dictionary):
+    if dictionary is None:
+        return zstandard.ZstdCompressor().compress(data)
+    compressor = zstandard.ZstdCompressor(dict_data=_zstd_dict(dictionary))
+    return compressor.compress(data)
+
+
+def _zstd_decompress(data, dictionary):
+    if dictionary is None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    decompressor = zstandard.ZstdDecompressor(
+        dict_data=_zstd_dict(dictionary))
+    return decompressor.decompress(data)
+
+
+def _lz4_compress(data, dictionary):
+    if dictionary is None:
+        return _lz4.compress(data)
+    return _lz4.compress(data, dict=dictionary)
+
+
+def _lz4_decompress(data, dictionary):
+    if dictionary is None:
+        return _lz4.decompress(data)
+    return _lz4.decompress(data, dict=dictionary)
+
+
+_IMPL = {
+    ZLIB: (_zlib_compress, _zlib_decompress),
+    ZSTD: (_zstd_compress, _zstd_decompress),
+    LZ4: (_lz4_compress, _lz4_decompress),
+}
+
+
+class Codec():
+    """
+    Compress and decompress journal data
+    """
+    def __init__(self, name=None, dictionary=None, resolver=None):
+        """
+        Codec compressing with name (zlib by default) and dictionary.
+        Without a dictionary zlib writes plain zlib data and the other
+        codecs use the default dictionary. resolver is called with the
+        dictionary id when decoding data compressed with an unknown
+        dictionary.
+        """
+        name = name or 'zlib'
+        if name not in CODECS:
+            raise ValueError('Unknown codec {0}'.format(name))
+        if name == 'zstd' and zstandard is None:
+            raise ValueError('zstd codec needs the zstandard module')
+        if name == 'lz4' and _lz4 is None:
+            raise ValueError('lz4 codec needs the lz4 module')
+        if dictionary is None and name != 'zlib':
+            dictionary = DEFAULT_DICTIONARY
+        self.name = name
+        self.codec_id = CODECS[name]
+        self.dictionary = dictionary
+        self.dict_id = dictionary_id(dictionary)
+        self.resolver = resolver
+        self.dictionaries = {
+            0: None,
+            DEFAULT_DICTIONARY_ID: DEFAULT_DICTIONARY,
+        }
+        if dictionary:
+            self.dictionaries[self.dict_id] = dictionary
+
+    def encode(self, data, use_dictionary=True):
+        """
+        Compress data
+        """
+        dictionary = self.dictionary if use_dictionary else None
+        if self.codec_id == ZLIB and not dictionary:
+            return zlib.compress(data)
+        compress = _IMPL[self.codec_id][0]
+        header = HEADER.pack(MARKER, self.codec_id, dictionary_id(dictionary))
+        return header + compress(data, dictionary)
+
+    def decode(self, data):
+        """
+        Decompress data written by any codec
+        """
+        if data[:1] != b'\x00':
+            return zlib.decompress(data)
+        (_, codec_id, dict_id) = HEADER.unpack_from(data)
+        if codec_id not in _IMPL:
+            raise ValueError('Unknown codec id {0}'.format(codec_id))
+        if codec_id == ZSTD and zstandard is None:
+            raise ValueError('zstd data needs the zstandard module')
+        if codec_id == LZ4 and _lz4 is None:
+            raise ValueError('lz4 data needs the lz4 module')
+        decompress = _IMPL[codec_id][1]
+        return decompress(data[HEADER.size:], self._dictionary(dict_id))
+
+    def _dictionary(self, dict_id):
+        if dict_id not in self.dictionaries:
+            dictionary = None
+            if self.resolver is not None:
+                dictionary = self.resolver(dict_id)
+            if dictionary is None or dictionary_id(dictionary) != dict_id:
+                raise ValueError('Unknown dictionary {0}'.format(dict_id))
+            self.dictionaries[dict_id] = dictionary
+        return self.dictionaries[dict_id]
+
+
+def load_dictionary(path):
+    """
+    Load a dictionary file
+    """
+    if not path:
+        return None
+    with open(path, 'rb') as fin:
+        return fin.read()
+
+
+def train_dictionary(samples, size, name=None):
+    """
+    Train a dictionary of up to size bytes on sample messages
+    """
+    if name == 'zstd' and zstandard is not None:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    # zlib and lz4 use raw dictionaries: most common content last
+    counts = {}
+    for sample in samples:
+        counts[sample] = counts.get(sample, 0) + 1
+    dictionary = b''.join(sorted(counts, key=counts.get))
+    return dictionary[-size:]
+
+
+__all__ = (
+    'Codec',
+    'CODECS',
+    'load_dictionary',
+    'train_dictionary',
+)
@@ -27,6 +27,9 @@ def create_app(journal_config, kwargs):
         """
         Abort the request if its not json type
         """
+        # Load balancer probes
+        if request.endpoint == 'main.journalready':
+            return
         if not request.is_json:
             abort(400)
 
@@ -37,8 +40,18 @@ def create_app(journal_config, kwargs):
         """
         Create primary and secondary journal objects
         """
-        journalobj = mjournal.Journal(current_app.config['journal_config'],
-                                      current_app.config['extra_args'])
-        current_app.config['journal'] = journalobj
+        init_journal(current_app)
     app.register_blueprint(main_blueprint)
     return app
+
+
+def init_journal(app):
+    """
+    Create the journal of the app if not done yet,
+    and start warming up its caches
+    """
+    if 'journal' not in app.config:
+        journalobj = mjournal.Journal(app.config['journal_config'],
+                                      app.config['extra_args'])
+        journalobj.warmup()
+        app.config['journal'] = journalobj
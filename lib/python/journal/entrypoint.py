@@ -7,12 +7,16 @@ import sys
 import logging
 import argparse
 
+from journal import compression
 from journal import journal_server_main
 from journal import resync_nfs_main
 from journal import journal_cli_main
 from journal import journal_zk_sqlite_main
 from journal import journal_zk_cleanup_main
+from journal import journal_zk_compact_main
+from journal import journal_codec_train_main
 from journal import journal_zk_dump_main
+from journal import journal_nfs_migrate_main
 
 FORMAT = '[%(asctime)s] [%(filename)s] [%(process)d] '\
          '[%(levelname)s]: %(message)s'
@@ -34,12 +38,51 @@ def resync_nfs():
                         help='Secondary journal')
     parser.add_argument('--adminuser',
                         help='Admin user which has rw/delete access')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        help='Compression codec of journal nodes')
+    parser.add_argument('--codecdict',
+                        help='Compression dictionary file')
+    parser.add_argument('--encoding',
+                        choices=['json', 'binary'],
+                        help='Record encoding of journal nodes')
+    parser.add_argument('-b', '--batchsize',
+                        default=500, type=int,
+                        help='Journal entries written per batch')
+    parser.add_argument('--concurrency',
+                        default=16, type=int,
+                        help='Zookeeper requests and file reads in flight')
+    parser.add_argument('--metricsfile',
+                        help='File to publish resync metrics to')
+    parser.add_argument('--pollinterval',
+                        default=60, type=int,
+                        help='Seconds between resyncs without events')
+    parser.add_argument('--blobpath',
+                        help='Directory storing large payloads by hash')
+    parser.add_argument('--blobthreshold',
+                        default=64 * 1024, type=int,
+                        help='Payloads bigger than this many bytes '
+                             'go to the blob store')
+    parser.add_argument('--containers',
+                        action='store_true',
+                        help='Create txid nodes as container nodes, '
+                             'removed by zookeeper once folded')
     args = parser.parse_args()
     if args.cfg or args.primary and args.secondary:
         resync_nfs_main.main(args.adminuser,
                              args.cfg,
                              args.primary,
-                             args.secondary)
+                             args.secondary,
+                             args.codec,
+                             args.codecdict,
+                             args.encoding,
+                             args.batchsize,
+                             args.concurrency,
+                             args.metricsfile,
+                             args.pollinterval,
+                             args.blobpath,
+                             args.blobthreshold,
+                             args.containers)
     else:
         sys.exit("Journal config missing: type --help to see options")
 
@@ -65,6 +108,73 @@ def journal_startup():
                         help='size of history cache')
     parser.add_argument('--adminuser',
                         help='Admin user which has rw/delete access')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        help='Compression codec of journal nodes')
+    parser.add_argument('--codecdict',
+                        help='Compression dictionary file')
+    parser.add_argument('--encoding',
+                        choices=['json', 'binary'],
+                        help='Record encoding of journal nodes')
+    parser.add_argument('--durability',
+                        choices=['none', 'fsync', 'group'],
+                        help='Sync of nfs journal files before success')
+    parser.add_argument('--groupwindow',
+                        type=float,
+                        help='Seconds writers wait to share a group sync')
+    parser.add_argument('--negativettl',
+                        type=float,
+                        help='Seconds nfs journal status misses are cached')
+    parser.add_argument('--listinterval',
+                        type=float,
+                        help='Seconds between listings of the nfs journal '
+                             'used to answer status misses')
+    parser.add_argument('--spool',
+                        help='Local spool file acknowledging writes '
+                             'before they are flushed to the journal')
+    parser.add_argument('--spoolsize',
+                        default=64 * 1024 * 1024, type=int,
+                        help='Size of a new spool file in bytes')
+    parser.add_argument('--blobpath',
+                        help='Directory storing large payloads by hash')
+    parser.add_argument('--blobthreshold',
+                        default=64 * 1024, type=int,
+                        help='Payloads bigger than this many bytes '
+                             'go to the blob store')
+    parser.add_argument('--historydb',
+                        help='Indexed history file served by /history')
+    parser.add_argument('--threads',
+                        default=8, type=int,
+                        help='Threads serving requests, '
+                             'status long-polls hold one each')
+    parser.add_argument('--shmcache',
+                        help='Directory on tmpfs sharing decoded history '
+                             'snapshots and final statuses between workers')
+    parser.add_argument('--readurl',
+                        help='Zookeeper url for status reads, e.g. of '
+                             'observers or local servers')
+    parser.add_argument('--readsessions',
+                        default=2, type=int,
+                        help='Number of status read sessions')
+    parser.add_argument('--readsync',
+                        action='store_true',
+                        help='Sync read sessions with the leader before '
+                             'status reads')
+    parser.add_argument('--zksessions',
+                        default=1, type=int,
+                        help='Number of zookeeper sessions writes and '
+                             'status reads are spread over')
+    parser.add_argument('--beginwindow',
+                        type=float,
+                        help='Seconds begin steps are held to be written '
+                             'with the next step of their txid')
+    parser.add_argument('--containers',
+                        action='store_true',
+                        help='Create txid nodes as container nodes, '
+                             'removed by zookeeper once folded')
+    parser.add_argument('--binsocket',
+                        help='Unix socket for the length-prefixed '
+                             'binary protocol')
     args = parser.parse_args()
     journal_server_main.main(args)
 
@@ -82,6 +192,26 @@ def journal_cli():
                         help='Admin user which has rw/delete access')
     parser.add_argument('-c', '--cfg',
                         help='Journal config file')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        help='Compression codec of journal nodes')
+    parser.add_argument('--codecdict',
+                        help='Compression dictionary file')
+    parser.add_argument('--encoding',
+                        choices=['json', 'binary'],
+                        help='Record encoding of journal nodes')
+    parser.add_argument('--durability',
+                        choices=['none', 'fsync', 'group'],
+                        help='Sync of nfs journal files before success')
+    parser.add_argument('--groupwindow',
+                        type=float,
+                        help='Seconds writers wait to share a group sync')
+    parser.add_argument('--blobpath',
+                        help='Directory storing large payloads by hash')
+    parser.add_argument('--blobthreshold',
+                        default=64 * 1024, type=int,
+                        help='Payloads bigger than this many bytes '
+                             'go to the blob store')
     args = parser.parse_args()
     journal_cli_main.main(args)
 
@@ -98,11 +228,35 @@ def journal_zk_sqlite():
     parser.add_argument('-b', '--batchsize',
                         default=2000, type=int,
                         help='Batch size')
+    parser.add_argument('--maxbatchsize',
+                        default=20000, type=int,
+                        help='Max batch size when there is a backlog')
     parser.add_argument('-i', '--interval',
                         default=300, type=int,
-                        help='Interval in seconds')
+                        help='Max interval in seconds when idle')
+    parser.add_argument('--mininterval',
+                        default=5, type=int,
+                        help='Min interval in seconds')
+    parser.add_argument('--metricsfile',
+                        help='File to publish folding metrics to')
+    parser.add_argument('--maxtxnsize',
+                        type=int,
+                        help='Max size in bytes of a fold transaction, '
+                        'must stay below the zookeeper jute.maxbuffer')
     parser.add_argument('--adminuser',
                         help='Admin user which has rw/delete access')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        help='Compression codec of journal nodes')
+    parser.add_argument('--codecdict',
+                        help='Compression dictionary file')
+    parser.add_argument('--encoding',
+                        choices=['json', 'binary'],
+                        help='Record encoding of journal nodes')
+    parser.add_argument('--containers',
+                        action='store_true',
+                        help='Txid nodes are container nodes, '
+                             'lock nodes are created as such')
     args = parser.parse_args()
     journal_zk_sqlite_main.main(args)
 
@@ -126,6 +280,8 @@ def journal_zk_dump():
                         help='Pattern of files in nfs')
     parser.add_argument('-o', '--outfile', required=True,
                         help='dump output file name')
+    parser.add_argument('--historydb',
+                        help='Indexed history file to load dumped rows to')
     args = parser.parse_args()
     journal_zk_dump_main.main(args)
 
@@ -153,3 +309,84 @@ def journal_zk_cleanup():
                         help='dump output file name')
     args = parser.parse_args()
     journal_zk_cleanup_main.main(args)
+
+
+def journal_zk_compact():
+    """
+    Zk history sqlite node compaction
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg',
+                        help='Journal config file')
+    parser.add_argument('-p', '--primary',
+                        help='Zookeeper journal')
+    parser.add_argument('-n', '--nfspath',
+                        required=True,
+                        help='NFS path of the dump')
+    parser.add_argument('-i', '--interval',
+                        default=300, type=int,
+                        help='Interval in seconds')
+    parser.add_argument('-t', '--targetsize',
+                        default=256 * 1024, type=int,
+                        help='Target size in bytes of compacted nodes')
+    parser.add_argument('--maxtxnsize',
+                        type=int,
+                        help='Max size in bytes of a compaction transaction')
+    parser.add_argument('-r', '--nfsregex', required=True,
+                        help='Pattern of files in nfs')
+    parser.add_argument('-o', '--outfile', required=True,
+                        help='dump output file name')
+    parser.add_argument('--adminuser',
+                        help='Admin user which has rw/delete access')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        help='Compression codec of journal nodes')
+    parser.add_argument('--codecdict',
+                        help='Compression dictionary file')
+    parser.add_argument('--encoding',
+                        choices=['json', 'binary'],
+                        help='Record encoding of journal nodes')
+    args = parser.parse_args()
+    journal_zk_compact_main.main(args)
+
+
+def journal_codec_train():
+    """
+    Train a compression dictionary on live journal nodes
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg',
+                        help='Journal config file')
+    parser.add_argument('-p', '--primary',
+                        help='Zookeeper journal')
+    parser.add_argument('--codec',
+                        choices=sorted(compression.CODECS),
+                        default='zstd',
+                        help='Codec the dictionary is trained for')
+    parser.add_argument('-n', '--samples',
+                        default=2000, type=int,
+                        help='Number of journal nodes to sample')
+    parser.add_argument('--dictsize',
+                        default=16 * 1024, type=int,
+                        help='Dictionary size in bytes')
+    parser.add_argument('-o', '--outfile', required=True,
+                        help='Dictionary output file name')
+    args = parser.parse_args()
+    journal_codec_train_main.main(args)
+
+
+def journal_nfs_migrate():
+    """
+    Migrate an NFS journal directory to hashed subdirectories
+    """
+    logging.basicConfig(format=FORMAT,
+                        level=logging.INFO,
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nfspath', required=True,
+                        help='NFS journal directory')
+    parser.add_argument('-s', '--shards',
+                        default=256, type=int,
+                        help='Number of subdirectories, 0 for flat')
+    args = parser.parse_args()
+    journal_nfs_migrate_main.main(args)
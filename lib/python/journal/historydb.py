@@ -0,0 +1,163 @@
+"""
+Local indexed store of the journal history
+
+The dump loads the rows of every /history snapshot it dumps into a
+sqlite file indexed on the columns audit queries filter on, and the
+webserver answers filtered, paginated queries from it. Payloads
+offloaded to the blob store are stored as their reference and read
+back from the store by queries.
+"""
+import json
+import logging
+import sqlite3
+import threading
+
+from journal import blobstore
+
+_LOG = logging.getLogger(__name__)
+
+HISTORY_CREATE = (
+    """
+    CREATE TABLE IF NOT EXISTS journal (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        seqid          TEXT          NOT NULL,
+        host           TEXT,
+        authuser_id    TEXT,
+        user_id        TEXT,
+        date           TEXT,
+        request_id     TEXT,
+        transaction_id TEXT,
+        step           TEXT,
+        as_role        TEXT,
+        resourcegroup  TEXT,
+        resource       TEXT,
+        verb           TEXT,
+        resourcepk     TEXT,
+        payload        TEXT,
+        cm             TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        seqid          TEXT PRIMARY KEY
+    )""",
+    'CREATE INDEX IF NOT EXISTS journal_request_id ON journal (request_id)',
+    'CREATE INDEX IF NOT EXISTS journal_user_id ON journal (user_id, date)',
+    'CREATE INDEX IF NOT EXISTS journal_resource ON journal (resource, date)',
+    'CREATE INDEX IF NOT EXISTS journal_step ON journal (step, date)',
+    'CREATE INDEX IF NOT EXISTS journal_date ON journal (date)',
+)
+
+COLUMNS = ('host', 'authuser_id', 'user_id', 'date',
+           'request_id', 'transaction_id', 'step', 'as_role',
+           'resourcegroup', 'resource', 'verb', 'resourcepk',
+           'payload', 'cm')
+
+HISTORY_INSERT = """
+    INSERT INTO journal (seqid, {0})
+    VALUES (?, {1})""".format(', '.join(COLUMNS),
+                              ', '.join('?' * len(COLUMNS)))
+
+# Query parameters matched for equality
+FILTERS = ('request_id', 'transaction_id', 'user_id', 'authuser_id',
+           'resource', 'resourcegroup', 'step', 'verb', 'host')
+
+QUERY_LIMIT = 100
+MAX_QUERY_LIMIT = 1000
+
+
+class HistoryDB():
+    """
+    Indexed journal history
+    """
+    def __init__(self, path, readonly=False, blobpath=None):
+        self.path = path
+        self.readonly = readonly
+        self.blobs = None
+        if blobpath:
+            self.blobs = blobstore.BlobStore(blobpath)
+        # sqlite connections are used by the thread which opened them
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(
+                    'file:{0}?mode=ro'.format(self.path), uri=True)
+            else:
+                conn = sqlite3.connect(self.path)
+                for statement in HISTORY_CREATE:
+                    conn.execute(statement)
+                conn.commit()
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def ingest(self, seqid, rows):
+        """
+        Add the rows of a snapshot, once per snapshot sequence id.
+        Rows are in COLUMNS order.
+        """
+        conn = self._connect()
+        rows = [(seqid,) + tuple(row) for row in rows]
+        with conn:
+            try:
+                conn.execute('INSERT INTO snapshots (seqid) VALUES (?)',
+                             (seqid,))
+            except sqlite3.IntegrityError:
+                _LOG.debug('Snapshot %s already in history', seqid)
+                return 0
+            conn.executemany(HISTORY_INSERT, rows)
+        return len(rows)
+
+    def query(self, filters, since=None, until=None, cursor=None,
+              limit=None):
+        """
+        Rows matching the filters, from date since to date until,
+        after the cursor of the previous page.
+        Return (rows, cursor of the next page or None).
+        """
+        limit = min(limit or QUERY_LIMIT, MAX_QUERY_LIMIT)
+        clauses = []
+        params = []
+        for key in FILTERS:
+            if filters.get(key) is not None:
+                clauses.append('{0} = ?'.format(key))
+                params.append(filters[key])
+        if since is not None:
+            clauses.append('date >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('date < ?')
+            params.append(until)
+        if cursor is not None:
+            clauses.append('id > ?')
+            params.append(cursor)
+        sql = 'SELECT * FROM journal'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY id LIMIT ?'
+        params.append(limit + 1)
+        rows = self._connect().execute(sql, params).fetchall()
+        nextcursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextcursor = rows[-1]['id']
+        rows = [_row_dict(row) for row in rows]
+        if self.blobs is not None:
+            rows = [self.blobs.rehydrate(row) for row in rows]
+        return (rows, nextcursor)
+
+
+def _row_dict(row):
+    data = {key: row[key] for key in row.keys() if key != 'id'}
+    data['role'] = data.pop('as_role')
+    if data['payload'] is not None:
+        data['payload'] = json.loads(data['payload'])
+    return data
+
+
+__all__ = (
+    'HistoryDB',
+    'FILTERS',
+)
@@ -0,0 +1,93 @@
+"""
+Minimal inotify binding, used to wake up on new journal files.
+inotify only sees changes made through the local kernel: on NFS,
+files written by other hosts are not reported.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie, len
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not all(hasattr(libc, name)
+               for name in ('inotify_init1', 'inotify_add_watch')):
+        return None
+    return libc
+
+
+_LIBC = _load_libc()
+
+
+def _error():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+def available():
+    """
+    Whether inotify can be used
+    """
+    return _LIBC is not None
+
+
+class Watcher():
+    """
+    Watch directories for changes
+    """
+    def __init__(self, paths, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        if _LIBC is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _LIBC.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise _error()
+        for path in paths:
+            self.add(path, mask)
+
+    def add(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        """
+        Watch another directory
+        """
+        if _LIBC.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise _error()
+
+    def read(self):
+        """
+        Block until changes, return the names changed
+        """
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            (_, _, _, length) = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            names.append(os.fsdecode(
+                data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        """
+        Stop watching
+        """
+        os.close(self.fd)
+
+
+__all__ = (
+    'Watcher',
+    'available',
+)
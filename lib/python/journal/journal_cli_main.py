@@ -31,6 +31,13 @@ def journal_init(in_args):
     if 'primary' not in jconfig and 'secondary' not in jconfig:
         sys.exit("Missing primary and secondary journal")
     jconfig['adminuser'] = in_args.adminuser
+    jconfig['codec'] = in_args.codec
+    jconfig['codecdict'] = in_args.codecdict
+    jconfig['encoding'] = in_args.encoding
+    jconfig['durability'] = in_args.durability
+    jconfig['groupwindow'] = in_args.groupwindow
+    jconfig['blobpath'] = in_args.blobpath
+    jconfig['blobthreshold'] = in_args.blobthreshold
     kwargs = dict()
     return mjournal.Journal(jconfig, kwargs)
 
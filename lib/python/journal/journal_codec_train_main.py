@@ -0,0 +1,53 @@
+"""
+Train a compression dictionary on journal nodes
+"""
+import sys
+import yaml
+from journal import compression
+from journal import shardjournal
+from journal import zkjournal
+
+
+def main(args):
+    """
+    Command line journal
+    """
+    primary_journal = None
+    kwargs = dict()
+    if args.cfg:
+        with open(args.cfg) as config:
+            jconf = yaml.load(config)
+            if 'primary' in jconf:
+                primary_journal = jconf['primary']
+                jconf.pop('primary')
+            kwargs = jconf
+    if args.primary:
+        primary_journal = args.primary
+    if primary_journal is None:
+        sys.exit("Missing primary journal")
+    try:
+        urls = shardjournal.shard_urls(primary_journal)
+    except ValueError as err:
+        sys.exit(str(err))
+    for url in urls:
+        (jmodule, jval) = url.split('://')
+        str(jmodule).lower()
+        if 'zookeeper' not in jmodule:
+            sys.exit("Wrong zookeeper information")
+    # The dictionary is shared by the shards, sample each of them
+    count = -(-args.samples // len(urls))
+    samples = []
+    for url in urls:
+        zkj = zkjournal.ZookeeperJournal(url, kwargs)
+        zkj.journal_zk_start()
+        if not zkj.zk.connected:
+            sys.exit("Zookeeper not connected")
+        samples.extend(zkj.sample_messages(count))
+    if not samples:
+        sys.exit("No journal nodes to sample")
+    dictionary = compression.train_dictionary(samples,
+                                              args.dictsize,
+                                              args.codec)
+    with open(args.outfile, 'wb') as fout:
+        fout.write(dictionary)
+    sys.exit()
@@ -0,0 +1,20 @@
+"""
+Move NFS journal files to a sharded directory layout
+"""
+import logging
+import sys
+from journal import nfsjournal
+
+_LOG = logging.getLogger(__name__)
+
+
+def main(args):
+    """
+    Command line journal
+    """
+    try:
+        moved = nfsjournal.migrate(args.nfspath, args.shards)
+    except ValueError as err:
+        sys.exit(str(err))
+    _LOG.info('Moved %d journal files to %d shards', moved, args.shards)
+    sys.exit()
@@ -9,6 +9,7 @@ import errno
 
 import yaml
 from gunicorn.app.base import Application
+from journal import binserver
 from journal import createapp
 
 _LOG = logging.getLogger(__name__)
@@ -30,22 +31,45 @@ class FlaskApp(Application):
         Passing options to gunicorn web server
         """
         return {'bind': self.options['bind'],
-                'timeout': self.options['timeout']}
+                'timeout': self.options['timeout'],
+                'threads': self.options['threads'],
+                'post_worker_init': self.post_worker_init}
+
+    def post_worker_init(self, worker):
+        """
+        Serve the binary protocol with the journal of one worker,
+        taken over by the worker replacing it if it exits
+        """
+        if self.options.get('binsocket'):
+            server = binserver.BinaryServer(self.options['binsocket'],
+                                            self.app.config['journal'])
+            if server.try_start():
+                _LOG.info('Worker %d serves the binary protocol', worker.pid)
 
     def load(self):
         """
         Load flask application
         """
-
+        # In the worker: warm the caches before the first request
+        createapp.init_journal(self.app)
         return self.app
 
 
-def main(args):
+# Command line options passed as is to the journal
+JOURNAL_OPTIONS = (
+    'adminuser', 'codec', 'codecdict', 'encoding', 'durability',
+    'groupwindow', 'blobpath', 'blobthreshold', 'historydb', 'shmcache',
+    'readurl', 'readsessions', 'readsync', 'zksessions', 'beginwindow',
+    'containers', 'negativettl', 'listinterval', 'spool', 'spoolsize',
+)
+
+
+def _journal_config(args):
     """
-    Journal web server start up entry function
+    Journal config and zookeeper options from the config file
+    and the command line
     """
     jconfig = dict()
-
     kwargs = dict()
     if args.cfg:
         with open(args.cfg) as config:
@@ -57,14 +81,22 @@ def main(args):
                 jconfig['secondary'] = jconf['secondary']
                 jconf.pop('secondary')
             kwargs = jconf
-    journal_socket = 'unix:{0}'.format(args.unixsocket)
-
     if args.primary:
         jconfig['primary'] = args.primary
     if args.secondary:
         jconfig['secondary'] = args.secondary
     jconfig['cachesize'] = args.historycache
-    jconfig['adminuser'] = args.adminuser
+    for option in JOURNAL_OPTIONS:
+        jconfig[option] = getattr(args, option)
+    return (jconfig, kwargs)
+
+
+def main(args):
+    """
+    Journal web server start up entry function
+    """
+    (jconfig, kwargs) = _journal_config(args)
+    journal_socket = 'unix:{0}'.format(args.unixsocket)
     if 'primary' not in jconfig and 'secondary' not in jconfig:
         sys.exit("Missing primary and secondary journal")
     try:
@@ -78,5 +110,6 @@ def main(args):
             raise
     app = createapp.create_app(jconfig, kwargs)
     sys.argv = sys.argv[:1]
-    opt = {'bind': journal_socket, 'timeout': 60}
+    opt = {'bind': journal_socket, 'timeout': 60, 'threads': args.threads,
+           'binsocket': args.binsocket}
     FlaskApp(opt, app).run()
@@ -4,6 +4,7 @@ Remove old history files
 import re
 import sys
 import yaml
+from journal import shardjournal
 from journal import zkjournal
 
 
@@ -24,17 +25,26 @@ def main(args):
         primary_journal = args.primary
     if primary_journal is None:
         sys.exit("Missing primary journal")
-    (jmodule, jval) = primary_journal.split('://')
-    str(jmodule).lower()
-    if 'zookeeper' not in jmodule:
-        sys.exit("Wrong zookeeper information")
+    try:
+        urls = shardjournal.shard_urls(primary_journal)
+    except ValueError as err:
+        sys.exit(str(err))
+    for url in urls:
+        (jmodule, jval) = url.split('://')
+        str(jmodule).lower()
+        if 'zookeeper' not in jmodule:
+            sys.exit("Wrong zookeeper information")
     nfsregex_compiled = re.compile(args.nfsregex)
-    zkj = zkjournal.ZookeeperJournal(primary_journal, kwargs)
-    zkj.journal_zk_start()
-    if zkj.zk.connected:
-        zkj.cleanup(args.nfspath,
-                    args.interval,
-                    args.age,
-                    args.outfile,
-                    nfsregex_compiled)
+
+    def cleanup(url, shard):
+        zkj = zkjournal.ZookeeperJournal(url, kwargs, shard=shard)
+        zkj.journal_zk_start()
+        if zkj.zk.connected:
+            zkj.cleanup(args.nfspath,
+                        args.interval,
+                        args.age,
+                        args.outfile,
+                        nfsregex_compiled)
+
+    shardjournal.run_per_shard(primary_journal, cleanup)
     sys.exit()
@@ -0,0 +1,55 @@
+"""
+Compact small zk sqlite nodes
+"""
+import re
+import sys
+import yaml
+from journal import shardjournal
+from journal import zkjournal
+
+
+def main(args):
+    """
+    Command line journal
+    """
+    primary_journal = None
+    kwargs = dict()
+    if args.cfg:
+        with open(args.cfg) as config:
+            jconf = yaml.load(config)
+            if 'primary' in jconf:
+                primary_journal = jconf['primary']
+                jconf.pop('primary')
+            kwargs = jconf
+    if args.primary:
+        primary_journal = args.primary
+    if primary_journal is None:
+        sys.exit("Missing primary journal")
+    try:
+        urls = shardjournal.shard_urls(primary_journal)
+    except ValueError as err:
+        sys.exit(str(err))
+    for url in urls:
+        (jmodule, jval) = url.split('://')
+        str(jmodule).lower()
+        if 'zookeeper' not in jmodule:
+            sys.exit("Wrong zookeeper information")
+    nfsregex_compiled = re.compile(args.nfsregex)
+
+    def compact(url, shard):
+        zkj = zkjournal.ZookeeperJournal(url, kwargs, args.adminuser,
+                                         maxtxnsize=args.maxtxnsize,
+                                         codec=args.codec,
+                                         codecdict=args.codecdict,
+                                         encoding=args.encoding,
+                                         shard=shard)
+        zkj.journal_zk_start()
+        if zkj.zk.connected:
+            zkj.compact(args.nfspath,
+                        args.interval,
+                        args.targetsize,
+                        args.outfile,
+                        nfsregex_compiled)
+
+    shardjournal.run_per_shard(primary_journal, compact)
+    sys.exit()
@@ -4,6 +4,8 @@ Dump zk sqlite nodes to NFS
 import re
 import sys
 import yaml
+from journal import historydb
+from journal import shardjournal
 from journal import zkjournal
 
 
@@ -24,16 +26,29 @@ def main(args):
         primary_journal = args.primary
     if primary_journal is None:
         sys.exit("Missing primary journal")
-    (jmodule, jval) = primary_journal.split('://')
-    str(jmodule).lower()
-    if 'zookeeper' not in jmodule:
-        sys.exit("Wrong zookeeper information")
+    try:
+        urls = shardjournal.shard_urls(primary_journal)
+    except ValueError as err:
+        sys.exit(str(err))
+    for url in urls:
+        (jmodule, jval) = url.split('://')
+        str(jmodule).lower()
+        if 'zookeeper' not in jmodule:
+            sys.exit("Wrong zookeeper information")
     nfsregex_compiled = re.compile(args.nfsregex)
-    zkj = zkjournal.ZookeeperJournal(primary_journal, kwargs)
-    zkj.journal_zk_start()
-    if zkj.zk.connected:
-        zkj.dump(args.nfspath,
-                 args.interval,
-                 args.outfile,
-                 nfsregex_compiled)
+
+    def dump(url, shard):
+        zkj = zkjournal.ZookeeperJournal(url, kwargs, shard=shard)
+        history = None
+        if args.historydb:
+            history = historydb.HistoryDB(args.historydb)
+        zkj.journal_zk_start()
+        if zkj.zk.connected:
+            zkj.dump(args.nfspath,
+                     args.interval,
+                     args.outfile,
+                     nfsregex_compiled,
+                     history)
+
+    shardjournal.run_per_shard(primary_journal, dump)
     sys.exit()
@@ -4,6 +4,8 @@ sqlite db
 """
 import sys
 import yaml
+from journal import metrics
+from journal import shardjournal
 from journal import zkjournal
 
 
@@ -24,14 +26,32 @@ def main(args):
         primary_journal = args.primary
     if primary_journal is None:
         sys.exit("Missing primary journal")
-    (jmodule, jval) = primary_journal.split('://')
-    str(jmodule).lower()
-    if 'zookeeper' not in jmodule:
-        sys.exit("Wrong zookeeper information")
-    zkj = zkjournal.ZookeeperJournal(primary_journal, kwargs, args.adminuser)
-    zkj.journal_zk_start()
-    if zkj.zk.connected:
-        zkj.upload_batch(
-            args.batchsize,
-            args.interval)
+    try:
+        urls = shardjournal.shard_urls(primary_journal)
+    except ValueError as err:
+        sys.exit(str(err))
+    for url in urls:
+        (jmodule, jval) = url.split('://')
+        str(jmodule).lower()
+        if 'zookeeper' not in jmodule:
+            sys.exit("Wrong zookeeper information")
+    metrics.configure(args.metricsfile)
+
+    def fold(url, shard):
+        zkj = zkjournal.ZookeeperJournal(url, kwargs, args.adminuser,
+                                         maxtxnsize=args.maxtxnsize,
+                                         codec=args.codec,
+                                         codecdict=args.codecdict,
+                                         encoding=args.encoding,
+                                         shard=shard,
+                                         containers=args.containers)
+        zkj.journal_zk_start()
+        if zkj.zk.connected:
+            zkj.upload_batch(
+                args.batchsize,
+                args.interval,
+                args.maxbatchsize,
+                args.mininterval)
+
+    shardjournal.run_per_shard(primary_journal, fold)
     sys.exit()
@@ -5,16 +5,29 @@ Module containing route for zookeeper journal
 import http.client
 import json
 import logging
-from flask import request, current_app, make_response
+import sqlite3
+import time
+import kazoo.exceptions
+from flask import (request, current_app, make_response, Response,
+                   stream_with_context)
 from journal.main import MAIN
 
 # W0611: Unused import
 # This module import is needed for journal_obj.write
 from journal import mjournal  # pylint: disable=W0611
+from journal import historydb
 from journal.main import errors
 
 _LOG = logging.getLogger(__name__)
 
+# Rows per chunk of the history export
+EXPORT_CHUNK_ROWS = 100
+
+# Longest status long-poll, and its polling interval bounds
+MAX_STATUS_WAIT = 30
+WAIT_POLL_MIN = 0.05
+WAIT_POLL_MAX = 1
+
 
 @MAIN.route('/<string:txid>/<string:step>', methods=['POST'])
 def journalview(txid, step):
@@ -44,9 +57,161 @@ def journalstatus(txid):
     """
 
     journal_obj = current_app.config['journal']
-    (resp, status_code) = journal_obj.status(txid)
+    wait = min(request.args.get('wait', 0, type=float), MAX_STATUS_WAIT)
+    (resp, status_code) = _wait_status(journal_obj, txid, wait)
     if resp is not None:
         resp = json.dumps(resp)
     output = make_response(resp, status_code)
     output.headers['Content-Type'] = 'application/json'
     return output
+
+
+def _wait_status(journal_obj, txid, wait):
+    """
+    Status of txid, polling for up to wait seconds until the
+    transaction is committed or aborted
+    """
+    deadline = time.monotonic() + wait
+    interval = WAIT_POLL_MIN
+    while True:
+        (resp, status_code) = journal_obj.status(txid)
+        if status_code not in (http.client.PROCESSING, http.client.NOT_FOUND):
+            return (resp, status_code)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return (resp, status_code)
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, WAIT_POLL_MAX)
+
+
+@MAIN.route('/batch', methods=['POST'])
+def journalbatch():
+    """
+    Handler for batched journal writes,
+    a list of {'txid': .., 'step': .., 'msg': ..}
+    """
+
+    try:
+        entries = [(entry['txid'], entry['step'], entry['msg'])
+                   for entry in request.get_json()]
+    except (KeyError, TypeError) as exc:
+        raise errors.APIError('Batch entries need txid, step and msg',
+                              status_code=http.client.BAD_REQUEST) from exc
+    journal_obj = current_app.config['journal']
+    rcs = journal_obj.write_batch(entries)
+    if any(rcs):
+        for ((txid, step, _), rc) in zip(entries, rcs):
+            if rc != 0:
+                _LOG.critical('Unsaved journal entry %s:%s', txid, step)
+        raise errors.APIError('Unsaved Journal entries',
+                              status_code=http.client.INTERNAL_SERVER_ERROR,
+                              payload={'rcs': rcs})
+    output = make_response(json.dumps({'rcs': rcs}), http.client.CREATED)
+    output.headers['Content-Type'] = 'application/json'
+    return output
+
+
+@MAIN.route('/status', methods=['POST'])
+def journalstatusbulk():
+    """
+    Handler for the status of a list of txids
+    """
+
+    txids = request.get_json()
+    if not isinstance(txids, list):
+        raise errors.APIError('Expected a list of txids',
+                              status_code=http.client.BAD_REQUEST)
+    journal_obj = current_app.config['journal']
+    statuses = {}
+    for txid in txids:
+        (resp, status_code) = journal_obj.status(txid)
+        statuses[txid] = {'status': resp, 'code': status_code}
+    output = make_response(json.dumps(statuses), http.client.OK)
+    output.headers['Content-Type'] = 'application/json'
+    return output
+
+
+@MAIN.route('/ready', methods=['GET'])
+def journalready():
+    """
+    Readiness of the server, not ready until the caches are warm
+    """
+
+    journal_obj = current_app.config.get('journal')
+    if journal_obj is None or not journal_obj.is_ready():
+        status_code = http.client.SERVICE_UNAVAILABLE
+    else:
+        status_code = http.client.OK
+    output = make_response(
+        json.dumps({'ready': status_code == http.client.OK}), status_code)
+    output.headers['Content-Type'] = 'application/json'
+    return output
+
+
+@MAIN.route('/history', methods=['GET'])
+def journalhistory():
+    """
+    Handler for history queries
+    """
+
+    journal_obj = current_app.config['journal']
+    if journal_obj.history is None:
+        raise errors.APIError('History store not configured',
+                              status_code=http.client.NOT_FOUND)
+    filters = {key: request.args.get(key) for key in historydb.FILTERS}
+    try:
+        (rows, cursor) = journal_obj.history.query(
+            filters,
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            cursor=request.args.get('cursor', type=int),
+            limit=request.args.get('limit', type=int))
+    except sqlite3.Error as err:
+        _LOG.exception('History query failed')
+        raise errors.APIError('History query failed: {0}'.format(err),
+                              status_code=http.client.SERVICE_UNAVAILABLE)
+    output = make_response(json.dumps({'rows': rows, 'cursor': cursor}),
+                           http.client.OK)
+    output.headers['Content-Type'] = 'application/json'
+    return output
+
+
+@MAIN.route('/export', methods=['GET'])
+def journalexport():
+    """
+    Handler for history export, streams NDJSON rows
+    """
+
+    journal_obj = current_app.config['journal']
+    try:
+        since = request.args.get('since', type=int)
+        until = request.args.get('until', type=int)
+        rows = journal_obj.export(
+            since=None if since is None else '{0:010d}'.format(since),
+            until=None if until is None else '{0:010d}'.format(until),
+            sincetime=request.args.get('sincetime', type=float),
+            untiltime=request.args.get('untiltime', type=float))
+    except kazoo.exceptions.KazooException as err:
+        _LOG.exception('History export failed')
+        raise errors.APIError('History export failed: {0}'.format(err),
+                              status_code=http.client.SERVICE_UNAVAILABLE)
+    if rows is None:
+        raise errors.APIError('Journal history not available',
+                              status_code=http.client.NOT_FOUND)
+
+    def generate():
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(json.dumps(row))
+                if len(chunk) >= EXPORT_CHUNK_ROWS:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+        except kazoo.exceptions.KazooException:
+            # Headers are sent, the client sees a short stream
+            _LOG.exception('History export interrupted')
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
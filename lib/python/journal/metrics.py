@@ -0,0 +1,76 @@
+"""
+Module for journal process metrics
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+_LOG = logging.getLogger(__name__)
+
+_METRICS = {}
+_LOCK = threading.Lock()
+_CONFIG = {'metricsfile': None}
+
+
+def configure(metricsfile):
+    """
+    Set the file metrics are published to
+    """
+    _CONFIG['metricsfile'] = metricsfile
+
+
+def gauge(name, value):
+    """
+    Set a gauge metric
+    """
+    with _LOCK:
+        _METRICS[name] = value
+
+
+def incr(name, value=1):
+    """
+    Increment a counter metric
+    """
+    with _LOCK:
+        _METRICS[name] = _METRICS.get(name, 0) + value
+
+
+def snapshot():
+    """
+    Get a copy of the current metrics
+    """
+    with _LOCK:
+        return dict(_METRICS)
+
+
+def publish():
+    """
+    Write current metrics to the metrics file, if configured
+    """
+    metricsfile = _CONFIG['metricsfile']
+    if not metricsfile:
+        return
+    data = snapshot()
+    data['timestamp'] = time.time()
+    try:
+        with tempfile.NamedTemporaryFile(
+                suffix='-XXXXX.tmp',
+                dir=os.path.dirname(os.path.abspath(metricsfile)),
+                delete=False, mode='w'
+        ) as outfile:
+            json.dump(data, outfile)
+        os.rename(outfile.name, metricsfile)
+    except (IOError, OSError):
+        _LOG.exception('Error publishing metrics to %s', metricsfile)
+
+
+__all__ = (
+    'configure',
+    'gauge',
+    'incr',
+    'publish',
+    'snapshot',
+)
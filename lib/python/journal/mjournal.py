@@ -3,8 +3,14 @@ Journal Factory module
 """
 import logging
 import http.client
+import os
 import sys
+from journal import coalesce
+from journal import historydb
 from journal import nfsjournal
+from journal import segjournal
+from journal import shardjournal
+from journal import spool
 from journal import zkjournal
 
 _LOG = logging.getLogger(__name__)
@@ -21,6 +27,9 @@ class Journal():
         """
         self.primary = None
         self.secondary = None
+        self.spool = None
+        self.history = None
+        self.begins = None
 
         self.initialize(jconfig, kwargs)
 
@@ -30,28 +39,151 @@ class Journal():
         """
         cachesize = jconfig.get('cachesize', None)
         adminuser = jconfig.get('adminuser', None)
+        codec = jconfig.get('codec', None)
+        codecdict = jconfig.get('codecdict', None)
+        encoding = jconfig.get('encoding', None)
         if 'primary' in jconfig:
-            self.primary = self.create_journal(jconfig['primary'],
-                                               kwargs, cachesize,
-                                               adminuser)
+            self.primary = self.create_journal(
+                jconfig['primary'], kwargs, cachesize,
+                adminuser, codec, codecdict, encoding,
+                blobpath=jconfig.get('blobpath', None),
+                blobthreshold=jconfig.get('blobthreshold', None),
+                shmcachepath=jconfig.get('shmcache', None),
+                readurl=jconfig.get('readurl', None),
+                readsessions=jconfig.get('readsessions', None),
+                readsync=jconfig.get('readsync', False),
+                sessions=jconfig.get('zksessions', None),
+                containers=jconfig.get('containers', False))
         if 'secondary' in jconfig:
-            self.secondary = self.create_journal(jconfig['secondary'])
+            self.secondary = self.create_journal(
+                jconfig['secondary'],
+                durability=jconfig.get('durability', None),
+                groupwindow=jconfig.get('groupwindow', None),
+                negativettl=jconfig.get('negativettl', None),
+                listinterval=jconfig.get('listinterval', None))
+        if jconfig.get('historydb', None):
+            self.history = historydb.HistoryDB(
+                jconfig['historydb'], readonly=True,
+                blobpath=jconfig.get('blobpath', None))
+        if jconfig.get('spool', None):
+            self.spool = spool.Spool(jconfig['spool'], self,
+                                     jconfig.get('spoolsize', None))
+            # Flush what was left by earlier processes
+            self.spool.start()
+        if jconfig.get('beginwindow', None):
+            self.begins = coalesce.BeginWindow(jconfig['beginwindow'],
+                                               self.write_batch)
+            self.begins.start()
 
     def create_journal(self, jconf, kwargs=None,
-                       cachesize=None, adminuser=None):
+                       cachesize=None, adminuser=None,
+                       codec=None, codecdict=None, encoding=None,
+                       durability=None, groupwindow=None,
+                       negativettl=None, listinterval=None,
+                       blobpath=None, blobthreshold=None,
+                       shmcachepath=None, readurl=None,
+                       readsessions=None, readsync=False, sessions=None,
+                       containers=False):
         """get the name and create obj"""
+        try:
+            shards = shardjournal.shards(jconf)
+        except ValueError as err:
+            sys.exit(str(err))
+        if len(shards) > 1:
+            if not all('zookeeper' in url.split('://')[0]
+                       for (_, url) in shards):
+                sys.exit("Only zookeeper journals can be sharded")
+            if readurl:
+                _LOG.warning('Read sessions are not used by sharded journals')
+            journals = {}
+            for (index, (name, url)) in enumerate(shards):
+                suffix = shardjournal.shard_suffix(index, name)
+                shardcache = shmcachepath
+                if shmcachepath and suffix:
+                    shardcache = os.path.join(shmcachepath, suffix)
+                journals[name] = zkjournal.ZookeeperJournal(
+                    url, kwargs, adminuser, cachesize,
+                    codec=codec, codecdict=codecdict, encoding=encoding,
+                    blobpath=blobpath, blobthreshold=blobthreshold,
+                    shmcachepath=shardcache, shard=suffix,
+                    sessions=sessions, containers=containers)
+            return shardjournal.ShardedJournal(journals)
+        jconf = shards[0][1]
         (jmodule, jval) = jconf.split('://')
         str(jmodule).lower()
         if jmodule == 'nfs':
-            return nfsjournal.NFSJournal(jval)
+            return nfsjournal.NFSJournal(jval, durability, groupwindow,
+                                         negativettl, listinterval)
+        if jmodule == 'segment':
+            return segjournal.SegmentJournal(jval)
         if 'zookeeper' in jmodule:
             return zkjournal.ZookeeperJournal(jconf,
                                               kwargs,
                                               adminuser,
-                                              cachesize)
+                                              cachesize,
+                                              codec=codec,
+                                              codecdict=codecdict,
+                                              encoding=encoding,
+                                              blobpath=blobpath,
+                                              blobthreshold=blobthreshold,
+                                              shmcachepath=shmcachepath,
+                                              readurl=readurl,
+                                              readsessions=readsessions,
+                                              readsync=readsync,
+                                              sessions=sessions,
+                                              containers=containers)
         sys.exit("Unsupported journal type")
 
+    def warmup(self):
+        """
+        Start warming up the primary journal caches
+        """
+        if hasattr(self.primary, 'warmup'):
+            self.primary.warmup()
+
+    def is_ready(self):
+        """
+        Whether the caches are warm
+        """
+        if hasattr(self.primary, 'is_ready'):
+            return self.primary.is_ready()
+        return True
+
     def write(self, txid, step, msg):
+        """
+        Write journal to the spool, or primary or secondary
+        """
+        if self.spool is not None:
+            try:
+                self.spool.append(txid, step, msg)
+                return 0
+            except spool.SpoolFull:
+                _LOG.warning('Journal spool full, writing through')
+            except (IOError, OSError):
+                _LOG.exception('Error writing to journal spool')
+        if self.begins is not None and step == 'begin':
+            return self.begins.write(txid, msg)
+        return self._write(txid, step, msg)
+
+    def write_batch(self, entries):
+        """
+        Write (txid, step, msg) entries to primary, failing over to
+        secondary, return the rc of each entry
+        """
+        if self.primary is None:
+            rcs = [1] * len(entries)
+        elif hasattr(self.primary, 'write_batch'):
+            rcs = self.primary.write_batch(entries)
+        else:
+            rcs = [self.primary.write(*entry) for entry in entries]
+        if self.secondary is not None:
+            rcs = [
+                rc if rc == 0 else self.secondary.write(*entry)
+                for (rc, entry) in zip(rcs, entries)
+            ]
+        return rcs
+
+    def _write(self, txid, step, msg):
         """
         Write journal to primary or secondary
         """
@@ -69,10 +201,25 @@ class Journal():
             rc = self.secondary.write(txid, step, msg)
         return rc
 
+    def export(self, since=None, until=None, sincetime=None, untiltime=None):
+        """
+        Rows of the primary journal history,
+        None if the primary journal keeps no history
+        """
+        if self.primary is None or not hasattr(self.primary, 'export'):
+            return None
+        return self.primary.export(since, until, sincetime, untiltime)
+
     def status(self, txid):
         """
         Get status from primary or secondary
         """
+        # Entries not flushed from the spool yet
+        spooled = None
+        if self.spool is not None:
+            (resp, spooled) = self.spool.status(txid)
+            if spooled == http.client.OK:
+                return (resp, spooled)
         # Primary journaling
         code = None
         if self.primary is not None:
@@ -81,6 +228,8 @@ class Journal():
         # We are here because 'primary' failed
         if code is None and self.secondary is not None:
             (resp, code) = self.secondary.status(txid)
+        if code is None and spooled is not None:
+            code = spooled
         if code is None:
             _LOG.error('task %r not found', txid)
             actual_data = 'Task not found'
@@ -1,58 +1,381 @@
 """
 Module for NFS journal
+
+Journal files are kept in the NFS directory, or spread over hashed
+subdirectories when the directory has a layout file giving the number
+of shards.
+
+With fsync durability each file is synced before its rename. With
+group durability concurrent writers hand their files to a committer
+thread which syncs each of them, renames them and syncs each
+directory once per batch. A file failing to sync fails its write.
+
+Status misses can be cached for a few seconds, and a listing of the
+journal files refreshed in the background can answer misses without
+going to NFS. Files written by other processes are seen once the miss
+expires or the next listing is done.
 """
 
+import collections
 import errno
 import http.client
 import json
 import os
 import logging
 import tempfile
+import threading
+import time
+import zlib
 from journal import basejournal
 
 _LOG = logging.getLogger(__name__)
 
+LAYOUT_FILE = '.layout'
+MAX_SHARDS = 256
+
+DURABILITY = ('none', 'fsync', 'group')
+GROUP_WINDOW = 0.005
+
+NEGATIVE_CACHE_SIZE = 100000
+STEPS = ('commit', 'abort', 'begin')
+
+
+def _layout_data(nfspath):
+    try:
+        with open(os.path.join(nfspath, LAYOUT_FILE), 'r') as fin:
+            return json.load(fin)
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            raise
+    return {}
+
+
+def read_layout(nfspath):
+    """
+    Number of shards of an NFS journal directory, 0 if flat
+    """
+    return int(_layout_data(nfspath).get('shards', 0))
+
+
+def previous_layout(nfspath):
+    """
+    Number of shards of the layout an NFS journal directory was
+    migrated from, None once its files are all migrated
+    """
+    previous = _layout_data(nfspath).get('previous')
+    return None if previous is None else int(previous)
+
+
+def write_layout(nfspath, shards, previous=None):
+    """
+    Set the number of shards of an NFS journal directory,
+    creating the shard subdirectories. previous is the number of
+    shards of the layout servers not restarted yet still write to.
+    """
+    if not 0 <= shards <= MAX_SHARDS:
+        raise ValueError('Number of shards must be 0 to {0}'.format(
+            MAX_SHARDS))
+    for shard in range(shards):
+        os.makedirs(os.path.join(nfspath, '{0:02x}'.format(shard)),
+                    exist_ok=True)
+    layout = {'shards': shards}
+    if previous is not None and previous != shards:
+        layout['previous'] = previous
+    with tempfile.NamedTemporaryFile(
+            suffix='-XXXXX.tmp',
+            dir=nfspath,
+            delete=False, mode='w'
+    ) as outfile:
+        json.dump(layout, outfile)
+    os.rename(outfile.name, os.path.join(nfspath, LAYOUT_FILE))
+
+
+def shard_path(nfspath, shards, txid):
+    """
+    Directory holding the journal files of txid
+    """
+    if not shards:
+        return nfspath
+    shard = zlib.crc32(txid.encode()) % shards
+    return os.path.join(nfspath, '{0:02x}'.format(shard))
+
+
+def journal_dirs(nfspath):
+    """
+    Directories of an NFS journal, the top one and any shard
+    """
+    yield nfspath
+    with os.scandir(nfspath) as entries:
+        for entry in entries:
+            if (len(entry.name) == 2 and
+                    all(c in '0123456789abcdef' for c in entry.name) and
+                    entry.is_dir()):
+                yield entry.path
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_files(tmpfiles):
+    """
+    Flush written files to stable storage, return those which failed
+    """
+    failed = set()
+    for tmpfile in tmpfiles:
+        try:
+            _fsync_path(tmpfile)
+        except OSError:
+            _LOG.exception('Error syncing nfs journal file %s', tmpfile)
+            failed.add(tmpfile)
+    return failed
+
+
+class GroupCommitter():
+    """
+    Sync and rename the journal files of concurrent writers in batches
+    """
+    def __init__(self, nfspath, window=None):
+        self.nfspath = nfspath
+        self.window = GROUP_WINDOW if window is None else window
+        self.cond = threading.Condition()
+        self.pending = []
+        self.thread = None
+
+    def commit(self, tmpfile, journal_file):
+        """
+        Queue a written temp file and wait until it is durably
+        renamed to journal_file, return 0 on success
+        """
+        entry = {'tmpfile': tmpfile, 'target': journal_file,
+                 'done': threading.Event(), 'rc': 1}
+        with self.cond:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run,
+                                               name='nfs-group-commit',
+                                               daemon=True)
+                self.thread.start()
+            self.pending.append(entry)
+            self.cond.notify()
+        entry['done'].wait()
+        return entry['rc']
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # Let the writers of the window join the batch
+            time.sleep(self.window)
+            with self.cond:
+                (batch, self.pending) = (self.pending, [])
+            try:
+                self._commit_batch(batch)
+            finally:
+                for entry in batch:
+                    entry['done'].set()
+
+    def _commit_batch(self, batch):
+        failed = _sync_files([entry['tmpfile'] for entry in batch])
+        renamed = []
+        for entry in batch:
+            if entry['tmpfile'] in failed:
+                _remove_quietly(entry['tmpfile'])
+                continue
+            try:
+                os.rename(entry['tmpfile'], entry['target'])
+            except OSError:
+                _LOG.exception('Error renaming nfs journal file %s',
+                               entry['target'])
+                _remove_quietly(entry['tmpfile'])
+                continue
+            renamed.append(entry)
+        synced = set()
+        for journal_dir in {os.path.dirname(entry['target'])
+                            for entry in renamed}:
+            try:
+                _fsync_path(journal_dir)
+                synced.add(journal_dir)
+            except OSError:
+                _LOG.exception('Error syncing nfs journal directory %s',
+                               journal_dir)
+        for entry in renamed:
+            if os.path.dirname(entry['target']) in synced:
+                entry['rc'] = 0
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 
 class NFSJournal(basejournal.BaseJournal):
     """
     Class defining nfs journal
     """
-    def __init__(self, opt):
+    def __init__(self, opt, durability=None, groupwindow=None,
+                 negativettl=None, listinterval=None):
         """
         constructor for nfs journal
         """
         self.nfspath = opt
+        self.shards = read_layout(opt)
+        self.previous = previous_layout(opt)
+        self.durability = durability or 'none'
+        if self.durability not in DURABILITY:
+            raise ValueError('Unknown durability {0}'.format(durability))
+        self.committer = None
+        if self.durability == 'group':
+            self.committer = GroupCommitter(opt, groupwindow)
+        self.negativettl = negativettl or 0
+        # txid -> expiry of the cached miss
+        self.negative = collections.OrderedDict()
+        self.negativelock = threading.Lock()
+        self.listinterval = listinterval or 0
+        self.listing = None
+        self.listed = 0
+        self.written = set()
+        self.listlock = threading.Lock()
+        self.lister = None
 
     def write(self, txid, step, msg):
         """
         Function to write journal to NFS
         """
         filename = '{0}_{1}'.format(txid, step)
+        with self.negativelock:
+            self.negative.pop(txid, None)
+        with self.listlock:
+            self.written.add(filename)
+            if self.listing is not None:
+                self.listing.add(filename)
         rc = 0
-        journal_file = os.path.join(self.nfspath, filename)
+        journal_dir = shard_path(self.nfspath, self.shards, txid)
+        journal_file = os.path.join(journal_dir, filename)
+        outfile = None
         try:
             with tempfile.NamedTemporaryFile(
                     suffix='-XXXXX.tmp',
-                    dir=self.nfspath,
+                    dir=journal_dir,
                     delete=False, mode='w'
             ) as outfile:
                 json.dump(msg, outfile)
+                if self.durability == 'fsync':
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
         except (IOError, OSError):
             _LOG.exception('Error writing to nfs primary journal')
+            if outfile is not None:
+                _remove_quietly(outfile.name)
             rc = 1
         else:
+            if self.committer is not None:
+                return self.committer.commit(outfile.name, journal_file)
             os.rename(outfile.name, journal_file)
+            if self.durability == 'fsync':
+                try:
+                    _fsync_path(journal_dir)
+                except OSError:
+                    _LOG.exception('Error syncing nfs journal directory')
+                    rc = 1
         return rc
 
     def status(self, txid):
         """
         Function to get status of a txid
         """
-        commitnode = os.path.join(self.nfspath,
+        if self._known_missing(txid):
+            return (None, None)
+        (resp, code) = self._read_status(txid)
+        if code is None and self.negativettl:
+            with self.negativelock:
+                self.negative[txid] = time.monotonic() + self.negativettl
+                if len(self.negative) > NEGATIVE_CACHE_SIZE:
+                    self.negative.popitem(last=False)
+        return (resp, code)
+
+    def _known_missing(self, txid):
+        """
+        Whether a txid is known to have no journal file without
+        looking at NFS
+        """
+        now = time.monotonic()
+        with self.negativelock:
+            expiry = self.negative.get(txid)
+            if expiry is not None:
+                if expiry > now:
+                    return True
+                self.negative.pop(txid, None)
+        listing = self._current_listing(now)
+        if listing is None:
+            return False
+        return not any('{0}_{1}'.format(txid, step) in listing
+                       for step in STEPS)
+
+    def _current_listing(self, now):
+        if not self.listinterval:
+            return None
+        if self.lister is None or not self.lister.is_alive():
+            self.lister = threading.Thread(target=self._list_files,
+                                           name='nfs-list', daemon=True)
+            self.lister.start()
+        if now - self.listed > 2 * self.listinterval:
+            # Not listed yet, or listing is stuck
+            return None
+        return self.listing
+
+    def _list_files(self):
+        """
+        Refresh the listing of journal files every listinterval
+        """
+        while True:
+            start = time.monotonic()
+            self._list_once()
+            time.sleep(max(0, self.listinterval -
+                           (time.monotonic() - start)))
+
+    def _list_once(self):
+        """
+        List the journal files once
+        """
+        start = time.monotonic()
+        with self.listlock:
+            self.written = set()
+        try:
+            names = set()
+            for journal_dir in journal_dirs(self.nfspath):
+                with os.scandir(journal_dir) as entries:
+                    names.update(entry.name for entry in entries)
+        except OSError:
+            _LOG.exception('Error listing nfs journal')
+        else:
+            with self.listlock:
+                # Keep what was written during the listing
+                names.update(self.written)
+                (self.listing, self.listed) = (names, start)
+
+    def _read_status(self, txid):
+        journal_dir = shard_path(self.nfspath, self.shards, txid)
+        (resp, code) = self._read_dir_status(journal_dir, txid)
+        if code is None and self.previous is not None:
+            # Written by a server started before the migration
+            legacy_dir = shard_path(self.nfspath, self.previous, txid)
+            if legacy_dir != journal_dir:
+                (resp, code) = self._read_dir_status(legacy_dir, txid)
+        return (resp, code)
+
+    def _read_dir_status(self, journal_dir, txid):
+        commitnode = os.path.join(journal_dir,
                                   '{0}_{1}'.format(txid, 'commit'))
-        abortnode = os.path.join(self.nfspath,
+        abortnode = os.path.join(journal_dir,
                                  '{0}_{1}'.format(txid, 'abort'))
-        beginnode = os.path.join(self.nfspath,
+        beginnode = os.path.join(journal_dir,
                                  '{0}_{1}'.format(txid, 'begin'))
         try:
             with open(commitnode, 'r') as fin:
@@ -77,3 +400,48 @@ class NFSJournal(basejournal.BaseJournal):
             return (final_resp, http.client.PROCESSING)
         else:
             return (None, None)
+
+
+def migrate(nfspath, shards):
+    """
+    Move the journal files of an NFS journal to the layout with
+    the given number of shards, 0 to go back to a flat directory.
+    Writers read the layout when they start: migrate again once the
+    journal servers are restarted to move the files they wrote since.
+    """
+    dirs = list(journal_dirs(nfspath))
+    # Once run again after the restart, all files are migrated
+    write_layout(nfspath, shards, read_layout(nfspath))
+    moved = 0
+    for journal_dir in dirs:
+        with os.scandir(journal_dir) as entries:
+            for entry in entries:
+                if (entry.name.startswith('.') or
+                        entry.name.endswith('.tmp') or
+                        '_' not in entry.name or
+                        not entry.is_file()):
+                    continue
+                txid = entry.name.split('_')[0]
+                target = shard_path(nfspath, shards, txid)
+                if target != journal_dir:
+                    os.rename(entry.path, os.path.join(target, entry.name))
+                    moved += 1
+    if not shards:
+        for journal_dir in dirs[1:]:
+            try:
+                os.rmdir(journal_dir)
+            except OSError:
+                _LOG.warning('Shard directory %s not empty', journal_dir)
+    return moved
+
+
+__all__ = (
+    'GroupCommitter',
+    'NFSJournal',
+    'journal_dirs',
+    'migrate',
+    'previous_layout',
+    'read_layout',
+    'shard_path',
+    'write_layout',
+)
@@ -0,0 +1,175 @@
+"""
+Binary encoding of journal records
+
+A journal message is stored either as json or as a binary record:
+a magic, a bitmap of the known fields present and a bitmap of the
+ones set to None, then the other known fields, the free-form payload
+as json and any unknown keys as json, separated by a control character
+json never leaves unescaped. Messages with values that don't fit the
+schema are kept as json.
+
+Snapshot rows, in SQLITE_INSERT column order, are stored as length
+prefixed strings.
+"""
+import json
+import struct
+
+MESSAGE_MAGIC = b'\x00\x01'
+ROWS_MAGIC = b'\x00\x02'
+
+FIELDS = ('host', 'authuser_id', 'user_id', 'date',
+          'request_id', 'transaction_id', 'step', 'role',
+          'resourcegroup', 'resource', 'verb', 'resourcepk', 'cm')
+KNOWN = frozenset(FIELDS + ('payload',))
+
+ROW_SIZE = len(FIELDS) + 1
+
+_HEADER = struct.Struct('!2sHH')
+_SEP = '\x1f'
+_U32 = struct.Struct('!I')
+_NONE32 = 0xffffffff
+
+# (present, nulls) bitmaps -> (keys of the values, dict of None keys)
+_LAYOUTS = {}
+
+
+def _layout(present, nulls):
+    layout = _LAYOUTS.get((present, nulls))
+    if layout is None:
+        keys = tuple(key for (i, key) in enumerate(FIELDS)
+                     if present & (1 << i) and not nulls & (1 << i))
+        nonekeys = dict.fromkeys(key for (i, key) in enumerate(FIELDS)
+                                 if nulls & (1 << i))
+        layout = (keys, nonekeys)
+        _LAYOUTS[(present, nulls)] = layout
+    return layout
+
+
+def encode(msg, binary=True):
+    """
+    Encode a journal message
+    """
+    if not binary:
+        return json.dumps(msg).encode()
+    present = 0
+    nulls = 0
+    bit = 1
+    values = []
+    for key in FIELDS:
+        if key in msg:
+            present |= bit
+            value = msg[key]
+            if value is None:
+                nulls |= bit
+            elif isinstance(value, str) and _SEP not in value:
+                values.append(value)
+            else:
+                return json.dumps(msg).encode()
+        bit <<= 1
+    known = bin(present).count('1')
+    if 'payload' in msg:
+        known += 1
+        values.append(json.dumps(msg['payload']))
+    else:
+        values.append('')
+    if len(msg) > known:
+        values.append(json.dumps(
+            {key: msg[key] for key in msg if key not in KNOWN}))
+    header = _HEADER.pack(MESSAGE_MAGIC, present, nulls)
+    return header + _SEP.join(values).encode()
+
+
+def _fields(data):
+    """
+    Read the fields of a binary record:
+    (known fields, payload json, extras json)
+    """
+    (magic, present, nulls) = _HEADER.unpack_from(data)
+    if magic != MESSAGE_MAGIC:
+        raise ValueError('Unknown journal record format')
+    (keys, nonekeys) = _layout(present, nulls)
+    values = data[_HEADER.size:].decode().split(_SEP)
+    fields = dict(zip(keys, values))
+    fields.update(nonekeys)
+    payload = values[len(keys)] or None
+    extras = None
+    if len(values) > len(keys) + 1:
+        extras = values[len(keys) + 1]
+    return (fields, payload, extras)
+
+
+def decode(data):
+    """
+    Decode a json or binary journal message
+    """
+    if data[:1] != b'\x00':
+        return json.loads(data.decode())
+    (msg, payload, extras) = _fields(data)
+    if payload is not None:
+        msg['payload'] = json.loads(payload)
+    if extras is not None:
+        msg.update(json.loads(extras))
+    return msg
+
+
+def to_row(data):
+    """
+    Snapshot row of a json or binary journal message,
+    the payload is kept as json text
+    """
+    if data[:1] != b'\x00':
+        msg = json.loads(data.decode())
+        payload = json.dumps(msg.get('payload'))
+    else:
+        (msg, payload, _) = _fields(data)
+        if payload is None:
+            payload = 'null'
+    row = [msg.get(key) for key in FIELDS]
+    row.insert(len(FIELDS) - 1, payload)
+    return tuple(row)
+
+
+def encode_rows(rows):
+    """
+    Encode snapshot rows, None if a value is not a string
+    """
+    parts = [ROWS_MAGIC]
+    for row in rows:
+        for value in row:
+            if value is None:
+                parts.append(_U32.pack(_NONE32))
+                continue
+            if not isinstance(value, str):
+                return None
+            raw = value.encode()
+            parts.append(_U32.pack(len(raw)))
+            parts.append(raw)
+    return b''.join(parts)
+
+
+def decode_rows(data):
+    """
+    Decode snapshot rows
+    """
+    offset = len(ROWS_MAGIC)
+    end = len(data)
+    while offset < end:
+        row = []
+        for _ in range(ROW_SIZE):
+            (length,) = _U32.unpack_from(data, offset)
+            offset += 4
+            if length == _NONE32:
+                row.append(None)
+                continue
+            row.append(data[offset:offset + length].decode())
+            offset += length
+        yield tuple(row)
+
+
+__all__ = (
+    'decode',
+    'decode_rows',
+    'encode',
+    'encode_rows',
+    'to_row',
+)
@@ -3,7 +3,10 @@ Main module to resync journal in NFS
 to zookeeper
 """
 
+import concurrent.futures
+import contextlib
 import os
+import threading
 import time
 import logging
 import fcntl
@@ -12,37 +15,131 @@ import json
 import sys
 import yaml
 import kazoo.exceptions
+from journal import inotify
+from journal import metrics
+from journal import nfsjournal
+from journal import segjournal
+from journal import shardjournal
 from journal import zkjournal
 
 _LOG = logging.getLogger(__name__)
 
 
-def resync_with_nfs(zkclient, nfs_path):
+RESYNC_BATCHSIZE = 500
+
+# Resync runs on zk reconnection and new journal files, this
+# poll only catches what those miss (e.g. files from other NFS hosts)
+RESYNC_POLL_INTERVAL = 60
+RECONNECT_INTERVAL = 60
+
+
+class _ResyncStats():
+    """
+    Drain rate and backlog of a resync pass
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.seen = 0
+        self.drained = 0
+        self.published = 0
+
+    def publish(self, done=False):
+        """
+        Publish the pass metrics, the backlog is only known once done
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        metrics.gauge('resync_drain_rate', self.drained / elapsed)
+        if done:
+            metrics.gauge('resync_backlog', self.seen - self.drained)
+        metrics.incr('resync_drained', self.drained - self.published)
+        self.published = self.drained
+        metrics.publish()
+
+
+def _read_journal_file(path):
+    """
+    (txid, step, msg) of a journal file, None if it can't be read
+    """
+    try:
+        (txid, step) = os.path.basename(path).split('_')
+        with open(path, 'r') as fin:
+            return (txid, step, json.load(fin))
+    except (IOError, OSError, ValueError):
+        _LOG.exception("""Error with data in
+                       journal entry file %s""", path)
+        return None
+
+
+def _journal_files(journal_dir):
+    """
+    Stream the journal files of a directory
+    """
+    with os.scandir(journal_dir) as entries:
+        for entry in entries:
+            if (entry.name.startswith('.') or
+                    entry.name.endswith('.tmp') or
+                    not entry.is_file()):
+                # lock, layout, temp files and shard directories
+                continue
+            yield entry.path
+
+
+def _resync_files(zkclient, paths, pool, concurrency, stats):
+    """
+    Read journal files in parallel, write them in one batch and
+    remove the ones committed
+    """
+    stats.seen += len(paths)
+    batch = [
+        (path, entry)
+        for (path, entry) in zip(paths, pool.map(_read_journal_file, paths))
+        if entry is not None
+    ]
+    rcs = zkclient.write_batch([entry for (_, entry) in batch], concurrency)
+    for ((path, _), rc) in zip(batch, rcs):
+        if rc == 0:
+            os.remove(path)
+            stats.drained += 1
+
+
+def resync_dir(zkclient, journal_dir, batchsize=None, concurrency=None,
+               pool=None, stats=None):
+    """
+    Resync the journal files of one directory
+    """
+    batchsize = batchsize or RESYNC_BATCHSIZE
+    concurrency = concurrency or zkjournal.WRITE_CONCURRENCY
+    stats = stats or _ResyncStats()
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(concurrency))
+        paths = []
+        for path in _journal_files(journal_dir):
+            paths.append(path)
+            if len(paths) >= batchsize:
+                _resync_files(zkclient, paths, pool, concurrency, stats)
+                stats.publish()
+                paths = []
+        if paths:
+            _resync_files(zkclient, paths, pool, concurrency, stats)
+
+
+def resync_with_nfs(zkclient, nfs_path, batchsize=None, concurrency=None):
     """
     Main function responsible for resync
     """
     lockfile = os.path.join(nfs_path, '.lock')
+    concurrency = concurrency or zkjournal.WRITE_CONCURRENCY
+    stats = _ResyncStats()
     with open(lockfile, 'w') as f:
         try:
             fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            for journalfile in os.listdir(nfs_path):
-                if not journalfile.startswith('.'):
-                    jfile = os.path.join(nfs_path, journalfile)
-                    try:
-                        if os.path.isfile(jfile) is True:
-                            txid, step = journalfile.split('_')
-                            with open(jfile, 'r') as fin:
-                                msg = json.load(fin)
-                    except IOError:
-                        _LOG.exception("""Error with data in
-                                       journal entry file %s""", jfile)
-                        continue
-                    else:
-                        rc = zkclient.write(txid, step, msg)
-                        if rc == 1:
-                            continue
-                        else:
-                            os.remove(jfile)
+            with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+                for journal_dir in nfsjournal.journal_dirs(nfs_path):
+                    resync_dir(zkclient, journal_dir, batchsize,
+                               concurrency, pool, stats)
+            stats.publish(done=True)
         except IOError as err:
             if err.errno == errno.EAGAIN:
                 # this is a lock fail, just skip
@@ -54,12 +151,61 @@ def resync_with_nfs(zkclient, nfs_path):
                 return
 
 
-def main(adminuser=None, cfg=None, primary=None, secondary=None):
+def resync_with_segments(zkclient, segments, batchsize=None,
+                         concurrency=None):
+    """
+    Resync live segment log records, then compact the segments
+    """
+    lockfile = os.path.join(segments.path, '.lock')
+    batchsize = batchsize or RESYNC_BATCHSIZE
+    stats = _ResyncStats()
+    with open(lockfile, 'w') as f:
+        try:
+            fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno != errno.EAGAIN:
+                _LOG.exception('Exception while trying to lockfile: %s',
+                               lockfile)
+            return
+        batch = []
+        for entry in segments.replay():
+            batch.append(entry)
+            if len(batch) >= batchsize:
+                _resync_records(zkclient, segments, batch, concurrency,
+                                stats)
+                stats.publish()
+                batch = []
+        _resync_records(zkclient, segments, batch, concurrency, stats)
+        stats.publish(done=True)
+        segments.compact()
+
+
+def _resync_records(zkclient, segments, batch, concurrency, stats):
+    stats.seen += len(batch)
+    if not batch:
+        return
+    rcs = zkclient.write_batch(batch, concurrency)
+    drained = [
+        (txid, step)
+        for ((txid, step, _), rc) in zip(batch, rcs)
+        if rc == 0
+    ]
+    segments.drain(drained)
+    stats.drained += len(drained)
+
+
+def main(adminuser=None, cfg=None, primary=None, secondary=None,
+         codec=None, codecdict=None, encoding=None,
+         batchsize=None, concurrency=None, metricsfile=None,
+         pollinterval=None, blobpath=None, blobthreshold=None,
+         containers=False):
     """
     Based on command line arguments, resync nfs to zookeeper.
-    Resync happens every minute.
+    Resync happens on zookeeper reconnection, on new journal files
+    and every pollinterval seconds, in pipelined batches.
     """
     _LOG.info('current parent process id %d', os.getpid())
+    metrics.configure(metricsfile)
     kwargs = dict()
     journal_nfspath = None
     if cfg:
@@ -73,33 +219,116 @@ def main(adminuser=None, cfg=None, primary=None, secondary=None):
             kwargs = jconf
     if primary is None:
         sys.exit("Missing primary journal")
-    if 'zookeeper' not in primary:
+    try:
+        urls = shardjournal.shard_urls(primary)
+    except ValueError as err:
+        sys.exit(str(err))
+    if not all('zookeeper' in url for url in urls):
         sys.exit("Wrong zookeeper information")
     (jmodule, jval) = secondary.split('://')
     str(jmodule).lower()
     if 'nfs' in jmodule:
         journal_nfspath = jval
+    if jmodule == 'segment':
+        journal_nfspath = segjournal.SegmentJournal(jval)
     if journal_nfspath and primary:
-        start_resync(primary, kwargs, journal_nfspath, adminuser)
+        start_resync(primary, kwargs, journal_nfspath, adminuser,
+                     codec, codecdict, encoding, batchsize, concurrency,
+                     pollinterval, blobpath, blobthreshold, containers)
     else:
         sys.exit('Error in Journal config')
 
 
-def start_resync(zkurl, kwargs, journal_nfspath, adminuser=None):
+def _is_journal_change(name):
+    """
+    Whether a changed name is a journal file or segment
+    """
+    return (not name.startswith('.') and not name.endswith('.tmp') and
+            ('_' in name or segjournal.SEGMENT_REGEX.match(name)))
+
+
+def _watch_journal(journal_nfspath, zkj, wakeup):
     """
-    Start resync with nfs
+    Wake resync up when journal files are written, while zk is up
     """
-    zkj = zkjournal.ZookeeperJournal(zkurl, kwargs, adminuser)
+    segments = isinstance(journal_nfspath, segjournal.SegmentJournal)
+    if segments:
+        # Writers keep segments open: appends only show as IN_MODIFY
+        dirs = [journal_nfspath.path]
+        mask = inotify.IN_MODIFY | inotify.IN_MOVED_TO
+    else:
+        dirs = list(nfsjournal.journal_dirs(journal_nfspath))
+        mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+    try:
+        watcher = inotify.Watcher(dirs, mask)
+    except OSError as err:
+        _LOG.info('Not watching journal files, polling only - %s', err)
+        return
     while True:
+        names = watcher.read()
+        if not _connected(zkj) or not any(map(_is_journal_change, names)):
+            continue
+        # Not for the tombstones appended by resync itself
+        if not segments or journal_nfspath.appended_elsewhere():
+            wakeup.set()
+
+
+def _connected(zkj):
+    """
+    Whether the journal, or any of its shards, is connected.
+    Entries of shards down are left for the next pass.
+    """
+    if isinstance(zkj, shardjournal.ShardedJournal):
+        return any(shard.zk.connected for shard in zkj.shards)
+    return zkj.zk.connected
+
+
+def start_resync(zkurl, kwargs, journal_nfspath, adminuser=None,
+                 codec=None, codecdict=None, encoding=None,
+                 batchsize=None, concurrency=None, pollinterval=None,
+                 blobpath=None, blobthreshold=None, containers=False):
+    """
+    Start resync with nfs. Resync runs when zookeeper (re)connects,
+    when journal files are written and every pollinterval seconds.
+    """
+    pollinterval = pollinterval or RESYNC_POLL_INTERVAL
+    wakeup = threading.Event()
+    shards = {
+        name: zkjournal.ZookeeperJournal(url, kwargs, adminuser,
+                                         codec=codec, codecdict=codecdict,
+                                         encoding=encoding, blobpath=blobpath,
+                                         blobthreshold=blobthreshold,
+                                         containers=containers)
+        for (name, url) in shardjournal.shards(zkurl)
+    }
+    if len(shards) > 1:
+        # Entries are routed to their shard by the sharded write_batch
+        zkj = shardjournal.ShardedJournal(shards)
+    else:
+        (zkj,) = shards.values()
+    zkj.add_connect_callback(wakeup.set)
+    if inotify.available():
+        threading.Thread(target=_watch_journal,
+                         args=(journal_nfspath, zkj, wakeup),
+                         name='resync-watch', daemon=True).start()
+    while True:
+        wakeup.clear()
         try:
-            if zkj.zk.connected:
-                resync_with_nfs(zkj, journal_nfspath)
-            else:
+            if not _connected(zkj):
                 zkj.journal_zk_start()
+            elif isinstance(journal_nfspath, segjournal.SegmentJournal):
+                resync_with_segments(zkj, journal_nfspath, batchsize,
+                                     concurrency)
+            else:
+                resync_with_nfs(zkj, journal_nfspath, batchsize,
+                                concurrency)
         except kazoo.exceptions.SessionExpiredError as err:
             _LOG.exception('Error - %s', err)
         except kazoo.exceptions.KazooException as err:
             _LOG.exception('Error - %s', err)
         except kazoo.handlers.threading.KazooTimeoutError as err:
             _LOG.exception('Error - %s', err)
-        time.sleep(60)
+        if _connected(zkj):
+            wakeup.wait(pollinterval)
+        else:
+            wakeup.wait(RECONNECT_INTERVAL)
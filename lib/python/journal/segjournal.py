@@ -0,0 +1,401 @@
+"""
+Module for segment log journal
+
+Journal entries are appended as framed records to rolling segment
+files instead of a file per step. Each process keeps an in-memory
+index of txid -> step -> record location, built by scanning the
+segments and refreshed from their tail, so status is a single read.
+Resynced entries are marked drained with a tombstone record and
+compaction drops the oldest segments once they are drained.
+"""
+
+import contextlib
+import fcntl
+import http.client
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+from journal import basejournal
+
+_LOG = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_REGEX = re.compile(r'^seg-(\d{10})\.log$')
+LOCKFILE = '.seglock'
+
+# magic, body length, body crc32
+FRAME = struct.Struct('!4sII')
+FRAME_MAGIC = b'JSEG'
+
+# Compaction copies the live records of the oldest segment forward
+# when they take less than this fraction of the segment
+COMPACT_RATIO = 0.25
+
+
+def _segment_name(number):
+    return 'seg-{0:010d}.log'.format(number)
+
+
+def _frame(body):
+    return FRAME.pack(FRAME_MAGIC, len(body),
+                      zlib.crc32(body) & 0xffffffff) + body
+
+
+def _read_frames(data, offset=0):
+    """
+    Read complete frames from data, skipping damaged ones.
+    Yield (offset, body), return at the first incomplete frame.
+    """
+    while True:
+        body = _frame_at(data, offset)
+        if body is not None:
+            yield (offset, body)
+            offset += FRAME.size + len(body)
+            continue
+        # Incomplete tail, or damaged by a writer that died mid-write
+        # if a valid frame follows
+        nxt = data.find(FRAME_MAGIC, offset + 1)
+        while nxt != -1 and _frame_at(data, nxt) is None:
+            nxt = data.find(FRAME_MAGIC, nxt + 1)
+        if nxt == -1:
+            return
+        _LOG.error('Damaged segment record at %d', offset)
+        offset = nxt
+
+
+def _frame_at(data, offset):
+    """
+    Body of the valid frame at offset, None if there is none
+    """
+    if offset + FRAME.size > len(data):
+        return None
+    (magic, length, crc) = FRAME.unpack_from(data, offset)
+    body = data[offset + FRAME.size:offset + FRAME.size + length]
+    if (magic != FRAME_MAGIC or len(body) != length or
+            zlib.crc32(body) & 0xffffffff != crc):
+        return None
+    return body
+
+
+class SegmentJournal(basejournal.BaseJournal):
+    """
+    Class defining segment log journal
+    """
+    def __init__(self, opt, segmentsize=None):
+        """
+        constructor for segment log journal
+        """
+        self.path = opt
+        self.segmentsize = segmentsize or SEGMENT_SIZE
+        # txid -> {step: (segment, offset, length)}
+        self.index = {}
+        # segment -> offset scanned up to
+        self.scanned = {}
+        self.sealed = set()
+        self.active = None
+        self.active_file = None
+        self.readers = {}
+        self.lock = threading.RLock()
+        self.lockfile = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Exclusive access to the segments across threads and processes
+        """
+        with self.lock:
+            if self.lockfile is None:
+                self.lockfile = open(os.path.join(self.path, LOCKFILE), 'a')
+            fcntl.lockf(self.lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.lockfile.fileno(), fcntl.LOCK_UN)
+
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            result = SEGMENT_REGEX.match(name)
+            if result:
+                numbers.append(int(result.groups()[0]))
+        return sorted(numbers)
+
+    def _active_segment(self):
+        """
+        Open file and size of the segment to append to, rotating full
+        segments. Called with the lock held.
+        """
+        if self.active is None:
+            numbers = self._segments()
+            self._open_active(numbers[-1] if numbers else 0)
+        size = os.fstat(self.active_file.fileno()).st_size
+        # Segments are only rotated once full, so a segment not full
+        # is still the newest: one fstat per append, no listing
+        while size >= self.segmentsize:
+            # Rotated already by another process, or rotate it here
+            self._open_active(self.active + 1)
+            size = os.fstat(self.active_file.fileno()).st_size
+        return (self.active_file, size)
+
+    def _close_active(self):
+        if self.active_file is not None:
+            try:
+                self.active_file.close()
+            except (IOError, OSError):
+                pass
+        self.active_file = None
+        self.active = None
+
+    def _open_active(self, number):
+        self._close_active()
+        with contextlib.ExitStack() as stack:
+            active_file = stack.enter_context(
+                open(os.path.join(self.path, _segment_name(number)), 'ab'))
+            # Closed by _close_active from now on
+            (self.active_file, self.active) = (active_file, number)
+            stack.pop_all()
+
+    def _append(self, records):
+        """
+        Append (txid, step, body) records, return their locations
+        """
+        with self._locked():
+            try:
+                (fout, offset) = self._active_segment()
+                locations = []
+                frames = []
+                for (txid, step, body) in records:
+                    frame = _frame(body)
+                    locations.append((txid, step,
+                                      (self.active, offset, len(frame))))
+                    frames.append(frame)
+                    offset += len(frame)
+                fout.write(b''.join(frames))
+                fout.flush()
+                if self.scanned.get(self.active) == locations[0][2][1]:
+                    # Indexed by the caller, no need to scan them back
+                    self.scanned[self.active] = offset
+            except (IOError, OSError):
+                # Look the active segment up again on the next append
+                self._close_active()
+                raise
+        return locations
+
+    def write(self, txid, step, msg):
+        """
+        Function to append journal to a segment
+        """
+        body = json.dumps([txid, step, msg]).encode()
+        try:
+            locations = self._append([(txid, step, body)])
+        except (IOError, OSError):
+            _LOG.exception('Error writing to segment journal')
+            return 1
+        with self.lock:
+            for (txid_, step_, location) in locations:
+                self.index.setdefault(txid_, {})[step_] = location
+        return 0
+
+    def drain(self, entries):
+        """
+        Mark (txid, step) entries resynced
+        """
+        records = [
+            (txid, step, json.dumps([txid, step]).encode())
+            for (txid, step) in entries
+        ]
+        if not records:
+            return
+        self._append(records)
+        with self.lock:
+            for (txid, step) in entries:
+                self._unindex(txid, step)
+
+    def _unindex(self, txid, step):
+        steps = self.index.get(txid)
+        if steps is not None:
+            steps.pop(step, None)
+            if not steps:
+                del self.index[txid]
+
+    def _refresh(self):
+        """
+        Index records appended since the last scan
+        """
+        with self.lock:
+            newest = max(self.scanned) if self.scanned else None
+            if newest is not None and not os.path.exists(os.path.join(
+                    self.path, _segment_name(newest + 1))):
+                # No rotation since the last scan, only read the tail
+                self._scan_segment(newest)
+                return
+            numbers = self._segments()
+            for number in set(self.scanned) - set(numbers):
+                self._forget_segment(number)
+            for number in numbers:
+                if number in self.sealed:
+                    continue
+                self._scan_segment(number)
+                if number != numbers[-1]:
+                    # Writers only append to the newest segment
+                    self.sealed.add(number)
+
+    def appended_elsewhere(self):
+        """
+        Whether records were appended past the last scan, so not by
+        this process
+        """
+        with self.lock:
+            if not self.scanned:
+                return True
+            newest = max(self.scanned)
+            try:
+                size = os.stat(os.path.join(
+                    self.path, _segment_name(newest))).st_size
+            except OSError:
+                return True
+            return size > self.scanned[newest] or os.path.exists(
+                os.path.join(self.path, _segment_name(newest + 1)))
+
+    def _scan_segment(self, number):
+        start = self.scanned.get(number, 0)
+        try:
+            with open(os.path.join(self.path, _segment_name(number)),
+                      'rb') as fin:
+                fin.seek(start)
+                data = fin.read()
+        except (IOError, OSError):
+            _LOG.exception('Error reading segment %d', number)
+            return
+        end = 0
+        for (offset, body) in _read_frames(data):
+            record = json.loads(body.decode())
+            end = offset + FRAME.size + len(body)
+            if len(record) == 2:
+                self._unindex(record[0], record[1])
+                continue
+            location = (number, start + offset, FRAME.size + len(body))
+            self.index.setdefault(record[0], {})[record[1]] = location
+        self.scanned[number] = start + end
+
+    def _forget_segment(self, number):
+        for txid in list(self.index):
+            for (step, location) in list(self.index[txid].items()):
+                if location[0] == number:
+                    self._unindex(txid, step)
+        self.scanned.pop(number, None)
+        self.sealed.discard(number)
+        # Closed once the threads reading it are done
+        self.readers.pop(number, None)
+
+    def _read(self, txid, step, location):
+        """
+        Read the message of a record, None if it is gone
+        """
+        (number, offset, length) = location
+        try:
+            with self.lock:
+                reader = self.readers.get(number)
+            if reader is None:
+                with contextlib.ExitStack() as stack:
+                    opened = stack.enter_context(open(
+                        os.path.join(self.path, _segment_name(number)), 'rb'))
+                    with self.lock:
+                        reader = self.readers.setdefault(number, opened)
+                    if reader is opened:
+                        # Closed once forgotten, else another thread's
+                        # reader won and this one is closed here
+                        stack.pop_all()
+            # No shared file position between threads
+            data = os.pread(reader.fileno(), length, offset)
+        except (IOError, OSError):
+            # Removed by compaction, live records were moved forward
+            with self.lock:
+                self._forget_segment(number)
+            return None
+        for (_, body) in _read_frames(data):
+            record = json.loads(body.decode())
+            if record[:2] == [txid, step] and len(record) == 3:
+                return record[2]
+        return None
+
+    def _lookup(self, txid):
+        with self.lock:
+            steps = dict(self.index.get(txid, {}))
+        for step in ('commit', 'abort'):
+            if step in steps:
+                msg = self._read(txid, step, steps[step])
+                if msg is not None:
+                    final_resp = {'status': msg}
+                    return (final_resp, http.client.OK)
+        if 'begin' in steps:
+            return (None, http.client.PROCESSING)
+        return (None, None)
+
+    def status(self, txid):
+        """
+        Function to get status of a txid
+        """
+        (resp, code) = self._lookup(txid)
+        if code != http.client.OK:
+            # Unknown or in progress here, look at what was appended since
+            self._refresh()
+            (resp, code) = self._lookup(txid)
+        return (resp, code)
+
+    def replay(self):
+        """
+        Live records in append order: (txid, step, msg)
+        """
+        self._refresh()
+        with self.lock:
+            entries = sorted(
+                (location, txid, step)
+                for (txid, steps) in self.index.items()
+                for (step, location) in steps.items()
+            )
+        for (location, txid, step) in entries:
+            msg = self._read(txid, step, location)
+            if msg is not None:
+                yield (txid, step, msg)
+
+    def compact(self):
+        """
+        Drop the oldest sealed segments once drained, copying their
+        few remaining live records to the active segment first
+        """
+        self._refresh()
+        with self._locked():
+            for number in sorted(self.sealed):
+                live = [
+                    (txid, step, location)
+                    for (txid, steps) in self.index.items()
+                    for (step, location) in steps.items()
+                    if location[0] == number
+                ]
+                livesize = sum(location[2] for (_, _, location) in live)
+                if livesize > self.scanned[number] * COMPACT_RATIO:
+                    break
+                records = []
+                for (txid, step, location) in live:
+                    msg = self._read(txid, step, location)
+                    if msg is not None:
+                        records.append(
+                            (txid, step,
+                             json.dumps([txid, step, msg]).encode()))
+                if records:
+                    for (txid, step, location) in self._append(records):
+                        self.index[txid][step] = location
+                os.remove(os.path.join(self.path, _segment_name(number)))
+                self._forget_segment(number)
+                _LOG.info('Compacted segment %d, %d live records moved',
+                          number, len(records))
+
+
+__all__ = (
+    'SegmentJournal',
+)
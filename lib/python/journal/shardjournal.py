@@ -0,0 +1,250 @@
+"""
+Journal sharded across several zookeeper ensembles
+
+Txids are placed on a consistent hash ring of the shard names, with
+VNODES points per shard: adding a shard only moves the txids of the
+ring arcs it takes over. Status lookups missing on the owner shard are
+fanned out to the other shards, which still hold what they journaled
+before the ring changed.
+
+A shard is named by its label, given as name=zkurl, or else by the
+chroot of its zkurl, so changing the servers of an ensemble does not
+move its txids. The first shard listed keeps the dump files, locks
+and history of the unsharded journal it was.
+"""
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import urllib.parse
+
+_LOG = logging.getLogger(__name__)
+
+VNODES = 128
+
+LABEL_REGEX = re.compile(r'^([\w.-]+)=(.+)$')
+
+
+def shards(primary):
+    """
+    (name, zkurl) of the shards of a primary journal: a list, or a
+    string of whitespace separated zkurls, optionally labelled
+    """
+    if isinstance(primary, (list, tuple)):
+        entries = list(primary)
+    else:
+        entries = primary.split()
+    found = []
+    for entry in entries:
+        result = LABEL_REGEX.match(entry)
+        if result:
+            found.append(result.groups())
+        else:
+            chroot = urllib.parse.urlparse(entry).path.strip('/')
+            found.append((chroot.replace('/', '-') or None, entry))
+    names = [name for (name, _) in found]
+    if len(found) > 1 and (None in names or len(set(names)) < len(names)):
+        raise ValueError('Shards need distinct chroots, or labels: '
+                         'name=zkurl')
+    return found
+
+
+def shard_urls(primary):
+    """
+    Shard zkurls of a primary journal
+    """
+    return [url for (_, url) in shards(primary)]
+
+
+def shard_suffix(index, name):
+    """
+    Suffix of the dump files, locks and history of a shard, None for
+    the first one
+    """
+    return name if index else None
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+class HashRing():
+    """
+    Consistent hash ring
+    """
+    def __init__(self, nodes, vnodes=None):
+        points = sorted(
+            (_hash('{0}#{1}'.format(node, i)), node)
+            for node in nodes
+            for i in range(vnodes or VNODES)
+        )
+        self.points = [point for (point, _) in points]
+        self.nodes = [node for (_, node) in points]
+        self.count = len(set(self.nodes))
+
+    def node(self, key):
+        """
+        Node owning key
+        """
+        index = bisect.bisect(self.points, _hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+    def successors(self, key):
+        """
+        Distinct nodes following key on the ring, owner first
+        """
+        index = bisect.bisect(self.points, _hash(key))
+        found = []
+        for offset in range(len(self.nodes)):
+            node = self.nodes[(index + offset) % len(self.nodes)]
+            if node not in found:
+                found.append(node)
+                if len(found) == self.count:
+                    break
+        return found
+
+
+class ShardedJournal():
+    """
+    Journal routing txids to shards
+    """
+    def __init__(self, journals, vnodes=None):
+        """
+        journals is {shard name: journal}
+        """
+        self.journals = journals
+        self.ring = HashRing(sorted(journals), vnodes)
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(journals))
+
+    @property
+    def shards(self):
+        """
+        The shard journals
+        """
+        return [self.journals[name] for name in sorted(self.journals)]
+
+    def _journal(self, txid):
+        return self.journals[self.ring.node(txid)]
+
+    def journal_zk_start(self):
+        """
+        Start the shards not connected
+        """
+        for journal in self.shards:
+            if not journal.zk.connected:
+                journal.journal_zk_start()
+
+    def add_connect_callback(self, callback):
+        """
+        Call callback on every (re)connection of a shard
+        """
+        for journal in self.shards:
+            journal.add_connect_callback(callback)
+
+    def warmup(self):
+        """
+        Start warming up the shard caches
+        """
+        for journal in self.shards:
+            journal.warmup()
+
+    def is_ready(self):
+        """
+        Whether all the shard caches are warm
+        """
+        return all(journal.is_ready() for journal in self.shards)
+
+    def write(self, txid, step, msg):
+        """
+        Write to the shard of txid
+        """
+        return self._journal(txid).write(txid, step, msg)
+
+    def write_batch(self, entries, concurrency=None):
+        """
+        Write (txid, step, msg) entries, the batch of each shard in
+        parallel, return the rc of each entry
+        """
+        byshard = {}
+        for (index, entry) in enumerate(entries):
+            byshard.setdefault(self.ring.node(entry[0]), []).append(index)
+        futures = {
+            name: self.pool.submit(self.journals[name].write_batch,
+                                   [entries[i] for i in indexes],
+                                   concurrency)
+            for (name, indexes) in byshard.items()
+        }
+        rcs = [1] * len(entries)
+        for (name, future) in futures.items():
+            try:
+                shardrcs = future.result()
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception('Error writing batch to shard %s', name)
+                continue
+            for (index, rc) in zip(byshard[name], shardrcs):
+                rcs[index] = rc
+        return rcs
+
+    def status(self, txid):
+        """
+        Status from the shard of txid, or the first other shard
+        knowing it
+        """
+        (resp, code) = (None, None)
+        for name in self.ring.successors(txid):
+            (resp, code) = self.journals[name].status(txid)
+            if code is not None:
+                break
+        return (resp, code)
+
+    def export(self, since=None, until=None, sincetime=None, untiltime=None):
+        """
+        History rows of each shard in turn, with their shard name:
+        sequence ids, and so since and until, are per shard
+        """
+        exports = [
+            (name, self.journals[name].export(since, until,
+                                              sincetime, untiltime))
+            for name in sorted(self.journals)
+        ]
+        return itertools.chain.from_iterable(
+            _with_shard(name, rows) for (name, rows) in exports)
+
+
+def _with_shard(name, rows):
+    for row in rows:
+        row['shard'] = name
+        yield row
+
+
+def run_per_shard(primary, job):
+    """
+    Run job(zkurl, shard suffix) for each shard, in a thread per shard
+    when there are several, until they all return
+    """
+    found = shards(primary)
+    if len(found) == 1:
+        job(found[0][1], None)
+        return
+    threads = [
+        threading.Thread(target=job, args=(url, shard_suffix(index, name)),
+                         name='shard-' + name, daemon=True)
+        for (index, (name, url)) in enumerate(found)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+__all__ = (
+    'HashRing',
+    'ShardedJournal',
+    'run_per_shard',
+    'shard_suffix',
+    'shard_urls',
+    'shards',
+)
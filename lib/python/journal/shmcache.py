@@ -0,0 +1,186 @@
+"""
+History cache shared by the journal server processes
+
+Decoded /history snapshots are kept as sqlite files, indexed on
+request_id and step, in a directory meant to be on tmpfs (/dev/shm).
+A worker decoding a snapshot writes it to a temporary file and renames
+it in place; the others open it read-only and immutable, so reads take
+no lock and map the same pages. Terminal statuses (commit or abort),
+which never change, are kept the same way as small json files.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+_LOG = logging.getLogger(__name__)
+
+STATUS_TTL = 3600
+PRUNE_INTERVAL = 60
+MMAP_SIZE = 256 * 1024 * 1024
+
+SNAPSHOT_DIR = 'snapshots'
+STATUS_DIR = 'status'
+LOCKFILE = '.lock'
+
+SNAPSHOT_INDEX = """
+    CREATE INDEX IF NOT EXISTS journal_request_step
+    ON journal (request_id, step)"""
+
+
+class SharedCache():
+    """
+    Snapshot and status cache in a directory shared between processes
+    """
+    def __init__(self, path, statusttl=None):
+        self.path = path
+        self.statusttl = statusttl or STATUS_TTL
+        self.snapshots = os.path.join(path, SNAPSHOT_DIR)
+        self.statuses = os.path.join(path, STATUS_DIR)
+        os.makedirs(self.snapshots, exist_ok=True)
+        os.makedirs(self.statuses, exist_ok=True)
+        # Read-only connections of this process, by snapshot
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.pruned = 0
+
+    def _snapshot_path(self, entry):
+        return os.path.join(self.snapshots, entry + '.db')
+
+    def _status_path(self, txid):
+        shard = '{0:02x}'.format(zlib.crc32(txid.encode()) % 256)
+        return os.path.join(self.statuses, shard,
+                            urllib.parse.quote(txid, safe='') + '.json')
+
+    def snapshot(self, entry):
+        """
+        Read-only connection to a cached snapshot, None if not cached
+        """
+        with self.lock:
+            conn = self.conns.get(entry)
+        if conn is not None:
+            return conn
+        path = self._snapshot_path(entry)
+        if not os.path.exists(path):
+            return None
+        try:
+            conn = sqlite3.connect(
+                'file:{0}?mode=ro&immutable=1'.format(
+                    urllib.parse.quote(path)),
+                uri=True, check_same_thread=False)
+            conn.execute('PRAGMA mmap_size={0}'.format(MMAP_SIZE))
+        except sqlite3.Error:
+            _LOG.exception('Error opening cached snapshot %s', entry)
+            return None
+        conn.row_factory = sqlite3.Row
+        with self.lock:
+            # Another thread may have opened it meanwhile
+            conn = self.conns.setdefault(entry, conn)
+        return conn
+
+    def put_snapshot(self, entry, source):
+        """
+        Cache the decoded snapshot in the source connection,
+        return a read-only connection to it
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self.snapshots,
+                                       prefix='.' + entry, suffix='.tmp')
+        os.close(fd)
+        try:
+            dest = sqlite3.connect(tmpfile)
+            try:
+                source.backup(dest)
+                dest.execute(SNAPSHOT_INDEX)
+                dest.commit()
+            finally:
+                dest.close()
+            os.rename(tmpfile, self._snapshot_path(entry))
+        except (sqlite3.Error, OSError):
+            _LOG.exception('Error caching snapshot %s', entry)
+            _remove_quietly(tmpfile)
+            return None
+        return self.snapshot(entry)
+
+    def get_status(self, txid):
+        """
+        Cached terminal status of txid, None if not cached
+        """
+        try:
+            with open(self._status_path(txid)) as fin:
+                return json.load(fin)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                _LOG.exception('Error reading cached status of %s', txid)
+        except ValueError:
+            _LOG.error('Bad cached status of %s', txid)
+        return None
+
+    def put_status(self, txid, status):
+        """
+        Cache the terminal status of txid
+        """
+        path = self._status_path(txid)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    mode='w', dir=os.path.dirname(path),
+                    suffix='.tmp', delete=False) as outfile:
+                json.dump(status, outfile)
+            os.rename(outfile.name, path)
+        except (IOError, OSError, TypeError, ValueError):
+            _LOG.exception('Error caching status of %s', txid)
+
+    def retain(self, entries):
+        """
+        Drop the snapshots not in entries, and statuses past their ttl.
+        Files are removed by one process at a time.
+        """
+        keep = set(entries)
+        with self.lock:
+            # Closed once the threads using them are done
+            for entry in [e for e in self.conns if e not in keep]:
+                del self.conns[entry]
+        with open(os.path.join(self.path, LOCKFILE), 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            for name in os.listdir(self.snapshots):
+                if name.endswith('.db') and name[:-3] not in keep:
+                    _remove_quietly(os.path.join(self.snapshots, name))
+            if time.time() - self.pruned >= PRUNE_INTERVAL:
+                self.pruned = time.time()
+                self._prune_statuses()
+
+    def _prune_statuses(self):
+        oldest = time.time() - self.statusttl
+        for shard in os.listdir(self.statuses):
+            shardpath = os.path.join(self.statuses, shard)
+            for name in os.listdir(shardpath):
+                path = os.path.join(shardpath, name)
+                try:
+                    if os.stat(path).st_mtime < oldest:
+                        os.unlink(path)
+                except (IOError, OSError) as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+
+
+def _remove_quietly(path):
+    try:
+        os.unlink(path)
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            _LOG.exception('Error removing %s', path)
+
+
+__all__ = (
+    'SharedCache',
+)
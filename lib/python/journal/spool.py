@@ -0,0 +1,322 @@
+"""
+Local write-ahead spool for journal writes
+
+Journal entries are appended to a memory-mapped file on local disk
+and acknowledged once synced, a flusher thread then writes them to
+the journal in batches. The file is shared by the processes of a host:
+appends take an fcntl lock on the file, and one process at a time
+flushes under a second lock. The records are kept in a ring after
+the header, head and tail are positions growing since the spool was
+created.
+
+An entry the journal keeps failing while the entries after it are
+written is moved to a dead-letter file next to the spool, one json
+[txid, step, msg] per line, so it does not hold back the others.
+"""
+import fcntl
+import http.client
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+_LOG = logging.getLogger(__name__)
+
+SPOOL_SIZE = 64 * 1024 * 1024
+FLUSH_INTERVAL = 0.05
+FLUSH_BATCHSIZE = 500
+RETRY_INTERVAL = 1
+MAX_ATTEMPTS = 5
+DEAD_LETTER_SUFFIX = '.dead'
+
+# magic, version, capacity, head (first record not flushed), tail
+HEADER = struct.Struct('!4sIQQQ')
+MAGIC = b'JSPL'
+VERSION = 1
+DATA_START = mmap.PAGESIZE
+
+# body length, body crc32
+FRAME = struct.Struct('!II')
+# length of the padding frame before the end of the ring
+PAD = 0xffffffff
+
+# byte ranges of the spool file locked for append and flush
+APPEND_LOCK = 0
+FLUSH_LOCK = 1
+
+
+class SpoolFull(Exception):
+    """
+    No room left in the spool
+    """
+
+
+class Spool():
+    """
+    Write-ahead spool in front of a journal
+    """
+    def __init__(self, path, journal, size=None, flushinterval=None,
+                 batchsize=None, maxattempts=None):
+        """
+        Open or create the spool file at path, flushing to journal.
+        An entry failing maxattempts flushes is dead-lettered.
+        """
+        self.path = path
+        self.journal = journal
+        self.flushinterval = flushinterval or FLUSH_INTERVAL
+        self.batchsize = batchsize or FLUSH_BATCHSIZE
+        self.maxattempts = maxattempts or MAX_ATTEMPTS
+        # (end position, failed flushes) of the first entry not flushed
+        self.attempts = (None, 0)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.locks = {
+            APPEND_LOCK: threading.Lock(),
+            FLUSH_LOCK: threading.Lock(),
+        }
+        with self._lock(APPEND_LOCK):
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size or SPOOL_SIZE)
+                self.mm = mmap.mmap(self.fd, 0)
+                self._set_header(0, 0)
+            else:
+                self.mm = mmap.mmap(self.fd, 0)
+            (magic, version, _, _, _) = HEADER.unpack_from(self.mm)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{0} is not a journal spool'.format(path))
+        self.ringsize = len(self.mm) - DATA_START
+        self.wakeup = threading.Event()
+        self.flusher = None
+
+    def _lock(self, offset):
+        return _RangeLock(self.fd, offset, self.locks[offset])
+
+    def _offset(self, position):
+        return DATA_START + position % self.ringsize
+
+    def _header(self):
+        (_, _, _, head, tail) = HEADER.unpack_from(self.mm)
+        return (head, tail)
+
+    def _set_header(self, head, tail):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, len(self.mm),
+                         head, tail)
+        self.mm.flush(0, mmap.PAGESIZE)
+
+    def append(self, txid, step, msg):
+        """
+        Append a journal entry, once it returns the entry is on disk.
+        Raise SpoolFull when there is no room left.
+        """
+        body = json.dumps([txid, step, msg]).encode()
+        frame = FRAME.pack(len(body), zlib.crc32(body) & 0xffffffff) + body
+        with self._lock(APPEND_LOCK):
+            (head, tail) = self._header()
+            room = self.ringsize - tail % self.ringsize
+            pad = room if len(frame) > room else 0
+            if tail + pad + len(frame) - head > self.ringsize:
+                raise SpoolFull()
+            if pad >= FRAME.size:
+                FRAME.pack_into(self.mm, self._offset(tail), PAD, 0)
+            offset = self._offset(tail + pad)
+            self.mm[offset:offset + len(frame)] = frame
+            start = self._offset(tail) - self._offset(tail) % mmap.PAGESIZE
+            if pad:
+                self.mm.flush(start, len(self.mm) - start)
+                start = DATA_START
+            self.mm.flush(start, offset + len(frame) - start)
+            self._set_header(head, tail + pad + len(frame))
+        self.start()
+        self.wakeup.set()
+
+    def _records(self, head, tail):
+        """
+        Records between head and tail: (end position, txid, step, msg)
+        """
+        position = head
+        while position < tail:
+            room = self.ringsize - position % self.ringsize
+            offset = self._offset(position)
+            if room < FRAME.size:
+                position += room
+                continue
+            (length, crc) = FRAME.unpack_from(self.mm, offset)
+            if length == PAD:
+                position += room
+                continue
+            end = offset + FRAME.size + length
+            body = self.mm[offset + FRAME.size:end]
+            if (length > room - FRAME.size or
+                    zlib.crc32(body) & 0xffffffff != crc):
+                # Overwritten since the header was read
+                return
+            position += FRAME.size + length
+            (txid, step, msg) = json.loads(body.decode())
+            yield (position, txid, step, msg)
+
+    def _contains(self, data, head, tail):
+        """
+        Whether data may be in the records between head and tail
+        """
+        if tail - head >= self.ringsize:
+            return True
+        (start, end) = (self._offset(head), self._offset(tail))
+        if start <= end:
+            return self.mm.find(data, start, end) != -1
+        return (self.mm.find(data, start) != -1 or
+                self.mm.find(data, DATA_START, end) != -1)
+
+    def status(self, txid):
+        """
+        Status of a txid from the entries not flushed yet
+        """
+        (head, tail) = self._header()
+        if head == tail or not self._contains(txid.encode(), head, tail):
+            return (None, None)
+        steps = {}
+        for (_, rtxid, step, msg) in self._records(head, tail):
+            if rtxid == txid:
+                steps[step] = msg
+        for step in ('commit', 'abort'):
+            if step in steps:
+                return ({'status': steps[step]}, http.client.OK)
+        if 'begin' in steps:
+            return (None, http.client.PROCESSING)
+        return (None, None)
+
+    def start(self):
+        """
+        Start the flusher thread of this process
+        """
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self._run,
+                                            name='spool-flush', daemon=True)
+            self.flusher.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flushinterval)
+            self.wakeup.clear()
+            try:
+                flushed = self.flush()
+                while flushed == self.batchsize:
+                    flushed = self.flush()
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception('Error flushing journal spool')
+                flushed = 0
+            (head, tail) = self._header()
+            if not flushed and head != tail:
+                # Journal down or another process flushing
+                time.sleep(RETRY_INTERVAL)
+
+    def flush(self):
+        """
+        Write a batch of spooled entries to the journal,
+        return the number of entries flushed
+        """
+        lock = self._lock(FLUSH_LOCK)
+        if not lock.acquire(blocking=False):
+            # Another process is flushing
+            return 0
+        try:
+            (head, tail) = self._header()
+            batch = []
+            for record in self._records(head, tail):
+                batch.append(record)
+                if len(batch) >= self.batchsize:
+                    break
+            if not batch:
+                return 0
+            entries = [(txid, step, msg) for (_, txid, step, msg) in batch]
+            if hasattr(self.journal, 'write_batch'):
+                rcs = self.journal.write_batch(entries)
+            else:
+                rcs = [self.journal.write(*entry) for entry in entries]
+            # Keep order: flush up to the first entry not written
+            done = 0
+            for (i, rc) in enumerate(rcs):
+                if rc != 0:
+                    if i or not self._poisoned(batch, rcs):
+                        break
+                    self._dead_letter(entries[0])
+                done += 1
+            if done:
+                with self._lock(APPEND_LOCK):
+                    (_, tail) = self._header()
+                    self._set_header(batch[done - 1][0], tail)
+            return done
+        finally:
+            lock.release()
+
+    def _poisoned(self, batch, rcs):
+        """
+        Whether the first entry of batch failed too many times
+        while the journal took the others
+        """
+        (position, count) = self.attempts
+        count = count + 1 if position == batch[0][0] else 1
+        self.attempts = (batch[0][0], count)
+        return count >= self.maxattempts and 0 in rcs[1:]
+
+    def _dead_letter(self, entry):
+        """
+        Append an entry to the dead-letter file, on disk once it returns
+        """
+        _LOG.error('Dead-lettering journal entry %s %s after %d attempts',
+                   entry[0], entry[1], self.maxattempts)
+        with open(self.path + DEAD_LETTER_SUFFIX, 'a') as fout:
+            fout.write(json.dumps(list(entry)) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+
+class _RangeLock():
+    """
+    fcntl lock on one byte of a file, with a thread lock as fcntl
+    locks are per process
+    """
+    def __init__(self, fd, offset, threadlock):
+        self.fd = fd
+        self.offset = offset
+        self.threadlock = threadlock
+
+    def acquire(self, blocking=True):
+        """
+        Take the lock, return False if not blocking and it is held
+        """
+        if not self.threadlock.acquire(blocking):
+            return False
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self.fd, flags, 1, self.offset)
+        except (IOError, OSError):
+            self.threadlock.release()
+            if blocking:
+                raise
+            return False
+        return True
+
+    def release(self):
+        """
+        Release the lock
+        """
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+        self.threadlock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+__all__ = (
+    'Spool',
+    'SpoolFull',
+)
@@ -0,0 +1,111 @@
+"""
+Unit test for binary protocol listener
+"""
+
+import http.client
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from journal import binserver
+
+
+class _Journal():
+    """Journal kept in memory, writes of txid slow wait for release"""
+
+    def __init__(self):
+        self.entries = {}
+        self.release = threading.Event()
+
+    def write(self, txid, step, msg):
+        """Journal a step"""
+        if txid == 'slow':
+            self.release.wait(5)
+        self.entries[(txid, step)] = msg
+        return 0
+
+    def status(self, txid):
+        """Status of a committed txid"""
+        if (txid, 'commit') in self.entries:
+            return ({'status': self.entries[(txid, 'commit')]},
+                    http.client.OK)
+        return (None, http.client.NOT_FOUND)
+
+
+def _send(sock, request):
+    body = json.dumps(request).encode()
+    sock.sendall(struct.pack('!I', len(body)) + body)
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+def _recv(sock):
+    (length,) = struct.unpack('!I', _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, length).decode())
+
+
+class BinaryServerTestCase(unittest.TestCase):
+    """Test for binary protocol listener"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = _Journal()
+        self.server = binserver.BinaryServer(
+            os.path.join(self.path, 'journal.bin'), self.journal)
+        self.server.start()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(self.server.path)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def test_pipelined(self):
+        """ Test pipelined requests are answered as they complete"""
+        _send(self.sock, {'id': 1, 'op': 'write', 'txid': 'slow',
+                          'step': 'begin', 'msg': {}})
+        _send(self.sock, {'id': 2, 'op': 'write', 'txid': 'tx1',
+                          'step': 'commit', 'msg': {'n': 1}})
+        self.assertEqual(_recv(self.sock), {'id': 2, 'rc': 0})
+        self.journal.release.set()
+        self.assertEqual(_recv(self.sock), {'id': 1, 'rc': 0})
+        _send(self.sock, {'id': 3, 'op': 'status', 'txid': 'tx1'})
+        self.assertEqual(_recv(self.sock),
+                         {'id': 3, 'status': {'status': {'n': 1}},
+                          'code': http.client.OK})
+
+    def test_errors(self):
+        """ Test bad requests get an error reply"""
+        _send(self.sock, {'id': 1, 'op': 'write', 'txid': 'tx1'})
+        self.assertEqual(_recv(self.sock),
+                         {'id': 1, 'error': "Missing 'step'"})
+        _send(self.sock, {'id': 2, 'op': 'delete'})
+        self.assertEqual(_recv(self.sock),
+                         {'id': 2, 'error': "Unknown op 'delete'"})
+
+    def test_try_start(self):
+        """ Test one process at a time listens on the socket"""
+        path = os.path.join(self.path, 'other.bin')
+        first = binserver.BinaryServer(path, self.journal)
+        second = binserver.BinaryServer(path, self.journal)
+        self.assertTrue(first.try_start())
+        self.assertFalse(second.try_start())
+        first.stop()
+        self.assertTrue(second.try_start())
+        second.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
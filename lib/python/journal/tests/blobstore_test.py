@@ -0,0 +1,51 @@
+"""
+Unit test for payload blob store
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal import blobstore
+
+
+class BlobStoreTestCase(unittest.TestCase):
+    """Test for payload blob store"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = blobstore.BlobStore(self.path, threshold=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_offload(self):
+        """ Test large payloads are replaced by a reference once"""
+        msg = {'step': 'commit', 'payload': {'data': 'x' * 200}}
+        offloaded = self.store.offload(msg)
+        self.assertTrue(blobstore.is_ref(offloaded['payload']))
+        self.assertEqual(self.store.offload(dict(msg)), offloaded)
+        self.assertEqual(self.store.rehydrate(offloaded), msg)
+        small = {'step': 'commit', 'payload': {'data': 'x'}}
+        self.assertIs(self.store.offload(small), small)
+        files = [f for (_, _, fs) in os.walk(self.path) for f in fs]
+        self.assertEqual(files, [offloaded['payload']['$blob']])
+
+    def test_escape(self):
+        """ Test user payloads looking like references are escaped"""
+        for payload in ({'$blob': '00' * 32, 'size': 10},
+                        {'$escaped': 1}, {'$blob': 'x' * 200}):
+            msg = {'step': 'commit', 'payload': payload}
+            offloaded = self.store.offload(msg)
+            self.assertNotEqual(offloaded, msg)
+            self.assertEqual(self.store.rehydrate(offloaded), msg)
+
+    def test_missing_blob(self):
+        """ Test references to missing blobs are returned as is"""
+        msg = {'payload': {'$blob': '00' * 32, 'size': 10}}
+        self.assertEqual(self.store.rehydrate(msg), msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Unit test for journal client
+"""
+
+import asyncio
+import http.client
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+
+from journal import client
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super(_Handler, self).setup()
+        self.server.connections += 1
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):  # pylint: disable=C0103
+        """Batch and bulk status"""
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length).decode())
+        if self.path == '/batch':
+            self.server.batches.append(len(body))
+            for entry in body:
+                self.server.entries[entry['txid']] = entry['step']
+            self._reply(http.client.CREATED, {'rcs': [0] * len(body)})
+        elif self.path == '/status':
+            self._reply(http.client.OK, {
+                txid: {'status': None, 'code': http.client.NOT_FOUND}
+                for txid in body
+            })
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Status, committed after a few polls"""
+        self.server.polls += 1
+        if self.server.polls < 3:
+            self._reply(http.client.NOT_FOUND, {'status': 'Task not found'})
+        else:
+            self._reply(http.client.OK, {'status': {'done': True}})
+
+
+class JournalClientTestCase(unittest.TestCase):
+    """Test for journal client"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.sock = os.path.join(self.path, 'journal.sock')
+        self.server = _Server(self.sock, _Handler)
+        self.server.connections = 0
+        self.server.polls = 0
+        self.server.batches = []
+        self.server.entries = {}
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_batching(self):
+        """ Test submitted writes are sent in batches"""
+        with client.JournalClient(self.sock, batchsize=50,
+                                  batchinterval=1) as jclient:
+            futures = [jclient.submit('tx%d' % i, 'begin', {})
+                       for i in range(120)]
+            self.assertEqual([f.result(5) for f in futures], [0] * 120)
+        self.assertEqual(self.server.batches, [50, 50, 20])
+        self.assertEqual(len(self.server.entries), 120)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_wait_for(self):
+        """ Test wait_for polls on a kept-alive connection"""
+        with client.JournalClient(self.sock) as jclient:
+            self.assertEqual(jclient.wait_for('tx1', timeout=5),
+                             ({'status': {'done': True}}, http.client.OK))
+            self.assertEqual(
+                jclient.status_many(['tx1']),
+                {'tx1': (None, http.client.NOT_FOUND)})
+        self.assertEqual(self.server.polls, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_async(self):
+        """ Test the asyncio client batches and polls on one connection"""
+        async def _run():
+            async with client.AsyncJournalClient(
+                    self.sock, batchsize=50, batchinterval=1) as jclient:
+                rcs = await asyncio.gather(*[
+                    jclient.submit('tx%d' % i, 'begin', {})
+                    for i in range(120)])
+                status = await jclient.wait_for('tx1', timeout=5)
+                statuses = await jclient.status_many(['tx1'])
+            return (rcs, status, statuses)
+
+        loop = asyncio.new_event_loop()
+        try:
+            (rcs, status, statuses) = loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        self.assertEqual(rcs, [0] * 120)
+        self.assertEqual(self.server.batches, [50, 50, 20])
+        self.assertEqual(status,
+                         ({'status': {'done': True}}, http.client.OK))
+        self.assertEqual(statuses, {'tx1': (None, http.client.NOT_FOUND)})
+        self.assertEqual(self.server.polls, 3)
+        self.assertEqual(self.server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Unit test for batched begin writes
+"""
+
+import http.client
+import threading
+import unittest
+
+import mock  # pylint: disable=E0401
+
+from journal import mjournal
+
+
+class _Primary():
+    """Journal kept in memory, shared by several Journal instances"""
+
+    def __init__(self):
+        self.steps = {}
+        self.batches = []
+
+    def write(self, txid, step, msg):
+        """Journal a step"""
+        self.steps[(txid, step)] = msg
+        return 0
+
+    def write_batch(self, entries):
+        """Journal a batch of steps"""
+        self.batches.append(entries)
+        return [self.write(*entry) for entry in entries]
+
+    def status(self, txid):
+        """Status of txid"""
+        for step in ('commit', 'abort'):
+            if (txid, step) in self.steps:
+                return ({'status': self.steps[(txid, step)]},
+                        http.client.OK)
+        if (txid, 'begin') in self.steps:
+            return (None, http.client.PROCESSING)
+        return (None, None)
+
+
+class CoalesceTestCase(unittest.TestCase):
+    """Test for batched begin writes"""
+
+    def setUp(self):
+        self.journal = mjournal.Journal({'beginwindow': 0.05}, {})
+        self.journal.primary = _Primary()
+
+    def test_batch(self):
+        """ Test begins within the window are written in one batch"""
+        rcs = {}
+        threads = [
+            threading.Thread(target=lambda txid=txid: rcs.update(
+                {txid: self.journal.write(txid, 'begin', {'n': 1})}))
+            for txid in ('tx1', 'tx2', 'tx3')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(rcs, {'tx1': 0, 'tx2': 0, 'tx3': 0})
+        batches = self.journal.primary.batches
+        self.assertEqual(sorted(txid for batch in batches
+                                for (txid, _, _) in batch),
+                         ['tx1', 'tx2', 'tx3'])
+        self.assertTrue(len(batches) < 3)
+        # Other steps are written right away
+        self.assertEqual(self.journal.write('tx1', 'commit', {'n': 2}), 0)
+        self.assertEqual(len(self.journal.primary.batches), len(batches))
+
+    def test_status_elsewhere(self):
+        """ Test an acknowledged begin is seen by other journals"""
+        other = mjournal.Journal({}, {})
+        other.primary = self.journal.primary
+        self.assertEqual(self.journal.write('tx1', 'begin', {'n': 1}), 0)
+        self.assertEqual(other.status('tx1'),
+                         ({'status': 'Task in progress'},
+                          http.client.PROCESSING))
+        self.assertEqual(self.journal.write('tx1', 'commit', {'n': 2}), 0)
+        self.assertEqual(other.status('tx1'),
+                         ({'status': {'n': 2}}, http.client.OK))
+
+    def test_failover(self):
+        """ Test begins the primary failed to write go to secondary"""
+        self.journal.primary = mock.Mock()
+        self.journal.primary.write_batch.side_effect = (
+            lambda entries: [1] * len(entries))
+        self.journal.secondary = mock.Mock()
+        self.journal.secondary.write.return_value = 0
+        self.assertEqual(self.journal.write('tx1', 'begin', {'n': 1}), 0)
+        self.journal.secondary.write.assert_called_once_with(
+            'tx1', 'begin', {'n': 1})
+        # An error writing the batch fails its begins
+        self.journal.primary.write_batch.side_effect = IOError('down')
+        self.assertEqual(self.journal.write('tx2', 'begin', {'n': 1}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
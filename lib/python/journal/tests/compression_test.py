@@ -0,0 +1,54 @@
+"""
+Unit test for journal compression codecs
+"""
+
+import json
+import unittest
+import zlib
+
+from journal import compression
+
+
+MSG = json.dumps({
+    'user_id': 'user1', 'role': None,
+    'request_id': 'BAD268C6-AB14-11E6-A7C1-98638C7A8FAA',
+    'transaction_id': 'BAD268C6-AB14-11E6-A7C1-98638C7A8FAA',
+    'step': 'commit', 'resource': 'phonebook', 'cm': None
+}).encode()
+
+
+class CompressionTestCase(unittest.TestCase):
+    """Test for journal compression codecs"""
+
+    def test_zlib_legacy(self):
+        """ Test plain zlib is written and read without header"""
+        codec = compression.Codec()
+        self.assertEqual(codec.encode(MSG), zlib.compress(MSG))
+        self.assertEqual(codec.decode(zlib.compress(MSG)), MSG)
+
+    def test_dictionary(self):
+        """ Test dictionary compression round trip and size"""
+        codec = compression.Codec('zlib', compression.DEFAULT_DICTIONARY)
+        data = codec.encode(MSG)
+        self.assertEqual(data[:1], b'\x00')
+        self.assertTrue(len(data) < len(zlib.compress(MSG)))
+        # Any codec reads data with a known dictionary
+        self.assertEqual(compression.Codec().decode(data), MSG)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard missing')
+    def test_zstd(self):
+        """ Test zstd round trip"""
+        codec = compression.Codec('zstd')
+        self.assertEqual(compression.Codec().decode(codec.encode(MSG)), MSG)
+
+    def test_unknown_dictionary(self):
+        """ Test unknown dictionaries are resolved"""
+        dictionary = compression.train_dictionary([MSG] * 3, 1024)
+        data = compression.Codec('zlib', dictionary).encode(MSG)
+        self.assertRaises(ValueError, compression.Codec().decode, data)
+        codec = compression.Codec(resolver=lambda _dict_id: dictionary)
+        self.assertEqual(codec.decode(data), MSG)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Unit test for indexed journal history
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from journal import blobstore
+from journal import historydb
+
+
+def _row(txid, step, user, date):
+    return ('host1', user, user, date, 'req-' + txid, txid, step,
+            None, 'proid', 'resource1', 'POST', None,
+            json.dumps({'n': 1}), None)
+
+
+class HistoryDBTestCase(unittest.TestCase):
+    """Test for indexed journal history"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = os.path.join(self.path, 'history.db')
+        self.history = historydb.HistoryDB(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_ingest(self):
+        """ Test snapshots are loaded once"""
+        rows = [_row('tx1', 'begin', 'alice', '2020-01-01 00:00:00'),
+                _row('tx1', 'commit', 'alice', '2020-01-01 00:00:01')]
+        self.assertEqual(self.history.ingest('0000000001', rows), 2)
+        self.assertEqual(self.history.ingest('0000000001', rows), 0)
+        (found, cursor) = self.history.query({'transaction_id': 'tx1'})
+        self.assertEqual([row['step'] for row in found], ['begin', 'commit'])
+        self.assertEqual(found[0]['payload'], {'n': 1})
+        self.assertIsNone(cursor)
+
+    def test_query(self):
+        """ Test filters, date range and pagination"""
+        rows = [_row('tx{0}'.format(i), 'commit',
+                     'alice' if i % 2 else 'bob',
+                     '2020-01-{0:02d}00:00:00'.format(i + 1))
+                for i in range(10)]
+        self.history.ingest('0000000001', rows)
+        reader = historydb.HistoryDB(self.db, readonly=True)
+        (found, _) = reader.query({'user_id': 'bob'},
+                                  since='2020-01-03', until='2020-01-08')
+        self.assertEqual([row['transaction_id'] for row in found],
+                         ['tx2', 'tx4', 'tx6'])
+        pages = []
+        cursor = None
+        while True:
+            (found, cursor) = reader.query({}, cursor=cursor, limit=4)
+            pages.append(len(found))
+            if cursor is None:
+                break
+        self.assertEqual(pages, [4, 4, 2])
+
+    def test_blobs(self):
+        """ Test offloaded payloads are read back from the blob store"""
+        blobpath = os.path.join(self.path, 'blobs')
+        msg = blobstore.BlobStore(blobpath, threshold=4).offload(
+            {'payload': {'big': 'x' * 10}})
+        row = list(_row('tx1', 'commit', 'alice', '2020-01-01 00:00:00'))
+        row[12] = json.dumps(msg['payload'])
+        self.history.ingest('0000000001', [row])
+        reader = historydb.HistoryDB(self.db, readonly=True,
+                                     blobpath=blobpath)
+        (found, _) = reader.query({'transaction_id': 'tx1'})
+        self.assertEqual(found[0]['payload'], {'big': 'x' * 10})
+        (found, _) = self.history.query({'transaction_id': 'tx1'})
+        self.assertTrue(blobstore.is_ref(found[0]['payload']))
+
+    def test_threads(self):
+        """ Test queries from other threads than the ingesting one"""
+        self.history.ingest('0000000001', [
+            _row('tx1', 'commit', 'alice', '2020-01-01 00:00:00')])
+        found = []
+        thread = threading.Thread(target=lambda: found.extend(
+            self.history.query({'user_id': 'alice'})[0]))
+        thread.start()
+        thread.join()
+        self.assertEqual([row['transaction_id'] for row in found], ['tx1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+"""
+Unit test for inotify binding
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal import inotify
+
+
+@unittest.skipUnless(inotify.available(), 'inotify not available')
+class InotifyTestCase(unittest.TestCase):
+    """Test for inotify binding"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        """ Test written and renamed files are reported"""
+        watcher = inotify.Watcher([self.path])
+        with open(os.path.join(self.path, 'tx1_begin'), 'w') as fout:
+            fout.write('{}')
+        os.rename(os.path.join(self.path, 'tx1_begin'),
+                  os.path.join(self.path, 'tx1_commit'))
+        self.assertEqual(watcher.read(), ['tx1_begin', 'tx1_commit'])
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
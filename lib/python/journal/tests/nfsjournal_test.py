@@ -0,0 +1,148 @@
+"""
+Unit test for NFS journal
+"""
+
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from journal import nfsjournal
+
+
+class NFSJournalTestCase(unittest.TestCase):
+    """Test for NFS journal"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sharded(self):
+        """ Test journal files go to the shard of their txid"""
+        nfsjournal.write_layout(self.path, 16)
+        journal = nfsjournal.NFSJournal(self.path)
+        journal.write('tx1', 'commit', {'step': 'commit'})
+        shard = nfsjournal.shard_path(self.path, 16, 'tx1')
+        self.assertEqual(os.listdir(shard), ['tx1_commit'])
+        self.assertEqual(journal.status('tx1'),
+                         ({'status': {'step': 'commit'}}, http.client.OK))
+        self.assertEqual(len(list(nfsjournal.journal_dirs(self.path))), 17)
+
+    def test_migrate(self):
+        """ Test flat journal files are moved to shards and back"""
+        nfsjournal.NFSJournal(self.path).write('tx1', 'begin', {})
+        self.assertEqual(nfsjournal.migrate(self.path, 4), 1)
+        journal = nfsjournal.NFSJournal(self.path)
+        self.assertEqual(journal.status('tx1'),
+                         (None, http.client.PROCESSING))
+        self.assertEqual(nfsjournal.migrate(self.path, 0), 1)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['.layout', 'tx1_begin'])
+        self.assertRaises(ValueError, nfsjournal.migrate, self.path, 1000)
+
+    def test_migrate_transition(self):
+        """ Test files written flat after a migration are still found"""
+        flat = nfsjournal.NFSJournal(self.path)
+        nfsjournal.migrate(self.path, 4)
+        # Server not restarted yet, still writing flat
+        flat.write('tx1', 'commit', {'step': 'commit'})
+        journal = nfsjournal.NFSJournal(self.path)
+        self.assertEqual(journal.status('tx1'),
+                         ({'status': {'step': 'commit'}}, http.client.OK))
+        self.assertEqual(journal.status('tx2'), (None, None))
+        # Migrated again once restarted, the flat directory is not read
+        nfsjournal.migrate(self.path, 4)
+        self.assertIsNone(nfsjournal.previous_layout(self.path))
+        journal = nfsjournal.NFSJournal(self.path)
+        self.assertEqual(journal.status('tx1'),
+                         ({'status': {'step': 'commit'}}, http.client.OK))
+        flat.write('tx2', 'commit', {'step': 'commit'})
+        self.assertEqual(journal.status('tx2'), (None, None))
+
+    def test_sharded_miss(self):
+        """ Test a miss of a journal sharded from the start reads a shard"""
+        nfsjournal.write_layout(self.path, 4)
+        journal = nfsjournal.NFSJournal(self.path)
+        with mock.patch('builtins.open',
+                        side_effect=FileNotFoundError) as mock_open:
+            self.assertEqual(journal.status('tx1'), (None, None))
+        shard = nfsjournal.shard_path(self.path, 4, 'tx1')
+        self.assertEqual(
+            {os.path.dirname(call[0][0]) for call in mock_open.call_args_list},
+            {shard})
+
+    def test_group_commit(self):
+        """ Test concurrent writers share one sync"""
+        journal = nfsjournal.NFSJournal(self.path, durability='group',
+                                        groupwindow=0.05)
+        rcs = []
+        with mock.patch('journal.nfsjournal._sync_files',
+                        return_value=set()) as sync:
+            threads = [
+                threading.Thread(target=lambda i=i: rcs.append(
+                    journal.write('tx{0}'.format(i), 'begin', {})))
+                for i in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(rcs, [0] * 5)
+        self.assertEqual(sync.call_count, 1)
+        self.assertEqual(len(sync.call_args[0][0]), 5)
+        self.assertEqual(len(os.listdir(self.path)), 5)
+        self.assertEqual(journal.status('tx3'),
+                         (None, http.client.PROCESSING))
+
+    def test_fsync_error(self):
+        """ Test a failed fsync fails the write and leaves no file"""
+        for durability in ('fsync', 'group'):
+            journal = nfsjournal.NFSJournal(self.path, durability=durability,
+                                            groupwindow=0)
+            with mock.patch('os.fsync', side_effect=OSError(5, 'EIO')):
+                self.assertEqual(journal.write('tx1', 'begin', {}), 1)
+            self.assertEqual(os.listdir(self.path), [])
+            self.assertEqual(journal.write('tx1', 'begin', {}), 0)
+            self.assertEqual(os.listdir(self.path), ['tx1_begin'])
+            os.remove(os.path.join(self.path, 'tx1_begin'))
+
+    def test_negative_cache(self):
+        """ Test misses are cached until written or expired"""
+        journal = nfsjournal.NFSJournal(self.path, negativettl=60)
+        other = nfsjournal.NFSJournal(self.path)
+        self.assertEqual(journal.status('tx1'), (None, None))
+        other.write('tx1', 'begin', {})
+        with mock.patch('builtins.open') as mock_open:
+            self.assertEqual(journal.status('tx1'), (None, None))
+            self.assertFalse(mock_open.called)
+        journal.write('tx1', 'commit', {})
+        self.assertEqual(journal.status('tx1'), ({'status': {}},
+                                                 http.client.OK))
+
+    def test_listing(self):
+        """ Test misses are answered from the directory listing"""
+        nfsjournal.NFSJournal(self.path).write('tx1', 'begin', {})
+        journal = nfsjournal.NFSJournal(self.path, listinterval=60)
+        # List from the test, not the lister thread
+        with mock.patch('journal.nfsjournal.threading.Thread') as thread:
+            self.assertEqual(journal.status('tx2'), (None, None))
+        list_files = thread.call_args[1]['target']
+        with mock.patch('time.sleep', side_effect=StopIteration):
+            self.assertRaises(StopIteration, list_files)
+        with mock.patch('builtins.open') as mock_open:
+            self.assertEqual(journal.status('tx2'), (None, None))
+            self.assertFalse(mock_open.called)
+        self.assertEqual(journal.status('tx1'),
+                         (None, http.client.PROCESSING))
+        journal.write('tx2', 'abort', {})
+        self.assertEqual(journal.status('tx2')[1], http.client.OK)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Unit test for journal record encoding
+"""
+
+import json
+import unittest
+
+from journal import record
+
+
+MSG = {
+    'user_id': 'user1', 'resourcepk': None,
+    'request_id': 'ac513125-0469-408d-b332-b8a0383870f9',
+    'host': 'host1', 'payload': {'name': 'todo', 'tags': [1, 2]},
+    'resourcegroup': 'cookbook',
+    'transaction_id': 'c4f62dae-2c3a-417e-94f9-db43d86d4cd0',
+    'cm': None, 'step': 'begin', 'date': '2017-6-13 16:47:55',
+    'resource': 'cookbook/todo', 'role': None, 'authuser_id': 'user1',
+    'verb': 'get'
+}
+
+
+class RecordTestCase(unittest.TestCase):
+    """Test for journal record encoding"""
+
+    def test_round_trip(self):
+        """ Test binary messages decode to the original message"""
+        data = record.encode(MSG)
+        self.assertTrue(len(data) < len(json.dumps(MSG)))
+        self.assertEqual(record.decode(data), MSG)
+        msg = {'step': 'commit', 'extra': {'a': 1}}
+        self.assertEqual(record.decode(record.encode(msg)), msg)
+
+    def test_json_fallback(self):
+        """ Test json messages and messages off schema"""
+        data = record.encode(MSG, binary=False)
+        self.assertEqual(record.decode(data), MSG)
+        msg = dict(MSG, date=1497372475)
+        self.assertEqual(record.encode(msg), json.dumps(msg).encode())
+
+    def test_rows(self):
+        """ Test snapshot rows from binary and json messages"""
+        row = record.to_row(record.encode(MSG))
+        self.assertEqual(row, record.to_row(json.dumps(MSG).encode()))
+        self.assertEqual(row[12], json.dumps(MSG['payload']))
+        rows = [row, record.to_row(record.encode({'step': 'abort'}))]
+        data = record.encode_rows(rows)
+        self.assertEqual(list(record.decode_rows(data)), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Unit test for segment log journal
+"""
+
+import http.client
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock  # pylint: disable=E0401
+
+from journal import segjournal
+
+
+class SegmentJournalTestCase(unittest.TestCase):
+    """Test for segment log journal"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_status(self):
+        """ Test status across processes sharing the segments"""
+        writer = segjournal.SegmentJournal(self.path)
+        reader = segjournal.SegmentJournal(self.path)
+        self.assertEqual(reader.status('tx1'), (None, None))
+        writer.write('tx1', 'begin', {'step': 'begin'})
+        self.assertEqual(reader.status('tx1'),
+                         (None, http.client.PROCESSING))
+        writer.write('tx1', 'commit', {'step': 'commit'})
+        self.assertEqual(reader.status('tx1'),
+                         ({'status': {'step': 'commit'}}, http.client.OK))
+
+    def test_damaged_record(self):
+        """ Test records after a partial write are still read"""
+        journal = segjournal.SegmentJournal(self.path)
+        journal.write('tx1', 'begin', {})
+        with open(os.path.join(self.path, 'seg-0000000000.log'), 'ab') as f:
+            f.write(segjournal.FRAME_MAGIC + b'\x00\x00')
+        journal.write('tx2', 'abort', {'step': 'abort'})
+        reader = segjournal.SegmentJournal(self.path)
+        self.assertEqual(reader.status('tx2')[1], http.client.OK)
+        self.assertEqual(reader.status('tx1')[1], http.client.PROCESSING)
+
+    def test_drain_compact(self):
+        """ Test segments rotate and are removed once drained"""
+        journal = segjournal.SegmentJournal(self.path, segmentsize=100)
+        for i in range(4):
+            journal.write('tx{0}'.format(i), 'commit', {'n': 'x' * 80})
+        self.assertEqual(len(os.listdir(self.path)), 5)
+        entries = list(journal.replay())
+        self.assertEqual([txid for (txid, _, _) in entries],
+                         ['tx0', 'tx1', 'tx2', 'tx3'])
+        journal.drain([('tx0', 'commit'), ('tx1', 'commit')])
+        journal.compact()
+        reader = segjournal.SegmentJournal(self.path)
+        self.assertEqual(reader.status('tx0'), (None, None))
+        self.assertEqual(reader.status('tx3')[1], http.client.OK)
+        self.assertEqual([txid for (txid, _, _) in reader.replay()],
+                         ['tx2', 'tx3'])
+        self.assertNotIn('seg-0000000000.log', os.listdir(self.path))
+
+    def test_rotation(self):
+        """ Test appends follow rotations without listing segments"""
+        first = segjournal.SegmentJournal(self.path, segmentsize=100)
+        second = segjournal.SegmentJournal(self.path, segmentsize=100)
+        first.write('tx0', 'commit', {'n': 'x' * 80})
+        second.write('tx1', 'commit', {'n': 'x' * 80})
+        with mock.patch('os.path.exists') as exists, \
+                mock.patch('os.listdir') as listdir:
+            first.write('tx2', 'begin', {})
+            exists.assert_not_called()
+            listdir.assert_not_called()
+        # Past the segment second rotated to, full too
+        self.assertEqual((first.active, second.active), (2, 1))
+        self.assertEqual(
+            sorted(os.listdir(self.path))[1:],
+            ['seg-0000000000.log', 'seg-0000000001.log',
+             'seg-0000000002.log'])
+        reader = segjournal.SegmentJournal(self.path)
+        for txid in ('tx0', 'tx1'):
+            self.assertEqual(reader.status(txid)[1], http.client.OK)
+        self.assertEqual(reader.status('tx2')[1], http.client.PROCESSING)
+
+    def test_appended_elsewhere(self):
+        """ Test own appends are told apart from other processes'"""
+        writer = segjournal.SegmentJournal(self.path)
+        resync = segjournal.SegmentJournal(self.path)
+        writer.write('tx1', 'commit', {})
+        self.assertTrue(resync.appended_elsewhere())
+        self.assertEqual(len(list(resync.replay())), 1)
+        self.assertFalse(resync.appended_elsewhere())
+        # Its own tombstones do not count
+        resync.drain([('tx1', 'commit')])
+        self.assertFalse(resync.appended_elsewhere())
+        writer.write('tx2', 'begin', {})
+        self.assertTrue(resync.appended_elsewhere())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Unit test for sharded journal
+"""
+
+import http.client
+import unittest
+
+from journal import shardjournal
+
+
+class _Journal():
+    """Journal of a shard, kept in memory"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def write(self, txid, step, msg):
+        """Journal a step"""
+        self.entries[(txid, step)] = msg
+        return 0
+
+    def write_batch(self, entries, concurrency=None):
+        """Journal a batch of steps"""
+        del concurrency
+        return [self.write(*entry) for entry in entries]
+
+    def export(self, since=None, until=None, sincetime=None, untiltime=None):
+        """Rows of the journaled txids"""
+        del since, until, sincetime, untiltime
+        return iter([{'transaction_id': txid}
+                     for (txid, _) in sorted(self.entries)])
+
+    def status(self, txid):
+        """Status of a committed txid"""
+        if (txid, 'commit') in self.entries:
+            return ({'status': self.entries[(txid, 'commit')]},
+                    http.client.OK)
+        return (None, None)
+
+
+class ShardJournalTestCase(unittest.TestCase):
+    """Test for sharded journal"""
+
+    def test_shard_urls(self):
+        """ Test primary journals are split in shard zkurls"""
+        self.assertEqual(shardjournal.shard_urls('zookeeper://a/j'),
+                         ['zookeeper://a/j'])
+        self.assertEqual(
+            shardjournal.shard_urls('zookeeper://a/j a2=zookeeper://b/j'),
+            ['zookeeper://a/j', 'zookeeper://b/j'])
+        self.assertEqual(shardjournal.shard_urls(['zookeeper://a/j']),
+                         ['zookeeper://a/j'])
+
+    def test_shards(self):
+        """ Test shards are named by label or chroot, not servers"""
+        self.assertEqual(
+            shardjournal.shards('zookeeper://a,b/j/1 zookeeper://c/j/2'),
+            [('j-1', 'zookeeper://a,b/j/1'), ('j-2', 'zookeeper://c/j/2')])
+        self.assertEqual(
+            shardjournal.shards(['east=zookeeper://a/j', 'zookeeper://b/k']),
+            [('east', 'zookeeper://a/j'), ('k', 'zookeeper://b/k')])
+        self.assertEqual(shardjournal.shards('zookeeper://a'),
+                         [(None, 'zookeeper://a')])
+        self.assertRaises(ValueError, shardjournal.shards,
+                          'zookeeper://a/j zookeeper://b/j')
+        self.assertRaises(ValueError, shardjournal.shards,
+                          'zookeeper://a zookeeper://b/j')
+        self.assertEqual(
+            [shardjournal.shard_suffix(i, name) for (i, name)
+             in enumerate(['j-1', 'j-2'])], [None, 'j-2'])
+
+    def test_ring(self):
+        """ Test adding a shard only moves the keys it takes over"""
+        keys = ['tx%d' % i for i in range(10000)]
+        ring = shardjournal.HashRing(['a', 'b', 'c'])
+        before = {key: ring.node(key) for key in keys}
+        counts = [list(before.values()).count(node) for node in 'abc']
+        self.assertTrue(all(count > 2500 for count in counts), counts)
+        ring = shardjournal.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if ring.node(key) != before[key]]
+        self.assertTrue(all(ring.node(key) == 'd' for key in moved))
+        self.assertTrue(1500 < len(moved) < 3500, len(moved))
+        self.assertEqual(sorted(ring.successors('tx1')), list('abcd'))
+        self.assertEqual(ring.successors('tx1')[0], ring.node('tx1'))
+
+    def test_routing(self):
+        """ Test writes go to their shard and status misses fan out"""
+        old = {'a': _Journal(), 'b': _Journal()}
+        journal = shardjournal.ShardedJournal(old)
+        entries = [('tx%d' % i, 'commit', {'n': i}) for i in range(100)]
+        self.assertEqual(journal.write_batch(entries), [0] * 100)
+        for (txid, _, _) in entries:
+            owner = old[journal.ring.node(txid)]
+            self.assertIn((txid, 'commit'), owner.entries)
+        self.assertTrue(all(shard.entries for shard in old.values()))
+
+        # A new shard owns some txids journaled on the old ones
+        shards = dict(old)
+        shards['c'] = _Journal()
+        journal = shardjournal.ShardedJournal(shards)
+        for (txid, _, msg) in entries:
+            self.assertEqual(journal.status(txid),
+                             ({'status': msg}, http.client.OK))
+        self.assertEqual(journal.status('missing'), (None, None))
+
+    def test_export(self):
+        """ Test the history of every shard is exported"""
+        shards = {'a': _Journal(), 'b': _Journal()}
+        shards['a'].write('tx1', 'commit', {})
+        shards['b'].write('tx2', 'commit', {})
+        journal = shardjournal.ShardedJournal(shards)
+        self.assertEqual(list(journal.export()),
+                         [{'transaction_id': 'tx1', 'shard': 'a'},
+                          {'transaction_id': 'tx2', 'shard': 'b'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Unit test for shared history cache
+"""
+
+import http.client
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock  # pylint: disable=E0401
+
+from journal import shmcache
+from journal import zkhistory
+from journal import zkjournal
+from journal.zk.client.zookeeper import ZkClient
+
+
+def _rows(seq):
+    return [
+        ('host', 'user', 'user', 'date', 'tx%d%d' % (seq, i),
+         'tx%d%d' % (seq, i), step, None, 'rg', 'res', 'verb', None,
+         '{"n": %d}' % i, None)
+        for i in range(3) for step in ('begin', 'commit')
+    ]
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """Test for shared history cache"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_status(self):
+        """ Test terminal statuses are shared through files"""
+        cache = shmcache.SharedCache(self.path)
+        self.assertIsNone(cache.get_status('tx/1'))
+        cache.put_status('tx/1', {'step': 'commit'})
+        other = shmcache.SharedCache(self.path)
+        self.assertEqual(other.get_status('tx/1'), {'step': 'commit'})
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    @mock.patch('kazoo.client.KazooClient.connected',
+                mock.PropertyMock(return_value=True))
+    def test_snapshots(self):
+        """ Test snapshots are decoded once for all workers"""
+        snapshots = {}
+        workers = []
+        watchers = []
+
+        def _children_watch(_path, func):
+            watchers.append(func)
+            func(list(snapshots))
+        for _ in range(2):
+            zkj = zkjournal.ZookeeperJournal(
+                'zookeeper://dev#foobar', dict(), 'adminuser', 2,
+                shmcachepath=self.path)
+            zkj.zk.exists = mock.Mock(side_effect=lambda path: (
+                path == '/history'))
+            zkj.zk.ChildrenWatch = _children_watch
+            zkj.zk.get = mock.Mock(
+                side_effect=lambda path: (snapshots[path.split('/')[-1]],
+                                          None))
+            workers.append(zkj)
+        for seq in range(1, 4):
+            snapshots['sqlite-db#%010d' % seq] = zkhistory.make_snapshot(
+                _rows(seq), workers[0].codec)
+
+        (resp, code) = workers[0].status('tx11')
+        self.assertEqual(code, http.client.OK)
+        self.assertEqual(resp['status']['payload'], {'n': 1})
+        # The 2 newest snapshots are cached, the oldest was decoded
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.path, 'snapshots'))),
+            ['sqlite-db#0000000002.db', 'sqlite-db#0000000003.db'])
+
+        workers[1].zk.get.reset_mock()
+        (_, code) = workers[1].status('tx32')
+        self.assertEqual(code, http.client.OK)
+        (_, code) = workers[1].status('tx11')
+        self.assertEqual(code, http.client.OK)
+        # Cached snapshot and final status: no snapshot fetched
+        self.assertEqual(workers[1].zk.get.call_count, 0)
+
+        del snapshots['sqlite-db#0000000002']
+        snapshots['sqlite-db#0000000004'] = zkhistory.make_snapshot(
+            _rows(4), workers[1].codec)
+        for func in watchers:
+            func(list(snapshots))
+        (_, code) = workers[1].status('tx99')
+        self.assertIsNone(code)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.path, 'snapshots'))),
+            ['sqlite-db#0000000003.db', 'sqlite-db#0000000004.db'])
+
+
+if __name__ == '__main__':
+    unittest.main()
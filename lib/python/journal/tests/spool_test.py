@@ -0,0 +1,100 @@
+"""
+Unit test for journal write-ahead spool
+"""
+
+import http.client
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from journal import spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    """Test for journal write-ahead spool"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = mock.Mock()
+        self.journal.write_batch.side_effect = lambda e: [0] * len(e)
+        # Flush from the tests, not the flusher thread
+        patcher = mock.patch('journal.spool.Spool.start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _spool(self, size=None):
+        return spool.Spool(os.path.join(self.path, 'spool'),
+                           self.journal, size, batchsize=3)
+
+    def test_status_flush(self):
+        """ Test spooled entries are read back until flushed"""
+        wal = self._spool()
+        wal.append('tx1', 'begin', {})
+        wal.append('tx1', 'commit', {'step': 'commit'})
+        other = self._spool()
+        self.assertEqual(other.status('tx1'),
+                         ({'status': {'step': 'commit'}}, http.client.OK))
+        self.assertEqual(other.status('tx2'), (None, None))
+        self.assertEqual(other.flush(), 2)
+        self.journal.write_batch.assert_called_with(
+            [('tx1', 'begin', {}), ('tx1', 'commit', {'step': 'commit'})])
+        self.assertEqual(wal.status('tx1'), (None, None))
+
+    def test_partial_flush(self):
+        """ Test entries after a failed write stay spooled"""
+        self.journal.write_batch.side_effect = lambda e: [0, 1]
+        wal = self._spool()
+        wal.append('tx1', 'begin', {})
+        wal.append('tx2', 'begin', {})
+        self.assertEqual(wal.flush(), 1)
+        self.assertEqual(wal.status('tx1'), (None, None))
+        self.assertEqual(wal.status('tx2'), (None, http.client.PROCESSING))
+
+    def test_dead_letter(self):
+        """ Test an entry failing every flush is moved aside"""
+        self.journal.write_batch.side_effect = lambda e: [
+            int(txid == 'tx1') for (txid, _, _) in e]
+        wal = spool.Spool(os.path.join(self.path, 'spool'),
+                          self.journal, batchsize=3, maxattempts=2)
+        wal.append('tx1', 'begin', {'poison': True})
+        wal.append('tx2', 'begin', {})
+        wal.append('tx3', 'begin', {})
+        self.assertEqual(wal.flush(), 0)
+        self.assertEqual(wal.flush(), 3)
+        self.assertEqual(wal.status('tx1'), (None, None))
+        self.assertEqual(wal.status('tx3'), (None, None))
+        with open(os.path.join(self.path, 'spool.dead')) as fin:
+            self.assertEqual(fin.read(),
+                             '["tx1", "begin", {"poison": true}]\n')
+        # Entries are not dead-lettered while the journal is down
+        self.journal.write_batch.side_effect = lambda e: [1] * len(e)
+        wal.append('tx4', 'begin', {})
+        for _ in range(3):
+            self.assertEqual(wal.flush(), 0)
+        self.assertEqual(wal.status('tx4'), (None, http.client.PROCESSING))
+
+    def test_ring(self):
+        """ Test the spool wraps around once flushed and fills up"""
+        wal = self._spool(mmap.PAGESIZE * 2)
+        msg = {'payload': 'x' * 1000}
+        for i in range(10):
+            wal.append('tx{0}'.format(i), 'begin', msg)
+            wal.flush()
+        wal.append('txa', 'begin', msg)
+        wal.append('txb', 'begin', msg)
+        wal.append('txc', 'begin', msg)
+        self.assertRaises(spool.SpoolFull, wal.append, 'txd', 'begin', msg)
+        self.assertEqual(wal.flush(), 3)
+        self.assertEqual(self.journal.write_batch.call_args[0][0][2],
+                         ('txc', 'begin', msg))
+
+
+if __name__ == '__main__':
+    unittest.main()
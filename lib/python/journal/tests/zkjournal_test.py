@@ -2,16 +2,92 @@
 Unit test for zookeeper journal write
 """
 
+import binascii
+import functools
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import json
 import zlib
 import kazoo
 import mock  # pylint: disable=E0401
 
-from journal.zkjournal import ZookeeperJournal, entry_cmp
+from kazoo.protocol.serialization import Create, Delete, Transaction
+from journal.zkjournal import ZookeeperJournal, HISTORY_CACHE
+from journal.zkhistory import HistoryView, entry_cmp, make_snapshot
+from journal.zkfold import (
+    MULTI_HEADER_SIZE, create_op_size, delete_op_size, fold_chunks,
+    fold_schedule, fold_txn_size
+)
+from journal import compression
+from journal import metrics
+from journal import record
+from journal import zkcompact
+from journal import zkexport
+from journal import zkpool
+from journal.zk import utils as zkutils
 from journal.zk.client.zookeeper import ZkClient
 
 
+class _History():
+    """In-memory /history of snapshots, watched and transacted"""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.connected = True
+        self.chroot = None
+        self.watches = []
+
+    def exists(self, path):
+        """Stat of a snapshot, None for the txid nodes"""
+        if path == '/history':
+            return mock.Mock()
+        name = path.split('/')[-1]
+        if not path.startswith('/history/') or name not in self.snapshots:
+            return None
+        return mock.Mock(dataLength=len(self.snapshots[name]), version=0,
+                         ctime=0)
+
+    def get(self, path):
+        """Data and stat of a snapshot"""
+        if self.exists(path) is None:
+            raise kazoo.exceptions.NoNodeError()
+        return (self.snapshots[path.split('/')[-1]], self.exists(path))
+
+    def get_children(self, _path):
+        """Snapshot names"""
+        return list(self.snapshots)
+
+    def ChildrenWatch(self, _path, func):  # pylint: disable=C0103
+        """Call func with the snapshot names now and on changes"""
+        self.watches.append(func)
+        func(self.get_children('/history'))
+
+    def transaction(self):
+        """Transaction applied to the snapshots on commit"""
+        ops = []
+        txn = mock.Mock()
+        txn.create.side_effect = lambda path, value, acl: ops.append(
+            (path, value))
+        txn.delete.side_effect = lambda path, version: ops.append(
+            (path, None))
+        txn.commit.side_effect = lambda: self._commit(ops)
+        return txn
+
+    def _commit(self, ops):
+        for (path, value) in ops:
+            if value is None:
+                del self.snapshots[path.split('/')[-1]]
+            else:
+                self.snapshots[path.split('/')[-1]] = value
+        for func in self.watches:
+            func(self.get_children('/history'))
+        return [path for (path, _) in ops]
+
+
 class ZkjournalTestCase(unittest.TestCase):
     """Mock test for zookeeper journal"""
 
@@ -54,6 +130,498 @@ class ZkjournalTestCase(unittest.TestCase):
         result = entry_cmp(sqlite_file1, sqlite_file2)
         self.assertEqual(result, -1)
 
+    def test_fold_schedule(self):
+        """ Test adaptive fold batch size and interval"""
+        # Full batch: fold again now with a bigger batch, up to the max
+        self.assertEqual(fold_schedule(2000, 2000, 5, 2000, 5000, 5, 300),
+                         (4000, 0))
+        self.assertEqual(fold_schedule(4000, 4000, 0, 2000, 5000, 5, 300),
+                         (5000, 0))
+        # Partial batch: back to the base batch and min interval
+        self.assertEqual(fold_schedule(10, 5000, 0, 2000, 5000, 5, 300),
+                         (2000, 5))
+        # Idle: back off up to the max interval
+        self.assertEqual(fold_schedule(0, 2000, 5, 2000, 5000, 5, 300),
+                         (2000, 10))
+        self.assertEqual(fold_schedule(0, 2000, 160, 2000, 5000, 5, 300),
+                         (2000, 300))
+
+    def test_txn_size(self):
+        """ Test fold transaction size estimate against kazoo encoding"""
+        acl = [zkutils.make_anonymous_acl('rwcda')]
+        create = Create('/chroot/history/sqlite-db#', b'x' * 100, acl, 2)
+        delete = Delete('/chroot/txid/commit', -1)
+        txn = Transaction([create, delete, delete])
+        size = (MULTI_HEADER_SIZE +
+                create_op_size(create.path, create.data, acl) +
+                2 * delete_op_size(delete.path))
+        self.assertEqual(size, len(txn.serialize()))
+
+    def test_fold_chunks(self):
+        """ Test oversize fold batches are split to fit transactions"""
+        acl = [zkutils.make_anonymous_acl('rwcda')]
+
+        def _txnsize(snapshot, nodes):
+            return fold_txn_size(snapshot, nodes, '/chroot', acl)
+
+        rows = [
+            ('host', 'user', 'user', 'date', 'txid%d' % i, 'txid%d' % i,
+             'commit', None, 'rg', 'res', 'verb', None,
+             json.dumps(binascii.hexlify(os.urandom(300)).decode()), None)
+            for i in range(20)
+        ]
+        nodes = ['/txid%d/commit' % i for i in range(20)]
+        chunks = list(fold_chunks(rows, nodes, compression.Codec(),
+                                  _txnsize, 4096))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual([n for (_, chunk) in chunks for n in chunk], nodes)
+        for (snapshot, chunk) in chunks:
+            self.assertTrue(_txnsize(snapshot, chunk) <= 4096)
+        self.assertEqual(list(fold_chunks([], [], compression.Codec(),
+                                          _txnsize, 4096)), [])
+
+    def test_fold_chunks_txids(self):
+        """ Test fold chunks never split the steps of a txid"""
+        acl = [zkutils.make_anonymous_acl('rwcda')]
+        rows = []
+        nodes = []
+        for i in range(10):
+            for step in ('commit', 'begin'):
+                rows.append(
+                    ('host', 'user', 'user', 'date', 'txid%d' % i,
+                     'txid%d' % i, step, None, 'rg', 'res', 'verb', None,
+                     json.dumps(binascii.hexlify(os.urandom(150)).decode()),
+                     None))
+                nodes.append('/txid%d/%s' % (i, step))
+        chunks = list(fold_chunks(
+            rows, nodes, compression.Codec(),
+            lambda snapshot, chunk: fold_txn_size(snapshot, chunk, '', acl),
+            4096))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(sorted(n for (_, chunk) in chunks for n in chunk),
+                         sorted(nodes))
+        for (_, chunk) in chunks:
+            for i in range(10):
+                if '/txid%d/commit' % i in chunk:
+                    self.assertEqual(
+                        chunk.index('/txid%d/begin' % i) + 1,
+                        chunk.index('/txid%d/commit' % i))
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    @mock.patch('kazoo.client.KazooClient.connected',
+                mock.PropertyMock(return_value=True))
+    def test_write_batch(self):
+        """ Test batched writes fall back to single creates on error"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        zkj.zk.create_async = mock.Mock()
+        committed = mock.Mock()
+        committed.get.return_value = [
+            kazoo.exceptions.NodeExistsError(),
+            kazoo.exceptions.RolledBackError()
+        ]
+        zkj.zk.transaction = mock.Mock()
+        zkj.zk.transaction.return_value.commit_async.return_value = committed
+        created = mock.Mock()
+        created.get.side_effect = [
+            '/tx1', '/tx2', kazoo.exceptions.NodeExistsError(),
+            kazoo.exceptions.ConnectionLoss()
+        ]
+        zkj.zk.create_async.return_value = created
+        rcs = zkj.write_batch([('tx1', 'begin', {}), ('tx2', 'begin', {})])
+        self.assertEqual(rcs, [0, 1])
+        self.assertEqual(zkj.zk.transaction.return_value.create.call_count,
+                         2)
+        self.assertEqual(zkj.zk.create_async.call_count, 4)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    @mock.patch('kazoo.client.KazooClient.connected',
+                mock.PropertyMock(return_value=True))
+    def test_export(self):
+        """ Test history export by sequence id and creation time"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        snapshots = {}
+        for seq in range(1, 5):
+            rows = [
+                ('host', 'user', 'user', 'date', 'req', 'tx%d%d' % (seq, i),
+                 'commit', None, 'rg', 'res', 'verb', None, '{}', None)
+                for i in range(3)
+            ]
+            snapshots['sqlite-db#%010d' % seq] = (
+                make_snapshot(rows, zkj.codec),
+                mock.Mock(ctime=seq * 1000))
+        zkj.zk.exists = mock.Mock(
+            side_effect=lambda path: snapshots[path.split('/')[-1]][1]
+            if path.startswith('/history/') else True)
+        zkj.zk.get_children = mock.Mock(
+            return_value=list(reversed(sorted(snapshots))))
+        zkj.zk.get = mock.Mock(
+            side_effect=lambda path: snapshots[path.split('/')[-1]])
+        rows = list(zkj.export(since='0000000002', until='0000000004'))
+        self.assertEqual([row['transaction_id'] for row in rows],
+                         ['tx20', 'tx21', 'tx22', 'tx30', 'tx31', 'tx32'])
+        self.assertEqual(rows[0]['seqid'], '0000000002')
+        self.assertEqual(rows[0]['payload'], {})
+        rows = list(zkj.export(sincetime=4))
+        self.assertEqual(len(rows), 3)
+        # Only the snapshot in range is fetched
+        self.assertEqual(zkj.zk.get.call_count, 3)
+        rows = list(zkj.export(sincetime=2, untiltime=3))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(zkj.zk.get.call_count, 4)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_dump_ingest_error(self):
+        """ Test a snapshot failing history ingest is dumped again"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        row = ('host', 'user', 'user', 'date', 'req', 'tx1', 'commit',
+               None, 'rg', 'res', 'verb', None, '{}', None)
+        zkj.zk.get = mock.Mock(
+            return_value=(make_snapshot([row], zkj.codec), None))
+        history = mock.Mock()
+        history.ingest.side_effect = [sqlite3.Error('locked'), 1, 1]
+        nfspath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, nfspath)
+        nfsregex = re.compile(r'.*#(\d+)\.csv')
+        journals = ['sqlite-db#0000000001', 'sqlite-db#0000000002']
+        zkexport.dump_snapshots(zkj, journals, nfspath, 'journal', nfsregex,
+                                history)
+        self.assertEqual(os.listdir(nfspath), [])
+        self.assertEqual(history.ingest.call_count, 1)
+        zkexport.dump_snapshots(zkj, journals, nfspath, 'journal', nfsregex,
+                                history)
+        self.assertEqual(sorted(os.listdir(nfspath)),
+                         ['journal#0000000001.csv.gz',
+                          'journal#0000000002.csv.gz'])
+        self.assertEqual(
+            [c[0][0] for c in history.ingest.call_args_list],
+            ['0000000001', '0000000001', '0000000002'])
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    @mock.patch('kazoo.client.KazooClient.connected',
+                mock.PropertyMock(return_value=True))
+    def test_warmup(self):
+        """ Test the newest snapshots are loaded in the background"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 2)
+        entries = ['sqlite-db#%010d' % seq for seq in range(1, 5)]
+        HISTORY_CACHE.clear()
+        HISTORY_CACHE[entries[0]] = b'old'
+        zkj.zk.exists = mock.Mock(return_value=True)
+        zkj.zk.get_children = mock.Mock(return_value=list(entries))
+        zkj.zk.get = mock.Mock(
+            side_effect=lambda path: (path.encode(), None))
+        self.assertFalse(zkj.ready.is_set())
+        zkj.warmup()
+        self.assertTrue(zkj.ready.wait(5))
+        self.assertEqual(sorted(HISTORY_CACHE), entries[2:])
+        self.assertEqual(zkj.zk.get.call_count, 2)
+        HISTORY_CACHE.clear()
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_read_sessions(self):
+        """ Test status reads go to the read sessions when up"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50,
+                               readurl='zookeeper://observer#foobar',
+                               readsync=True)
+        reader = mock.Mock(connected=True)
+        reader.exists.side_effect = lambda path: path == '/tx1/commit'
+        reader.get.return_value = (
+            zkj.codec.encode(json.dumps({'step': 'commit'}).encode()), None)
+        zkj.readers.sessions = [reader]
+        zkj.zk = mock.Mock(connected=True)
+        self.assertEqual(zkj.status('tx1'),
+                         ({'status': {'step': 'commit'}}, 200))
+        reader.sync.assert_called_once_with('/')
+        zkj.zk.exists.assert_not_called()
+        # Read sessions down: the main session answers
+        reader.connected = False
+        zkj.readers.start = mock.Mock()
+        zkj.zk.exists.return_value = False
+        zkj.zk.get_children.return_value = []
+        zkj.snapshots.view.start = mock.Mock(return_value=False)
+        self.assertEqual(zkj.status('tx2'), (None, None))
+        self.assertTrue(zkj.zk.exists.called)
+        # Errors of a read session surface and count against it
+        reader.connected = True
+        reader.exists.side_effect = kazoo.exceptions.ConnectionLoss()
+        self.assertEqual(zkj.status('tx1'), (None, None))
+        self.assertEqual(zkj.readers.failures[id(reader)], 1)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(side_effect=lambda *args, **kwargs: mock.Mock(
+                    connected=True, chroot=None)))
+    def test_sessions(self):
+        """ Test writes are spread over the session pool"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50, sessions=2)
+        zkj.pool.start = mock.Mock()
+        for i in range(4):
+            self.assertEqual(zkj.write('tx%d' % i, 'begin', {'n': i}), 0)
+        for zk in zkj.pool.sessions:
+            self.assertEqual(zk.create.call_count, 2)
+            self.assertEqual(zk.create.call_args[1]['acl'], zkj.acl)
+        self.assertIs(zkj.pool.sessions[0], zkj.zk)
+        # Reads see the writes of the other sessions
+        for zk in zkj.pool.sessions:
+            zk.exists.side_effect = lambda path: path == '/tx1/begin'
+        self.assertEqual(zkj.status('tx1'), (None, 102))
+        self.assertEqual(
+            sum(zk.sync.call_count for zk in zkj.pool.sessions), 1)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(side_effect=lambda *args, **kwargs: mock.Mock(
+                    connected=True, chroot=None)))
+    def test_sessions_batch_errors(self):
+        """ Test session errors of batch writes count against it"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50, sessions=2)
+        zkj.acl = []
+        failing = mock.Mock(connected=True, chroot=None)
+        failing.create_async.return_value.get.side_effect = (
+            kazoo.exceptions.ConnectionLoss())
+        commit = failing.transaction.return_value.commit_async.return_value
+        commit.get.side_effect = kazoo.exceptions.ConnectionLoss()
+        zkj.pool.sessions = [failing]
+        entries = [('tx1', 'begin', {})]
+        for _ in range(zkpool.MAX_FAILURES):
+            self.assertEqual(zkj.write_batch(entries), [1])
+        self.assertFalse(zkj.pool.healthy(failing))
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(side_effect=lambda *args, **kwargs: mock.Mock(
+                    connected=True, chroot=None)))
+    @mock.patch('journal.zk.utils.create_container')
+    def test_containers(self, create_container):
+        """ Test txid and lock nodes are made container nodes"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50, containers=True)
+        zkj.zk.create.side_effect = [kazoo.exceptions.NoNodeError(), None]
+        self.assertEqual(zkj.write('tx1', 'begin', {}), 0)
+        create_container.assert_called_once_with(zkj.zk, '/tx1', zkj.acl)
+        self.assertNotIn('makepath', zkj.zk.create.call_args[1])
+
+        lock = mock.Mock(path='/tx1_lock', assured_path=False)
+        self.assertTrue(zkj._create_lock_root(lock))
+        self.assertTrue(lock.assured_path)
+        # Only txid nodes proven to be containers are left to the servers
+        owner = {'/tx1': zkutils.CONTAINER_EPHEMERAL_OWNER, '/tx2': 0}
+        zkj.zk.get_children = mock.Mock(
+            side_effect=lambda path, include_data: (
+                ['commit'], mock.Mock(ephemeralOwner=owner[path])))
+        zkj.zk.Lock = mock.Mock()
+        zkj._create_lock_root = mock.Mock(return_value=True)
+        zkj._create_sqlite = mock.Mock(return_value=(2, 2))
+        zkj.zk.delete = mock.Mock()
+        zkj._fold_journals(['tx1', 'tx2'], 10)
+        zkj._create_sqlite.assert_called_once_with(
+            ['/tx1/commit', '/tx2/commit'], ['tx2'])
+        zkj.zk.delete.assert_not_called()
+
+        # Servers without containers: plain nodes, cleaned up as before
+        create_container.side_effect = kazoo.exceptions.UnimplementedError()
+        zkj.zk.create.side_effect = [kazoo.exceptions.NoNodeError(),
+                                     None, None]
+        self.assertEqual(zkj.write('tx2', 'begin', {}), 0)
+        self.assertFalse(zkj.containers)
+        self.assertEqual(zkj.zk.create.call_args_list[-2],
+                         mock.call('/tx2', acl=zkj.acl))
+        zkj._fold_sqlite_data([], [], ['tx1'])
+        zkj.zk.delete.assert_called_once_with('/tx1')
+
+    def test_create_container(self):
+        """ Test container creates are encoded as create2 requests"""
+        zkc = mock.Mock(chroot='/chroot')
+        zkutils.create_container_async(zkc, '/tx1', [])
+        request = zkc._call.call_args[0][0]
+        self.assertEqual(request.type, 19)
+        self.assertEqual(request.path, '/chroot/tx1')
+        self.assertEqual(request.flags, zkutils.CONTAINER_FLAGS)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    @mock.patch('journal.zkfold.fold_chunks', mock.Mock(return_value=[
+        (b'db', ['/tx1/begin', '/tx1/commit']), (b'db', ['/tx2/begin'])]))
+    def test_fold_committed(self):
+        """ Test only the nodes of committed fold chunks are counted"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        zkj._commit_fold = mock.Mock(side_effect=[True, False])
+        zkj._delete_empty_nodes = mock.Mock()
+        self.assertEqual(zkj._fold_sqlite_data([], [], ['tx1', 'tx2']),
+                         (2, 1))
+        # A failed fold is not taken for a full batch
+        zkj._commit_fold = mock.Mock(return_value=False)
+        self.assertEqual(zkj._fold_sqlite_data([], [], ['tx1', 'tx2']),
+                         (0, 0))
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_shard_gauges(self):
+        """ Test the fold gauges of the shards do not overwrite each other"""
+        for (shard, batchsize) in ((None, 10), ('eu', 20)):
+            zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                                   'adminuser', 50, shard=shard)
+            zkj.zk.exists = mock.Mock(return_value=True)
+            zkj.zk.get_children = mock.Mock(return_value=[])
+            # Stop after the first fold pass
+            with mock.patch.object(ZookeeperJournal, '_wait_for_backlog',
+                                   side_effect=StopIteration):
+                self.assertRaises(StopIteration, zkj.upload_batch,
+                                  batchsize, 60)
+        gauges = metrics.snapshot()
+        self.assertEqual(gauges['fold_batchsize'], 10)
+        self.assertEqual(gauges['fold_batchsize-eu'], 20)
+        self.assertEqual(gauges['fold_backlog-eu'], 0)
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_wait_for_backlog(self):
+        """ Test the backlog of txids is compared with txids"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        wakeup = mock.Mock()
+        wakeup.is_set.return_value = True
+        txids = ['tx%d' % i for i in range(10)]
+        zkj.zk.get_children = mock.Mock(
+            return_value=txids + ['history', 'codec'])
+        with mock.patch('time.sleep') as sleep:
+            zkj._wait_for_backlog(wakeup, 60, 10, 1)
+            sleep.assert_not_called()
+        # Lock nodes left over are not counted
+        zkj.zk.get_children = mock.Mock(
+            return_value=txids[1:] + ['tx0_lock', 'history'])
+        with mock.patch('time.time', side_effect=[0, 0, 60]), \
+                mock.patch('time.sleep') as sleep:
+            zkj._wait_for_backlog(wakeup, 60, 10, 1)
+            sleep.assert_called_once_with(1)
+
+    def test_snapshot_constraints(self):
+        """ Test rows missing a column are not folded in snapshots"""
+        codec = mock.Mock()
+        codec.encode.side_effect = lambda data, use_dictionary: data
+        codec.decode.side_effect = lambda data: data
+        row = ('host', 'user', 'user', 'date', 'req', 'tx1', 'commit',
+               None, 'rg', 'res', 'verb', None, '{}', None)
+        self.assertIsNotNone(make_snapshot([row], codec, binary=True))
+        missing = row[:2] + (None,) + row[3:]
+        self.assertIsNone(make_snapshot([row, missing], codec, binary=True))
+        self.assertIsNone(make_snapshot([row, missing], codec))
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_fold_missing_column(self):
+        """ Test a node missing a column is quarantined, not folded"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50, encoding='binary')
+        msg = {'host': 'host', 'authuser_id': 'user', 'user_id': 'user',
+               'date': 'date', 'request_id': 'tx1', 'transaction_id': 'tx1',
+               'step': 'commit', 'resourcegroup': 'rg', 'resource': 'res',
+               'verb': 'verb', 'payload': {}}
+        nodes = {
+            '/tx1/commit': zkj.codec.encode(record.encode(msg)),
+            '/tx2/commit': zkj.codec.encode(record.encode(
+                dict(msg, request_id='tx2', transaction_id='tx2',
+                     user_id=None))),
+        }
+        zkj.zk.get = mock.Mock(
+            side_effect=lambda path: (nodes[path], mock.Mock(ctime=0)))
+        zkj.zk.create = mock.Mock()
+        zkj.zk.delete = mock.Mock()
+        zkj.zk.transaction = mock.Mock()
+        txn = zkj.zk.transaction.return_value
+        txn.commit.return_value = ['/done']
+        self.assertEqual(zkj._create_sqlite(sorted(nodes), []), (1, 1))
+        self.assertEqual(txn.create.call_args_list[0][0][0],
+                         '/quarantine/tx2.commit')
+        self.assertEqual(txn.create.call_args_list[0][1]['value'],
+                         nodes['/tx2/commit'])
+        self.assertEqual([c[0][0] for c in txn.delete.call_args_list],
+                         ['/tx2/commit', '/tx1/commit'])
+
+    @mock.patch('journal.zk.utils.connect',
+                mock.Mock(return_value=ZkClient()))
+    def test_compaction(self):
+        """ Test compacted snapshots keep their place in the history"""
+        zkj = ZookeeperJournal('zookeeper://dev#foobar', dict(),
+                               'adminuser', 50)
+        HISTORY_CACHE.clear()
+        self.addCleanup(HISTORY_CACHE.clear)
+
+        def _row(txid, step, payload='{}'):
+            return ('host', 'user', 'user', 'date', txid, txid, step,
+                    None, 'rg', 'res', 'verb', None, payload, None)
+
+        big = json.dumps(binascii.hexlify(os.urandom(2000)).decode())
+        snapshots = {
+            'sqlite-db#0000000001': [_row('tx1', 'begin')],
+            'sqlite-db#0000000002': [_row('tx2', 'begin'),
+                                     _row('tx2', 'commit')],
+            'sqlite-db#0000000003': [_row('tx1', 'commit', big)],
+            'sqlite-db#0000000004': [_row('tx3', 'begin')],
+        }
+        zkj.zk = _History({name: make_snapshot(rows, zkj.codec)
+                           for (name, rows) in snapshots.items()})
+        zkj.snapshots.zk = zkj.zk
+        zkj.snapshots.view = HistoryView(zkj.zk)
+
+        def _exported(since=None):
+            return sorted((row['seqid'], row['transaction_id'], row['step'])
+                          for row in zkj.export(since=since))
+
+        self.assertEqual(zkj.status('tx1')[1], 200)
+        exported = _exported()
+        tail = _exported(since='0000000003')
+        targetsize = len(zkj.zk.snapshots['sqlite-db#0000000003']) - 1
+        zkcompact.compact_history(zkj, None, targetsize)
+        self.assertEqual(sorted(zkj.zk.snapshots), [
+            'sqlite-db#0000000002.1', 'sqlite-db#0000000003',
+            'sqlite-db#0000000004'])
+        # The begin merged in an older run does not hide the commit
+        self.assertEqual(zkj.status('tx1')[1], 200)
+        self.assertEqual(zkj.status('tx2')[1], 200)
+        self.assertEqual(zkj.status('tx3')[1], 102)
+        self.assertEqual(
+            [step for (_, _, step) in _exported()],
+            [step for (_, _, step) in exported])
+        self.assertEqual(_exported(since='0000000003'), tail)
+        self.assertEqual(_exported(since='0000000002'),
+                         [('0000000002', 'tx1', 'begin'),
+                          ('0000000002', 'tx2', 'begin'),
+                          ('0000000002', 'tx2', 'commit')] + tail)
+
+    def test_history_view(self):
+        """ Test the watched /history view stays in serial order"""
+        zk = mock.Mock(connected=True)
+        view = HistoryView(zk)
+        self.assertTrue(view.start())
+        update = zk.ChildrenWatch.call_args[0][1]
+        names = ['sqlite-db#2147483646', 'sqlite-db#2147483647',
+                 'sqlite-db#-2147483648', 'lock', 'sqlite-db#-2147483647']
+        update(names[:2])
+        self.assertEqual(view.entries,
+                         ('sqlite-db#2147483647', 'sqlite-db#2147483646'))
+        # Sequence numbers wrapped around
+        update(names)
+        self.assertEqual(view.entries, (
+            'sqlite-db#-2147483647', 'sqlite-db#-2147483648',
+            'sqlite-db#2147483647', 'sqlite-db#2147483646'))
+        update(names[1:])
+        self.assertEqual(view.entries, (
+            'sqlite-db#-2147483647', 'sqlite-db#-2147483648',
+            'sqlite-db#2147483647'))
+        expected = sorted(view.entries, key=functools.cmp_to_key(entry_cmp),
+                          reverse=True)
+        self.assertEqual(list(view.entries), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,98 @@
+"""
+Unit test for zookeeper session pool
+"""
+
+import unittest
+
+import kazoo.exceptions
+import mock  # pylint: disable=E0401
+
+from journal import zkpool
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    """Test for zookeeper session pool"""
+
+    def setUp(self):
+        self.main = mock.Mock(connected=True)
+        with mock.patch('journal.zk.utils.connect',
+                        side_effect=lambda url: mock.Mock(connected=True)):
+            self.pool = zkpool.SessionPool('zookeeper://dev#foobar',
+                                           size=3, sessions=[self.main])
+
+    def test_least_loaded(self):
+        """ Test requests go to the sessions with the fewest in flight"""
+        sessions = self.pool.sessions
+        self.assertIs(sessions[0], self.main)
+        with self.pool.session() as first:
+            with self.pool.session() as second:
+                with self.pool.session() as third:
+                    self.assertEqual(len({first, second, third}), 3)
+                with self.pool.session() as fourth:
+                    self.assertIs(fourth, third)
+        sessions[1].connected = False
+        for _ in range(4):
+            with self.pool.session() as zk:
+                self.assertIsNot(zk, sessions[1])
+        for zk in sessions:
+            zk.connected = False
+        self.pool.start = mock.Mock()
+        with self.pool.session() as zk:
+            self.assertIsNone(zk)
+        self.pool.start.assert_called_once_with()
+
+    def test_health(self):
+        """ Test sessions failing repeatedly are set aside"""
+        failing = self.pool.sessions[1]
+        for _ in range(zkpool.MAX_FAILURES):
+            while True:
+                try:
+                    with self.pool.session() as zk:
+                        if zk is failing:
+                            raise kazoo.exceptions.ConnectionLoss()
+                except kazoo.exceptions.ConnectionLoss:
+                    break
+        # Request errors say nothing about the session
+        with self.assertRaises(kazoo.exceptions.NodeExistsError):
+            with self.pool.session() as zk:
+                raise kazoo.exceptions.NodeExistsError()
+        self.assertFalse(self.pool.healthy(failing))
+        for _ in range(6):
+            with self.pool.session() as zk:
+                self.assertIsNot(zk, failing)
+        # Used again when the others are down
+        self.pool.sessions[0].connected = False
+        self.pool.sessions[2].connected = False
+        with self.pool.session() as zk:
+            self.assertIs(zk, failing)
+        listener = failing.add_listener.call_args[0][0]
+        listener('CONNECTED')
+        self.assertTrue(self.pool.healthy(failing))
+
+    def test_start(self):
+        """ Test lost sessions are started in the background"""
+        lost = self.pool.sessions[1]
+        lost.state = 'LOST'
+        self.main.state = 'LOST'
+        self.pool.sessions[2].state = 'CONNECTED'
+        with mock.patch('journal.zkpool.threading.Thread') as thread:
+            self.pool.start()
+        thread.return_value.start.assert_called_once_with()
+        # One pass of the starter thread
+        run = thread.call_args[1]['target']
+        with mock.patch('time.sleep', side_effect=StopIteration):
+            self.assertRaises(StopIteration, run)
+        lost.start.assert_called_once_with(timeout=zkpool.START_TIMEOUT)
+        self.main.start.assert_not_called()
+        self.pool.sessions[2].start.assert_not_called()
+
+    def test_stop(self):
+        """ Test adopted sessions are left to their owner"""
+        self.pool.stop()
+        self.main.stop.assert_not_called()
+        for zk in self.pool.sessions[1:]:
+            zk.stop.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
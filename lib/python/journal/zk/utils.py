@@ -8,6 +8,7 @@ import kazoo
 import kazoo.client
 import kazoo.exceptions
 import kazoo.security
+from kazoo.protocol.serialization import Create2
 from kazoo.client import (
     NodeExistsError,
     NoNodeError,
@@ -19,6 +20,25 @@ from . import client as zkclient
 
 _LOG = logging.getLogger(__name__)
 
+# CreateMode.CONTAINER
+CONTAINER_FLAGS = 4
+# Stat ephemeralOwner of container nodes (EphemeralType.CONTAINER)
+CONTAINER_EPHEMERAL_OWNER = -2 ** 63
+
+
+class CreateContainer(Create2):
+    """Create request of a container node (zookeeper 3.5.3+), deleted
+    by the server some time after its last child is.
+    """
+    __slots__ = ()
+    type = 19
+
+
+def is_container(stat):
+    """Whether the node of stat is a container node.
+    """
+    return stat.ephemeralOwner == CONTAINER_EPHEMERAL_OWNER
+
 
 ###############################################################################
 def connect(zkurl, **connargs):
@@ -67,6 +87,26 @@ def make_anonymous_acl(perm):
     )
 
 
+def create_container_async(zkc, path, acl=None):
+    """Create a container node, kazoo has no call for it.
+
+    Servers not supporting them fail with UnimplementedError.
+    """
+    async_result = zkc.handler.async_result()
+    # pylint: disable=protected-access
+    zkc._call(
+        CreateContainer((zkc.chroot or '') + path, b'',
+                        acl or zkc.default_acl, CONTAINER_FLAGS),
+        async_result
+    )
+    return async_result
+
+
+def create_container(zkc, path, acl=None):
+    """Create a container node."""
+    return create_container_async(zkc, path, acl).get()
+
+
 def _parse_zkurl(zkurl):
     """
     """
@@ -83,6 +123,9 @@ def _parse_zkurl(zkurl):
 __all__ = (
     'connect',
     'ConnectionClosedError',
+    'create_container',
+    'create_container_async',
+    'is_container',
     'make_anonymous_acl',
     'NodeExistsError',
     'NoNodeError',
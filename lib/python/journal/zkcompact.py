@@ -0,0 +1,88 @@
+"""
+Compaction of the zookeeper journal history
+
+Runs of small adjacent /history snapshots not dumped yet are merged
+into snapshots of up to a target size, each in one transaction.
+"""
+import functools
+import logging
+from journal import zkfold
+from journal import zkhistory
+
+_LOG = logging.getLogger(__name__)
+
+
+def compact_history(zkj, lastid, targetsize):
+    """
+    Walk the undumped sqlite nodes of journal zkj in sequence order
+    and merge each run of small adjacent nodes
+    """
+    entries = zkj.zk.get_children('/history')
+    entries.sort(key=functools.cmp_to_key(zkhistory.entry_cmp))
+    run = []
+    runsize = 0
+    for entry in entries:
+        seqid = zkhistory.snapshot_seqid(entry)
+        if zkhistory.sequence_cmp(lastid, seqid) >= 0:
+            # Already dumped, cleanup takes care of it
+            continue
+        stat = zkj.zk.exists('/history/' + entry)
+        if stat is None:
+            continue
+        if runsize + stat.dataLength > targetsize:
+            merge_snapshots(zkj, run)
+            run = []
+            runsize = 0
+        if stat.dataLength < targetsize:
+            run.append(entry)
+            runsize += stat.dataLength
+    merge_snapshots(zkj, run)
+
+
+def merge_snapshots(zkj, entries):
+    """
+    Replace sqlite nodes by a single node holding all their rows,
+    in one transaction. The merged node takes the place of the
+    newest one in the sequence order, so snapshots created since
+    the run still sort after it.
+    """
+    if len(entries) < 2:
+        return
+    rows = []
+    versions = []
+    for entry in entries:
+        data, stat = zkj.zk.get('/history/' + entry)
+        conn = zkhistory.load_snapshot(data, zkj.codec)
+        rows.extend(tuple(row)
+                    for row in conn.execute(zkhistory.SQLITE_SELECT_ALL))
+        conn.close()
+        versions.append(stat.version)
+    snapshot = zkhistory.make_snapshot(rows, zkj.codec, zkj.binary)
+    if snapshot is None:
+        return
+    childnode = '/history/' + zkhistory.compacted_name(entries[-1])
+    chroot = zkj.zk.chroot or ''
+    size = zkfold.MULTI_HEADER_SIZE + zkfold.create_op_size(
+        chroot + childnode, snapshot, zkj.acl)
+    size += sum(zkfold.delete_op_size(chroot + '/history/' + entry)
+                for entry in entries)
+    if size > zkj.maxtxnsize:
+        _LOG.info('Merged snapshot of %r too big (%d bytes)',
+                  entries, size)
+        return
+    transaction = zkj.zk.transaction()
+    transaction.create(childnode, value=snapshot, acl=zkj.acl)
+    for (entry, version) in zip(entries, versions):
+        transaction.delete('/history/' + entry, version=version)
+    results = transaction.commit()
+    if any((isinstance(e, Exception) for e in results)):
+        _LOG.error('Transaction commit error - %r', results)
+        return
+    _LOG.info('Compacted %d sqlite nodes (%d rows) into %s',
+              len(entries), len(rows), results[0])
+
+
+__all__ = (
+    'compact_history',
+    'merge_snapshots',
+)
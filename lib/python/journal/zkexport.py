@@ -0,0 +1,200 @@
+"""
+Export and dump of the zookeeper journal history
+
+The /history snapshots are streamed as rows, or dumped to csv files
+on NFS named after their sequence id, which tells where the next dump
+starts.
+"""
+import contextlib
+import csv
+import errno
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import kazoo.exceptions
+from journal import zkhistory
+
+_LOG = logging.getLogger(__name__)
+
+CSV_COLUMNS = ['transaction_id',
+               'request_id',
+               'step',
+               'host',
+               'resource',
+               'verb',
+               'pk',
+               'date',
+               'user_id',
+               'authuser_id',
+               'role',
+               'cm',
+               'payload']
+
+
+def export_rows(zkj, entries, since, until, sincetime, untiltime):
+    """
+    Rows of the /history snapshots entries of journal zkj, see
+    ZookeeperJournal.export
+    """
+    for entry in entries:
+        seqid = zkhistory.snapshot_seqid(entry)
+        if seqid is None:
+            continue
+        if since is not None and zkhistory.sequence_cmp(seqid, since) < 0:
+            continue
+        if until is not None and zkhistory.sequence_cmp(seqid, until) >= 0:
+            break
+        path = '/history/' + entry
+        if sincetime is not None or untiltime is not None:
+            # Filter on the stat before fetching the snapshot
+            stat = zkj.zk.exists(path)
+            if stat is None or not _in_range(stat.ctime / 1000,
+                                             sincetime, untiltime):
+                continue
+        try:
+            data, _ = zkj.zk.get(path)
+        except kazoo.exceptions.NoNodeError:
+            # Compacted or cleaned up since listed
+            continue
+        conn = zkhistory.load_snapshot(data, zkj.codec)
+        del data
+        try:
+            for row in conn.execute(zkhistory.SQLITE_SELECT_ALL):
+                actual_data = {key: row[key] for key in row.keys()}
+                actual_data['seqid'] = seqid
+                actual_data['role'] = actual_data.pop('as_role')
+                if actual_data['payload'] is not None:
+                    actual_data['payload'] = json.loads(
+                        actual_data['payload'])
+                yield zkj.rehydrate(actual_data)
+        finally:
+            conn.close()
+
+
+def _in_range(ctime, sincetime, untiltime):
+    return ((sincetime is None or ctime >= sincetime) and
+            (untiltime is None or ctime < untiltime))
+
+
+@contextlib.contextmanager
+def dump_lock(lockfile):
+    """
+    Hold the NFS dump lock file, yield whether it was acquired
+    """
+    with open(lockfile, 'w') as f:
+        try:
+            fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                # this is another file operation exception
+                _LOG.exception(
+                    'Error in acquiring lock for dump function')
+            # otherwise this is a lock fail, just skip
+            yield False
+            return
+        yield True
+
+
+def dump_snapshots(zkj, journals, nfspath, prefix, nfsregex, history=None):
+    """
+    Dump the /history snapshots journals of journal zkj newer than the
+    last one dumped to prefix#<seqid>.csv.gz files, and to the history
+    store if given
+    """
+    lastid = last_dumped(nfspath, prefix, nfsregex)
+    for journal in journals:
+        jseqid = zkhistory.snapshot_seqid(journal)
+        if zkhistory.sequence_cmp(lastid, jseqid) < 0:
+            try:
+                data, _ = zkj.zk.get('/history/' + journal)
+            except kazoo.exceptions.KazooException as err:
+                _LOG.exception('Error in zk %s', err)
+                continue
+            conn = zkhistory.load_snapshot(data, zkj.codec)
+            rows = conn.execute(zkhistory.SQLITE_SELECT_ALL).fetchall()
+            conn.close()
+            if history is not None:
+                # Sequence ids of different shards collide
+                historyid = jseqid
+                if zkj.shard:
+                    historyid = '{0}-{1}'.format(zkj.shard, jseqid)
+                try:
+                    history.ingest(historyid, rows)
+                except sqlite3.Error:
+                    # The csv file records the dump position: not
+                    # written, this snapshot is retried next dump
+                    _LOG.exception('Error adding %s to history', journal)
+                    return
+            csvfilename = prefix + '#' + jseqid + '.csv'
+            csvfile = os.path.join(nfspath, csvfilename)
+            try:
+                with open(csvfile, "a") as outputfile:
+                    writer = csv.DictWriter(
+                        outputfile,
+                        fieldnames=CSV_COLUMNS)
+                    writer.writeheader()
+            except IOError as err:
+                _LOG.exception('Error in writing to NFS %s', err)
+                continue
+            for row in rows:
+                actual_data = {key: row[key] for key in row.keys()}
+                _write_csv_row(csvfile, actual_data)
+            lastid = jseqid
+            gzipcsvfile = csvfile + '.gz'
+            try:
+                with open(
+                        csvfile, 'rb') as f_in, gzip.open(
+                            gzipcsvfile, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            # W0703: (broad-except)
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception('failed to gzip %s', csvfile)
+                os.chmod(csvfile, 0o644)
+            else:
+                os.chmod(gzipcsvfile, 0o644)
+                os.remove(csvfile)
+
+
+def last_dumped(nfspath, prefix, nfsregex):
+    """
+    Sequence id of the last snapshot dumped to nfspath
+    """
+    lastid = None
+    pattern = '{0}/{1}#*'.format(nfspath, prefix)
+    files = glob.glob(pattern)
+    for jfile in files:
+        result = nfsregex.match(jfile)
+        if result:
+            if lastid is None:
+                lastid = result.groups()[0]
+            if int(lastid) < int(result.groups()[0]):
+                lastid = result.groups()[0]
+    return lastid
+
+
+def _write_csv_row(csvfile, dict_data):
+    # Converting journal data to splunk specific data
+    dict_data['role'] = dict_data['as_role']
+    dict_data['pk'] = dict_data['resourcepk']
+    del dict_data['as_role']
+    del dict_data['resourcepk']
+    del dict_data['resourcegroup']
+    try:
+        with open(csvfile, "a") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=CSV_COLUMNS)
+            writer.writerow(dict_data)
+    except IOError as err:
+        _LOG.exception('Error in writing to NFS %s', err)
+
+
+__all__ = (
+    'dump_lock',
+    'dump_snapshots',
+    'export_rows',
+    'last_dumped',
+)
@@ -0,0 +1,117 @@
+"""
+Fold of the zookeeper journal nodes in /history snapshots
+
+A fold creates a snapshot and deletes the nodes it holds in one
+multi-op transaction, which zookeeper drops beyond jute.maxbuffer: the
+sizes of the operations are worked out as kazoo encodes them.
+"""
+import collections
+import logging
+from journal import zkhistory
+
+_LOG = logging.getLogger(__name__)
+
+# Zookeeper drops requests bigger than jute.maxbuffer (default 0xfffff),
+# keep some room for the request and packet headers.
+JUTE_MAXBUFFER = 0xfffff
+TXN_MAX_BYTES = JUTE_MAXBUFFER - 1024
+
+# Multi-op header: type (int), done (bool), err (int)
+MULTI_HEADER_SIZE = 9
+
+
+def fold_chunks(batchdata, journalwritten, codec, txnsize, maxtxnsize,
+                binary=False):
+    """
+    Split a fold batch into (snapshot, nodes) chunks whose
+    snapshot create + node deletes fit in one transaction.
+    The steps of a txid go in the same chunk, begin first, so no
+    snapshot holds a begin newer than its commit or abort.
+    txnsize(snapshot, nodes) gives the size of a chunk transaction.
+    """
+    txids = collections.OrderedDict()
+    for (row, node) in zip(batchdata, journalwritten):
+        txids.setdefault(node.split('/')[1], []).append((row, node))
+    pending = [[
+        sorted(steps, key=lambda item: item[1].split('/')[2] != 'begin')
+        for steps in txids.values()
+    ]] if txids else []
+    while pending:
+        groups = pending.pop(0)
+        rows = [row for steps in groups for (row, _) in steps]
+        nodes = [node for steps in groups for (_, node) in steps]
+        snapshot = zkhistory.make_snapshot(rows, codec, binary)
+        if snapshot is None:
+            continue
+        size = txnsize(snapshot, nodes)
+        if size <= maxtxnsize:
+            yield (snapshot, nodes)
+            continue
+        if len(groups) == 1:
+            _LOG.error('Journal nodes %s do not fit in a '
+                       'transaction (%d bytes)', nodes, size)
+            continue
+        pieces = min(len(groups), -(-size // maxtxnsize))
+        step = -(-len(groups) // pieces)
+        _LOG.info('Splitting fold of %d txids (%d bytes) in %d',
+                  len(groups), size, pieces)
+        pending[0:0] = [
+            groups[i:i + step] for i in range(0, len(groups), step)
+        ]
+
+
+def fold_txn_size(snapshot, nodes, chroot, acl):
+    """
+    Encoded size of the snapshot create + deletes transaction
+    """
+    size = MULTI_HEADER_SIZE
+    size += create_op_size(chroot + '/history/sqlite-db#', snapshot, acl)
+    for node in nodes:
+        size += delete_op_size(chroot + node)
+    return size
+
+
+def _string_size(value):
+    return 4 + len(value.encode())
+
+
+def create_op_size(path, value, acl):
+    """
+    Encoded size of a create operation in a multi-op transaction
+    """
+    size = MULTI_HEADER_SIZE + _string_size(path) + 4 + len(value)
+    size += 4
+    for entry in acl:
+        size += 4 + _string_size(entry.id.scheme) + _string_size(entry.id.id)
+    return size + 4
+
+
+def delete_op_size(path):
+    """
+    Encoded size of a delete operation in a multi-op transaction
+    """
+    return MULTI_HEADER_SIZE + _string_size(path) + 4
+
+
+def fold_schedule(folded, foldsize, delay,
+                  batchsize, maxbatchsize, mininterval, maxinterval):
+    """
+    Work out the next fold batch size and pause in seconds
+    from the number of nodes folded by the last pass
+    """
+    if folded >= foldsize:
+        # Batch was full, there is a backlog: fold again right away
+        return (min(foldsize * 2, maxbatchsize), 0)
+    if folded:
+        return (batchsize, mininterval)
+    # Idle, back off
+    return (batchsize, min(max(delay * 2, mininterval), maxinterval))
+
+
+__all__ = (
+    'create_op_size',
+    'delete_op_size',
+    'fold_chunks',
+    'fold_schedule',
+    'fold_txn_size',
+)
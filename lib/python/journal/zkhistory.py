@@ -0,0 +1,475 @@
+"""
+Snapshots of the zookeeper journal history
+
+Folded journal nodes are kept under /history as sequential nodes, each
+a compressed snapshot: a sqlite dump, or binary rows. Sequence ids wrap
+around and are compared in serial number arithmetic.
+"""
+import functools
+import heapq
+import http.client
+import json
+import logging
+import re
+import sqlite3
+import threading
+import kazoo.exceptions
+from journal import record
+
+_LOG = logging.getLogger(__name__)
+
+# Max zk sequence number is 2**32 (signed integer)
+# SERIAL_BITS defines the size of sliding window
+SERIAL_BITS = 32
+# HistoryView keys drifting further from their base get recomputed
+SERIAL_REBASE = 2**(SERIAL_BITS - 2)
+
+SQLITE_CREATE = """
+      CREATE TABLE IF NOT EXISTS journal (
+          id             INTEGER PRIMARY KEY AUTOINCREMENT,
+          date           DATETIME DEFAULT CURRENT_TIMESTAMP,
+          authuser_id    VARCHAR(64)   NOT NULL,
+          user_id        VARCHAR(64)   NOT NULL,
+          as_role        VARCHAR(16)   NULL,
+          request_id     VARCHAR(36)   NOT NULL,
+          transaction_id VARCHAR(36)   NOT NULL,
+          step           VARCHAR(16)   NOT NULL,
+          host           VARCHAR(254)  NOT NULL,
+          resource       VARCHAR(64)   NOT NULL,
+          resourcegroup  VARCHAR(64)   NOT NULL,
+          verb           VARCHAR(64)   NOT NULL,
+          resourcepk     VARCHAR(128)  NULL,
+          payload        TEXT          NULL,
+          cm             VARCHAR(20)   NULL
+      )"""
+
+SQLITE_INSERT = """
+      INSERT INTO journal (
+          host, authuser_id, user_id, date,
+          request_id, transaction_id,
+          step, as_role,
+          resourcegroup, resource, verb, resourcepk,
+          payload, cm
+      )
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Rows of SQLITE_INSERT, indexes of the NOT NULL columns
+SQLITE_NOT_NULL = (0, 1, 2, 4, 5, 6, 8, 9, 10)
+
+SQLITE_SELECT = """
+    SELECT host, authuser_id, user_id, date,
+    request_id, transaction_id, step, as_role,
+    resourcegroup, resource, verb, resourcepk, payload, cm
+    FROM journal WHERE request_id=? AND
+    step=?
+    """
+
+SQLITE_SELECT_ALL = """
+    SELECT host, authuser_id, user_id, date,
+    request_id, transaction_id, step, as_role,
+    resourcegroup, resource, verb, resourcepk, payload, cm
+    FROM journal
+    """
+
+
+# Compacted snapshots keep the sequence id of the newest snapshot they
+# merge, with a generation suffix
+SQLITE_NODE_REGEX = re.compile(r'^sqlite-db#(-?\d+)(?:\.(\d+))?$')
+
+
+def make_snapshot(batchdata, codec, binary=False):
+    """
+    Build the compressed sqlite snapshot of journal rows
+    """
+    # Snapshots are big enough to compress well without the dictionary
+    if binary and all(row[i] is not None
+                      for row in batchdata for i in SQLITE_NOT_NULL):
+        # Rows breaking the constraints fail in sqlite below
+        data = record.encode_rows(batchdata)
+        if data is not None:
+            return codec.encode(data, use_dictionary=False)
+    conn = sqlite3.connect(":memory:")
+    try:
+        with conn:
+            conn.execute(SQLITE_CREATE)
+            conn.executemany(
+                SQLITE_INSERT, batchdata)
+    except sqlite3.IntegrityError:
+        _LOG.exception('Error in inserting data to sqlite')
+        conn.close()
+        return None
+    fdata = '\n'.join(conn.iterdump())
+    conn.close()
+    return codec.encode(fdata.encode(), use_dictionary=False)
+
+
+def load_snapshot(data, codec):
+    """
+    Load a compressed sqlite snapshot in an in-memory db
+    """
+    data = codec.decode(data)
+    conn = sqlite3.connect(":memory:")
+    if data[:len(record.ROWS_MAGIC)] == record.ROWS_MAGIC:
+        conn.execute(SQLITE_CREATE)
+        conn.executemany(SQLITE_INSERT, record.decode_rows(data))
+    else:
+        conn.executescript(data.decode())
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def snapshot_status(conn, txid):
+    """
+    Status of txid in a loaded snapshot
+    """
+    for step in ('commit', 'abort'):
+        row = conn.execute(SQLITE_SELECT, (txid, step)).fetchone()
+        if row is not None:
+            actual_data = {key: row[key] for key in row.keys()}
+            actual_data['payload'] = json.loads(actual_data['payload'])
+            return (actual_data, http.client.OK)
+    row = conn.execute(SQLITE_SELECT, (txid, 'begin')).fetchone()
+    if row is not None:
+        return (None, http.client.PROCESSING)
+    return (None, None)
+
+
+class HistoryCache():
+    """
+    Status lookups in the /history snapshots, newest first. The newest
+    cachesize snapshots are kept in cache, decoded once in shared for
+    all the workers if given.
+    """
+    def __init__(self, zk, codec, cachesize, cache, lock, shared=None):
+        self.zk = zk
+        self.codec = codec
+        self.cachesize = cachesize
+        self.cache = cache
+        # Snapshots are cached and evicted from request threads and
+        # the warmup
+        self.lock = lock
+        self.shared = shared
+        self.view = HistoryView(zk)
+
+    def warm(self):
+        """
+        Fetch and cache the newest cachesize snapshots not cached yet,
+        return the number of snapshots in the cache
+        """
+        if not self.cachesize:
+            return 0
+        entries = self.entries()
+        if entries is None:
+            return 0
+        entries = entries[:self.cachesize]
+        for entry in entries:
+            if self.shared is not None:
+                if self.shared.snapshot(entry) is not None:
+                    continue
+            elif self._cached(entry):
+                continue
+            try:
+                data, _ = self.zk.get('/history/' + entry)
+            except kazoo.exceptions.NoNodeError:
+                continue
+            if self.shared is not None:
+                decoded = load_snapshot(data, self.codec)
+                self.shared.put_snapshot(entry, decoded)
+                decoded.close()
+            else:
+                with self.lock:
+                    self.cache[entry] = data
+        if self.shared is not None:
+            self.shared.retain(entries)
+        else:
+            self._evict(entries)
+        return len(entries)
+
+    def status(self, txid, zk=None):
+        """
+        Status of txid in the snapshots, (None, None) if not found
+        """
+        zk = zk or self.zk
+        if self.shared is not None:
+            return self._shared_status(txid, zk)
+        with self.lock:
+            cached = sorted(self.cache.items(), reverse=True,
+                            key=functools.cmp_to_key(
+                                lambda a, b: entry_cmp(a[0], b[0])))
+        # Newest first, a begin folded before its commit is not taken
+        # for the status
+        for (_, data) in cached:
+            (status, code) = self._snapshot_status(data, txid)
+            if code is not None:
+                return (status, code)
+        entries = self.entries(zk)
+        if entries is not None:
+            (status, code) = self._update_cache(entries, txid, zk)
+            if code is not None:
+                return (status, code)
+        return (None, None)
+
+    def entries(self, zk=None):
+        """
+        /history snapshots newest first, None if there is no /history.
+        Served from the watched view once /history exists.
+        """
+        if self.view.start():
+            return self.view.entries
+        zk = zk or self.zk
+        if not zk.exists('/history'):
+            return None
+        entries = zk.get_children('/history')
+        entries.sort(key=functools.cmp_to_key(entry_cmp), reverse=True)
+        return entries
+
+    def _shared_status(self, txid, zk):
+        """
+        Look txid up in the /history snapshots, the newest decoded once
+        in the shared cache for all the workers
+        """
+        entries = self.entries(zk)
+        if entries is None:
+            return (None, None)
+        cached = entries[:self.cachesize]
+        added = False
+        (status, code) = (None, None)
+        for (index, entry) in enumerate(entries):
+            conn = None
+            if index < len(cached):
+                conn = self.shared.snapshot(entry)
+            if conn is None:
+                try:
+                    data, _ = zk.get('/history/' + entry)
+                except kazoo.exceptions.NoNodeError:
+                    # Compacted or cleaned up since listed
+                    continue
+                decoded = load_snapshot(data, self.codec)
+                if index < len(cached):
+                    conn = self.shared.put_snapshot(entry, decoded)
+                    added = True
+                if conn is None:
+                    (status, code) = snapshot_status(decoded, txid)
+                else:
+                    (status, code) = snapshot_status(conn, txid)
+                decoded.close()
+            else:
+                (status, code) = snapshot_status(conn, txid)
+            if code is not None:
+                break
+        if added:
+            self.shared.retain(cached)
+        return (status, code)
+
+    def _snapshot_status(self, sqlite_data, txid):
+        conn = load_snapshot(sqlite_data, self.codec)
+        try:
+            return snapshot_status(conn, txid)
+        finally:
+            conn.close()
+
+    def _update_cache(self, entries, txid, zk=None):
+        zk = zk or self.zk
+        _LOG.debug('number of entries %d', len(entries))
+        if not entries:
+            with self.lock:
+                self.cache.clear()
+            return (None, None)
+        _LOG.debug('entries are %r', entries)
+        # cleanup cache first
+        self._evict(entries[:self.cachesize])
+        # check for data and fill the cache
+        status = None
+        code = None
+        with self.lock:
+            current_cache_size = len(self.cache)
+        for entry in entries:
+            if self._cached(entry):
+                continue
+            try:
+                data, _ = zk.get('/history/' + entry)
+            except kazoo.exceptions.NoNodeError:
+                # Compacted or cleaned up since listed
+                continue
+            if current_cache_size < self.cachesize:
+                with self.lock:
+                    self.cache[entry] = data
+                current_cache_size += 1
+            if code is None:
+                (status, code) = self._snapshot_status(data, txid)
+            if code is not None and current_cache_size >= self.cachesize:
+                break
+        if code is not None:
+            return (status, code)
+        return (None, None)
+
+    def _cached(self, entry):
+        with self.lock:
+            return entry in self.cache
+
+    def _evict(self, entries):
+        """
+        Drop cached snapshots other than entries: older ones, and those
+        compacted or cleaned up
+        """
+        kept = set(entries)
+        with self.lock:
+            for key in list(self.cache.keys()):
+                if key not in kept:
+                    del self.cache[key]
+
+
+class HistoryView():
+    """
+    /history snapshots sorted newest first, kept up to date by a child
+    watch. Snapshot names are parsed once into serial number keys
+    relative to a base sequence id, so they sort as plain integers.
+    """
+    def __init__(self, zk):
+        self.zk = zk
+        self.lock = threading.Lock()
+        self.startlock = threading.Lock()
+        self.watch = None
+        self.base = None
+        self.keys = {}
+        # Replaced as a whole on updates, readers need no lock
+        self.entries = ()
+
+    def start(self):
+        """
+        Start watching /history if it exists, return whether watching
+        """
+        if self.watch is not None:
+            return True
+        # The watch calls _update right away, which takes self.lock
+        with self.startlock:
+            if self.watch is None:
+                if not self.zk.connected or not self.zk.exists('/history'):
+                    return False
+                self.watch = self.zk.ChildrenWatch('/history', self._update)
+        return True
+
+    def _key(self, seqid):
+        return serial_key(int(seqid), self.base)
+
+    def _update(self, children):
+        with self.lock:
+            names = set(children)
+            removed = [name for name in self.keys if name not in names]
+            for name in removed:
+                del self.keys[name]
+            added = []
+            for name in names:
+                if name in self.keys:
+                    continue
+                seqid = snapshot_seqid(name)
+                if seqid is None:
+                    continue
+                if self.base is None:
+                    self.base = int(seqid)
+                added.append((self._key(seqid), name))
+            if not added and not removed:
+                return
+            self.keys.update((name, key) for (key, name) in added)
+            if any(abs(key) > SERIAL_REBASE for (key, _) in added):
+                # The window moved far from the base, start again from
+                # the newest snapshot
+                self.base = int(snapshot_seqid(
+                    max(added, key=lambda item: item[0])[1]))
+                self.keys = {
+                    name: self._key(snapshot_seqid(name))
+                    for name in self.keys
+                }
+                self.entries = tuple(sorted(self.keys, key=self.keys.get,
+                                            reverse=True))
+                return
+            if removed:
+                kept = (name for name in self.entries if name in self.keys)
+            else:
+                kept = iter(self.entries)
+            added.sort(reverse=True)
+            self.entries = tuple(heapq.merge(
+                kept, (name for (_, name) in added),
+                key=self.keys.get, reverse=True))
+
+
+def serial_key(seqid, base):
+    """
+    Integer sort key of a sequence id, in serial number arithmetic
+    relative to base
+    """
+    return (seqid - base + 2**(SERIAL_BITS - 1)) % 2**SERIAL_BITS - \
+        2**(SERIAL_BITS - 1)
+
+
+def snapshot_seqid(journal):
+    """
+    Sequence id of a snapshot name, None if not a snapshot
+    """
+    result = SQLITE_NODE_REGEX.match(journal)
+    if result:
+        return result.groups()[0]
+    else:
+        return None
+
+
+def compacted_name(entry):
+    """
+    Name of the node merging a run of snapshots up to entry: the
+    sequence id of entry with the next generation, a name not cached
+    for the snapshot it replaces
+    """
+    result = SQLITE_NODE_REGEX.match(entry)
+    generation = int(result.groups()[1] or 0) + 1
+    return 'sqlite-db#{0}.{1}'.format(result.groups()[0], generation)
+
+
+def entry_cmp(sqlite_file1, sqlite_file2):
+    """
+    Compare two sqlite file entries
+    in zookeeper to know the ordering
+    """
+    seq_id1 = snapshot_seqid(sqlite_file1)
+    seq_id2 = snapshot_seqid(sqlite_file2)
+    return sequence_cmp(seq_id1, seq_id2)
+
+
+def sequence_cmp(seqid1, seqid2):
+    """
+    Serial number arithmetic
+    """
+    if seqid1 == seqid2:
+        return 0
+    if seqid1 is None:
+        return -1
+    if seqid2 is None:
+        return 1
+    seq_id1 = int(seqid1)
+    seq_id2 = int(seqid2)
+    if (
+            (
+                seq_id1 < seq_id2 and (
+                    seq_id2 - seq_id1) < 2**(SERIAL_BITS - 1)
+            ) or
+            (
+                seq_id1 > seq_id2 and (
+                    seq_id1 - seq_id2) > 2**(SERIAL_BITS - 1)
+            )
+    ):
+        return -1
+    else:
+        return 1
+
+
+__all__ = (
+    'HistoryCache',
+    'HistoryView',
+    'compacted_name',
+    'entry_cmp',
+    'load_snapshot',
+    'make_snapshot',
+    'sequence_cmp',
+    'serial_key',
+    'snapshot_seqid',
+    'snapshot_status',
+)
@@ -1,94 +1,46 @@
 """
 Module for zookeeper journal
 """
-import csv
-import errno
-import fcntl
+import collections
+import contextlib
 import functools
-import glob
-import gzip
 import http.client
-import json
 import logging
 import os
-import re
-import shutil
-import sqlite3
 import sys
+import threading
 import time
-import zlib
 import kazoo.exceptions
 from kazoo.client import KazooState
 from journal import basejournal
+from journal import blobstore
+from journal import compression
+from journal import metrics
+from journal import record
+from journal import shmcache
+from journal import zkcompact
+from journal import zkexport
+from journal import zkfold
+from journal import zkhistory
+from journal import zkpool
 from journal.zk import utils as zkutils
 
 _LOG = logging.getLogger(__name__)
 
 HISTORY_CACHE = {}
+HISTORY_CACHE_LOCK = threading.Lock()
 
-# Max zk sequence number is 2**32 (signed integer)
-# SERIAL_BITS defines the size of sliding window
-SERIAL_BITS = 32
-
-SQLITE_CREATE = """
-      CREATE TABLE IF NOT EXISTS journal (
-          id             INTEGER PRIMARY KEY AUTOINCREMENT,
-          date           DATETIME DEFAULT CURRENT_TIMESTAMP,
-          authuser_id    VARCHAR(64)   NOT NULL,
-          user_id        VARCHAR(64)   NOT NULL,
-          as_role        VARCHAR(16)   NULL,
-          request_id     VARCHAR(36)   NOT NULL,
-          transaction_id VARCHAR(36)   NOT NULL,
-          step           VARCHAR(16)   NOT NULL,
-          host           VARCHAR(254)  NOT NULL,
-          resource       VARCHAR(64)   NOT NULL,
-          resourcegroup  VARCHAR(64)   NOT NULL,
-          verb           VARCHAR(64)   NOT NULL,
-          resourcepk     VARCHAR(128)  NULL,
-          payload        TEXT          NULL,
-          cm             VARCHAR(20)   NULL
-      )"""
-
-SQLITE_INSERT = """
-      INSERT INTO journal (
-          host, authuser_id, user_id, date,
-          request_id, transaction_id,
-          step, as_role,
-          resourcegroup, resource, verb, resourcepk,
-          payload, cm
-      )
-      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-
-SQLITE_SELECT = """
-    SELECT host, authuser_id, user_id, date,
-    request_id, transaction_id, step, as_role,
-    resourcegroup, resource, verb, resourcepk, payload, cm
-    FROM journal WHERE request_id=? AND
-    step=?
-    """
+# Root nodes which are not journals
+RESERVED_NODES = ('history', 'codec', 'quarantine')
 
-SQLITE_SELECT_ALL = """
-    SELECT host, authuser_id, user_id, date,
-    request_id, transaction_id, step, as_role,
-    resourcegroup, resource, verb, resourcepk, payload, cm
-    FROM journal
-    """
+# Step nodes per txid until a fold has measured it: begin and commit
+STEPS_PER_TXID = 2
 
-CSV_COLUMNS = ['transaction_id',
-               'request_id',
-               'step',
-               'host',
-               'resource',
-               'verb',
-               'pk',
-               'date',
-               'user_id',
-               'authuser_id',
-               'role',
-               'cm',
-               'payload']
+# Requests kept in flight by write_batch
+WRITE_CONCURRENCY = 16
 
-SQLITE_NODE_REGEX = re.compile(r'^sqlite-db#(-?\d+)$')
+# Pause between history cache warm-up attempts while zk is down
+WARMUP_RETRY_INTERVAL = 5
 
 
 class ZookeeperJournal(basejournal.BaseJournal):
@@ -96,12 +48,51 @@ class ZookeeperJournal(basejournal.BaseJournal):
     Class responsible for zookeeper client instance
     """
 
-    def __init__(self, zkurl, kwargs, adminuser=None, cachesize=None):
+    def __init__(self, zkurl, kwargs, adminuser=None, cachesize=None, *,
+                 maxtxnsize=None, codec=None, codecdict=None,
+                 encoding=None, blobpath=None, blobthreshold=None,
+                 shmcachepath=None, shard=None, readurl=None,
+                 readsessions=None, readsync=False, sessions=None,
+                 containers=False):
         """
         Create zookeeper client instance and acl.
+        shard names the shard of a sharded journal. Status reads go to
+        readsessions sessions to readurl (e.g. observers) if given,
+        after a sync() with the leader if readsync. Writes and other
+        status reads are spread over sessions sessions if more than one.
+        Txid and lock nodes are container nodes if containers, removed
+        by the servers once empty rather than by the folder.
         """
+        self.shard = shard
+        self.readers = None
+        if readurl:
+            self.readers = zkpool.SessionPool(
+                readurl, dict(kwargs, read_only=True), readsessions)
+        self.readsync = readsync
+        self.containers = containers
+        self.blobs = None
+        if blobpath:
+            self.blobs = blobstore.BlobStore(blobpath, blobthreshold)
+        self.shmcache = None
+        if shmcachepath:
+            self.shmcache = shmcache.SharedCache(shmcachepath)
         self.cachesize = cachesize
+        self.binary = encoding == 'binary'
+        self.maxtxnsize = maxtxnsize or zkfold.TXN_MAX_BYTES
+        self.codec = compression.Codec(
+            codec, compression.load_dictionary(codecdict),
+            resolver=self._fetch_dictionary)
+        self.connect_callbacks = []
+        self.ready = threading.Event()
+        self.warming = None
+        self.rewarm = threading.Event()
         self.zk = zkutils.connect(zkurl, **kwargs)
+        # Snapshot names of different shards collide
+        self.snapshots = zkhistory.HistoryCache(
+            self.zk, self.codec, cachesize,
+            HISTORY_CACHE if shard is None else {},
+            HISTORY_CACHE_LOCK if shard is None else threading.Lock(),
+            self.shmcache)
         self.zk.add_listener(self.my_listener)
         selfperm = 'rwc'
         if not adminuser:
@@ -112,6 +103,11 @@ class ZookeeperJournal(basejournal.BaseJournal):
         ]
         if adminuser:
             self.acl.append(self.zk.make_user_acl(adminuser, 'rwcda'))
+        # Same credentials and acl for all the sessions
+        self.pool = None
+        if sessions and sessions > 1:
+            self.pool = zkpool.SessionPool(zkurl, kwargs, sessions,
+                                           [self.zk])
 
     def journal_zk_start(self):
         """
@@ -136,6 +132,32 @@ class ZookeeperJournal(basejournal.BaseJournal):
             _LOG.info('Zookeeper started')
             if not self.zk.exists('/'):
                 sys.exit('Chroot {0} doesn\'t exist'.format(self.zk.chroot))
+            self._publish_dictionary()
+
+    def _publish_dictionary(self):
+        """
+        Store the codec dictionary in zk for the readers
+        """
+        if self.codec.dict_id in (0, compression.DEFAULT_DICTIONARY_ID):
+            return
+        try:
+            self.zk.create('/codec/dict-{0}'.format(self.codec.dict_id),
+                           value=self.codec.dictionary,
+                           makepath=True, acl=self.acl)
+        except kazoo.exceptions.NodeExistsError:
+            pass
+        except kazoo.exceptions.KazooException:
+            _LOG.exception('Error publishing codec dictionary')
+
+    def _fetch_dictionary(self, dict_id):
+        """
+        Get a codec dictionary from zk
+        """
+        try:
+            data, _ = self.zk.get('/codec/dict-{0}'.format(dict_id))
+        except kazoo.exceptions.NoNodeError:
+            return None
+        return data
 
     def my_listener(self, state):
         """
@@ -151,6 +173,58 @@ class ZookeeperJournal(basejournal.BaseJournal):
         if state == KazooState.CONNECTED:
             # Handle being connected/reconnected to Zookeeper
             _LOG.info('KazooState.CONNECTED')
+            for callback in self.connect_callbacks:
+                callback()
+
+    def add_connect_callback(self, callback):
+        """
+        Call callback on every (re)connection to zookeeper.
+        It runs in the kazoo event thread and must not block.
+        """
+        self.connect_callbacks.append(callback)
+
+    def warmup(self):
+        """
+        Load the newest history snapshots in the cache in a background
+        thread, now and after every reconnection. ready is set once the
+        first load is done. Read and pooled sessions are started in the
+        background too.
+        """
+        if self.warming is not None:
+            return
+        if self.readers is not None:
+            self.readers.start()
+        if self.pool is not None:
+            self.pool.start()
+        self.add_connect_callback(self.rewarm.set)
+        self.warming = threading.Thread(target=self._warmup_run,
+                                        name='history-warmup', daemon=True)
+        self.warming.start()
+
+    def is_ready(self):
+        """
+        Whether the history cache is warm
+        """
+        return self.ready.is_set()
+
+    def _warmup_run(self):
+        while True:
+            self.rewarm.clear()
+            if not self.zk.connected:
+                self.journal_zk_start()
+            if self.zk.connected:
+                try:
+                    loaded = self.snapshots.warm()
+                except (kazoo.exceptions.KazooException,
+                        kazoo.handlers.threading.KazooTimeoutError):
+                    _LOG.exception('Error warming up the history cache')
+                else:
+                    if not self.ready.is_set():
+                        _LOG.info('History cache warm, %d snapshots', loaded)
+                        self.ready.set()
+            # Woken up by reconnections, retries until the first load
+            self.rewarm.wait(None if self.ready.is_set() else
+                             WARMUP_RETRY_INTERVAL)
 
     def write(self, txid, step, msg):
         """
@@ -158,16 +232,14 @@ class ZookeeperJournal(basejournal.BaseJournal):
         """
         childnode = '/{0}/{1}'.format(txid, step)
         rc = 0
-        if not self.zk.connected:
-            self.journal_zk_start()
         try:
-            json_msg = json.dumps(msg)
-            compressed_msg = zlib.compress(json_msg.encode())
-            if self.zk.connected:
-                self.zk.create(childnode, value=compressed_msg,
-                               makepath=True, acl=self.acl)
-            else:
-                rc = 1
+            compressed_msg = self.codec.encode(
+                record.encode(self._offload(msg), self.binary))
+            with self._session() as zk:
+                if zk is not None:
+                    self._create_step(zk, txid, childnode, compressed_msg)
+                else:
+                    rc = 1
         except kazoo.exceptions.NodeExistsError:
             return rc
         except kazoo.exceptions.KazooException:
@@ -176,88 +248,412 @@ class ZookeeperJournal(basejournal.BaseJournal):
         except kazoo.handlers.threading.KazooTimeoutError as err:
             _LOG.exception('Zookeeper timed out - %s', err)
             rc = 1
+        except (IOError, OSError):
+            _LOG.exception('Error storing journal payload')
+            rc = 1
         return rc
 
+    def _create_step(self, zk, txid, path, value):
+        """
+        Create a step node, and its txid node if missing
+        """
+        if not self.containers:
+            zk.create(path, value=value, makepath=True, acl=self.acl)
+            return
+        try:
+            zk.create(path, value=value, acl=self.acl)
+        except kazoo.exceptions.NoNodeError:
+            # New txid, or its container was emptied and removed
+            self._create_container(zk, '/' + txid)
+            zk.create(path, value=value, acl=self.acl)
+
+    def _create_container(self, zk, path):
+        """
+        Create a container node, a plain node if the servers have none
+        """
+        if self.containers:
+            try:
+                zkutils.create_container(zk, path, self.acl)
+                return
+            except kazoo.exceptions.NodeExistsError:
+                return
+            except kazoo.exceptions.UnimplementedError:
+                self._no_containers()
+        try:
+            zk.create(path, acl=self.acl)
+        except kazoo.exceptions.NodeExistsError:
+            pass
+
+    def _create_parent_async(self, zk, path):
+        if self.containers:
+            return zkutils.create_container_async(zk, path, self.acl)
+        return zk.create_async(path, acl=self.acl)
+
+    def _no_containers(self):
+        if self.containers:
+            _LOG.warning('Zookeeper servers without container nodes, '
+                         'creating plain nodes')
+            self.containers = False
+
+    def _offload(self, msg):
+        if self.blobs is None:
+            return msg
+        return self.blobs.offload(msg)
+
+    def rehydrate(self, msg):
+        """
+        msg with its payload back from the blob store if offloaded
+        """
+        if self.blobs is None:
+            return msg
+        return self.blobs.rehydrate(msg)
+
+    def write_batch(self, entries, concurrency=None):
+        """
+        Write (txid, step, msg) entries with pipelined multi-op
+        transactions, return the rc of each entry
+        """
+        rcs = [1] * len(entries)
+        try:
+            nodes = self._encode_nodes(entries)
+        except (IOError, OSError):
+            _LOG.exception('Error storing journal payload')
+            return rcs
+        try:
+            with self._session() as zk:
+                if zk is not None:
+                    self._write_nodes(zk, nodes, concurrency or
+                                      WRITE_CONCURRENCY, rcs)
+        except zkpool.SESSION_ERRORS as err:
+            # Counted against the session, rcs tell what was written
+            _LOG.error('Zookeeper session error in batch write - %r', err)
+        return rcs
+
+    def _encode_nodes(self, entries):
+        """
+        (path, value) step nodes of (txid, step, msg) entries
+        """
+        return [
+            ('/{0}/{1}'.format(txid, step),
+             self.codec.encode(
+                 record.encode(self._offload(msg), self.binary)))
+            for (txid, step, msg) in entries
+        ]
+
+    def _write_nodes(self, zk, nodes, concurrency, rcs):
+        # Session errors of the async requests, raised once done
+        errors = []
+        parents = sorted(set(path.rsplit('/', 1)[0] for (path, _) in nodes))
+        for (parent, result) in _pipeline(
+                ((parent, functools.partial(self._create_parent_async, zk,
+                                            parent))
+                 for parent in parents), concurrency):
+            if isinstance(result, kazoo.exceptions.UnimplementedError):
+                # Parents not created are made by the one by one writes
+                self._no_containers()
+            elif (isinstance(result, Exception) and
+                    not isinstance(result,
+                                   kazoo.exceptions.NodeExistsError)):
+                _LOG.error('Error creating %s - %r', parent, result)
+                errors.append(result)
+        retry = []
+        for (chunk, results) in _pipeline(
+                ((chunk, functools.partial(self._commit_creates, zk, nodes,
+                                           chunk))
+                 for chunk in self._create_chunks(nodes)), concurrency):
+            if (isinstance(results, Exception) or
+                    any(isinstance(e, Exception) for e in results)):
+                # Some nodes already exist or failed, write one by one
+                if isinstance(results, Exception):
+                    errors.append(results)
+                retry.extend(chunk)
+                continue
+            for i in chunk:
+                rcs[i] = 0
+        for (i, result) in _pipeline(
+                ((i, functools.partial(zk.create_async, nodes[i][0],
+                                       value=nodes[i][1], acl=self.acl,
+                                       makepath=True))
+                 for i in retry), concurrency):
+            if (not isinstance(result, Exception) or
+                    isinstance(result, kazoo.exceptions.NodeExistsError)):
+                rcs[i] = 0
+            else:
+                _LOG.error('Error writing %s - %r', nodes[i][0], result)
+                errors.append(result)
+        for error in errors:
+            if isinstance(error, zkpool.SESSION_ERRORS):
+                raise error
+
+    def _create_chunks(self, nodes):
+        """
+        Split node creates into lists of indexes fitting a transaction
+        """
+        chroot = self.zk.chroot or ''
+        chunk = []
+        size = zkfold.MULTI_HEADER_SIZE
+        for (i, (path, value)) in enumerate(nodes):
+            opsize = zkfold.create_op_size(chroot + path, value, self.acl)
+            if chunk and size + opsize > self.maxtxnsize:
+                yield chunk
+                chunk = []
+                size = zkfold.MULTI_HEADER_SIZE
+            chunk.append(i)
+            size += opsize
+        if chunk:
+            yield chunk
+
+    def _commit_creates(self, zk, nodes, chunk):
+        transaction = zk.transaction()
+        for i in chunk:
+            transaction.create(nodes[i][0], value=nodes[i][1], acl=self.acl)
+        return transaction.commit_async()
+
     def status(self, txid):
         """
         Function to get status of a txid
         """
-        if not self.zk.connected:
-            self.journal_zk_start()
-        if not self.zk.connected:
-            return (None, None)
+        if self.shmcache is not None:
+            cached = self.shmcache.get_status(txid)
+            if cached is not None:
+                return ({'status': self.rehydrate(cached)}, http.client.OK)
         commitnode = '/{0}/{1}'.format(txid, 'commit')
         abortnode = '/{0}/{1}'.format(txid, 'abort')
         beginnode = '/{0}/{1}'.format(txid, 'begin')
         try:
-            if self.zk.exists(commitnode):
-                data = self.zk.get(commitnode)
-                actual_data = zlib.decompress(data[0]).decode()
-                final_resp = {'status': json.loads(actual_data)}
-                return (final_resp, http.client.OK)
-            if self.zk.exists(abortnode):
-                data = self.zk.get(abortnode)
-                actual_data = zlib.decompress(data[0]).decode()
-                final_resp = {'status': json.loads(actual_data)}
-                return (final_resp, http.client.OK)
-            if self.zk.exists(beginnode):
-                final_resp = None
-                return (final_resp, http.client.PROCESSING)
-            (actual_data, resp) = self._check_history_node(txid)
+            with self._read_session() as (zk, reader):
+                if zk is None:
+                    return (None, None)
+                if ((reader and self.readsync) or
+                        (not reader and self.pool is not None)):
+                    # Read what was written through other servers
+                    zk.sync('/')
+                if zk.exists(commitnode):
+                    data = zk.get(commitnode)
+                    actual_data = self.codec.decode(data[0])
+                    return self._final_status(txid,
+                                              record.decode(actual_data))
+                if zk.exists(abortnode):
+                    data = zk.get(abortnode)
+                    actual_data = self.codec.decode(data[0])
+                    return self._final_status(txid,
+                                              record.decode(actual_data))
+                if zk.exists(beginnode):
+                    final_resp = None
+                    return (final_resp, http.client.PROCESSING)
+                (actual_data, resp) = self.snapshots.status(txid, zk)
         except kazoo.exceptions.KazooException as err:
             _LOG.exception('Zookeeper error %s', err)
         except kazoo.handlers.threading.KazooTimeoutError as err:
             _LOG.exception('Zookeeper timed out - %s', err)
         else:
             if actual_data is not None:
-                actual_data = {'status': actual_data}
+                return self._final_status(txid, actual_data)
             return (actual_data, resp)
         return (None, None)
 
-    def upload_batch(self, batchsize, interval):
+    @contextlib.contextmanager
+    def _read_session(self):
+        """
+        Session for status reads and whether it is a read session:
+        a read session if any is up, else a main session, None if
+        not connected
+        """
+        with contextlib.ExitStack() as stack:
+            zk = None
+            if self.readers is not None:
+                zk = stack.enter_context(self.readers.session())
+            if zk is not None:
+                yield (zk, True)
+            else:
+                yield (stack.enter_context(self._session()), False)
+
+    @contextlib.contextmanager
+    def _session(self):
+        """
+        Main session, the least loaded of the pool if any,
+        None if not connected
+        """
+        if not self.zk.connected:
+            self.journal_zk_start()
+        if self.pool is not None:
+            with self.pool.session() as zk:
+                yield zk
+        else:
+            yield self.zk if self.zk.connected else None
+
+    def _final_status(self, txid, status):
+        """
+        Committed or aborted status, cached for the other workers
+        """
+        if self.shmcache is not None:
+            self.shmcache.put_status(txid, status)
+        return ({'status': self.rehydrate(status)}, http.client.OK)
+
+    def sample_messages(self, count):
+        """
+        Decoded messages of up to count live journal nodes
+        """
+        samples = []
+        for journal in _journals(self.zk.get_children('/')):
+            for step in self._get_stepkids(journal):
+                try:
+                    data, _ = self.zk.get('/{0}/{1}'.format(journal, step))
+                except kazoo.exceptions.NoNodeError:
+                    continue
+                samples.append(self.codec.decode(data))
+                if len(samples) >= count:
+                    return samples
+        return samples
+
+    def upload_batch(self, batchsize, interval,
+                     maxbatchsize=None, mininterval=None):
         """Generate snapshot DB and upload to zk.
+
+        A child watch on the root wakes the folder up when journals
+        arrive. A pass that fills its batch is followed by another one
+        right away with a bigger batch (up to maxbatchsize), otherwise
+        the folder waits mininterval and backs off up to interval while
+        idle.
         """
+        if maxbatchsize is None:
+            maxbatchsize = batchsize
+        if mininterval is None:
+            mininterval = interval
         if not self.zk.exists('/history'):
             self.zk.create('/history', makepath=True,
                            acl=self.acl)
+        wakeup = threading.Event()
+
+        def _wakeup_watch(_event):
+            wakeup.set()
+
+        foldsize = batchsize
+        delay = mininterval
+        # Step nodes per txid node, the backlog counts txid nodes
+        steps = STEPS_PER_TXID
         while True:
-            children = self.zk.get_children('/')
-            if 'history' in children:
-                children.remove('history')
-            journals = [x for x in children if '_lock' not in x]
-            journaltobewritten = []
-            locks = [
-                self.zk.Lock('/' + node + '_lock') for node in journals
-            ]
-            locked_nodes = []
-            try:
-                for (i, journal) in enumerate(journals):
+            wakeup.clear()
+            journals = _journals(
+                self.zk.get_children('/', watch=_wakeup_watch))
+            self._gauge('fold_backlog', len(journals))
+            (folded, txids) = self._fold_journals(journals, foldsize)
+            if txids:
+                steps = folded / txids
+            (foldsize, delay) = zkfold.fold_schedule(
+                folded, foldsize, delay,
+                batchsize, maxbatchsize, mininterval, interval)
+            self._gauge('fold_batchsize', foldsize)
+            self._gauge('fold_delay', delay)
+            metrics.publish()
+            self._wait_for_backlog(wakeup, delay, batchsize / steps,
+                                   mininterval)
+
+    def _fold_journals(self, journals, batchsize):
+        """
+        Fold up to batchsize journal nodes, return the number of
+        nodes and of txids folded
+        """
+        journaltobewritten = []
+        folded = (0, 0)
+        locks = [
+            self.zk.Lock('/' + node + '_lock') for node in journals
+        ]
+        locked_nodes = []
+        # Locked nodes whose lock is a container node
+        contained = set()
+        # Txid nodes which are container nodes, removed by the servers
+        containers = set()
+        try:
+            for (i, journal) in enumerate(journals):
+                if self.containers:
+                    (stepkids, stat) = self._get_stepkids(journal,
+                                                          include_data=True)
+                    if stat is not None and zkutils.is_container(stat):
+                        containers.add(journal)
+                else:
                     stepkids = self._get_stepkids(journal)
-                    if (locks[i].acquire(blocking=False) and stepkids):
-                        nodes_to_be_written = [
-                            '/'.join(['', journal, step]) for step in stepkids
-                        ]
-                        journaltobewritten.extend(nodes_to_be_written)
-                        locked_nodes.append(journal)
-                    if len(journaltobewritten) >= batchsize:
-                        break
-                if journaltobewritten:
-                    self._create_sqlite(journaltobewritten, locked_nodes)
+                if self.containers and self._create_lock_root(locks[i]):
+                    contained.add(journal)
+                if (locks[i].acquire(blocking=False) and stepkids):
+                    nodes_to_be_written = [
+                        '/'.join(['', journal, step]) for step in stepkids
+                    ]
+                    journaltobewritten.extend(nodes_to_be_written)
+                    locked_nodes.append(journal)
+                if len(journaltobewritten) >= batchsize:
+                    break
+            if journaltobewritten:
+                # Plain txid nodes, created before containers were used
+                # or by writers without them, are deleted once empty
+                folded = self._create_sqlite(
+                    journaltobewritten,
+                    [node for node in locked_nodes if node not in containers])
+            else:
+                self._gauge('fold_lag', 0)
+        except kazoo.exceptions.KazooException as err:
+            _LOG.exception('Error in uploading - %s', err)
+        finally:
+            for lock in locks:
+                lock.release()
+            self._delete_lock_nodes(
+                [node for node in locked_nodes if node not in contained])
+        return folded
+
+    def _create_lock_root(self, lock):
+        """
+        Create the root of lock as a container node, return whether
+        it was created so
+        """
+        created = True
+        try:
+            zkutils.create_container(self.zk, lock.path, self.acl)
+        except kazoo.exceptions.NodeExistsError:
+            # Maybe a plain node, deleted after the fold as before
+            created = False
+        except kazoo.exceptions.UnimplementedError:
+            self._no_containers()
+            return False
+        # No ensure_path() on acquire
+        lock.assured_path = True
+        return created
+
+    def _wait_for_backlog(self, wakeup, delay, threshold, pollinterval):
+        """
+        Sleep up to delay seconds. Once the root watch has fired the
+        backlog of txid nodes is polled and the wait is cut short when
+        it reaches threshold.
+        """
+        deadline = time.time() + delay
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if not wakeup.is_set():
+                wakeup.wait(remaining)
+                continue
+            try:
+                # Lock nodes linger as containers, the root stat
+                # would count them
+                backlog = len(_journals(self.zk.get_children('/')))
             except kazoo.exceptions.KazooException as err:
-                _LOG.exception('Error in uploading - %s', err)
-            finally:
-                for lock in locks:
-                    lock.release()
-                self._delete_lock_nodes(locked_nodes)
-            time.sleep(interval)
-
-    def _get_stepkids(self, journal):
+                _LOG.exception('Error in reading backlog - %s', err)
+                backlog = None
+            if backlog is not None and backlog >= threshold:
+                _LOG.info('Backlog of %d txids, folding now', backlog)
+                return
+            time.sleep(min(remaining, pollinterval))
+
+    def _get_stepkids(self, journal, include_data=False):
+        """
+        Step names of a txid node, with its stat if include_data
+        """
         try:
-            stepkids = self.zk.get_children('/' + journal)
+            return self.zk.get_children('/' + journal,
+                                        include_data=include_data)
         except kazoo.exceptions.NoAuthError as err:
             _LOG.exception('Auth error for zk node %s', err)
-            return []
-        return stepkids
+            return ([], None) if include_data else []
 
     def _delete_lock_nodes(self, lockednodes):
         for node in lockednodes:
@@ -268,63 +664,99 @@ class ZookeeperJournal(basejournal.BaseJournal):
 
     def _create_sqlite(self, journaltobewritten, lockednodes):
         """
-        Read node and create sqlite node
+        Read node and create sqlite node, return the number of
+        nodes and of txids folded
         """
         batchdata = []
         journalwritten = []
+        rejected = []
+        oldest = None
         for nodepath in journaltobewritten:
             try:
-                data, _ = self.zk.get(nodepath)
+                data, stat = self.zk.get(nodepath)
             except kazoo.exceptions.NoAuthError as err:
                 _LOG.exception('Auth error for zk node %s', err)
                 continue
-            olddata = zlib.decompress(data).decode()
-            data_dict = json.loads(olddata)
-            final_data = (
-                data_dict.get('host'), data_dict.get('authuser_id'),
-                data_dict.get('user_id'), data_dict.get('date'),
-                data_dict.get('request_id'),
-                data_dict.get('transaction_id'), data_dict.get('step'),
-                data_dict.get('role'),
-                data_dict.get('resourcegroup'), data_dict.get('resource'),
-                data_dict.get('verb'), data_dict.get('resourcepk'),
-                json.dumps(data_dict.get('payload')), data_dict.get('cm'))
+            if oldest is None or stat.ctime < oldest:
+                oldest = stat.ctime
+            final_data = record.to_row(self.codec.decode(data))
+            if any(final_data[i] is None for i in zkhistory.SQLITE_NOT_NULL):
+                # Would fail the whole snapshot
+                rejected.append((nodepath, data))
+                continue
             batchdata.append(final_data)
             journalwritten.append(nodepath)
-        self._fold_sqlite_data(batchdata,
-                               journalwritten,
-                               lockednodes)
+        if rejected:
+            self._quarantine(rejected)
+        if oldest is not None:
+            # Fold lag: how long the oldest folded entry stayed live
+            fold_lag = time.time() - oldest / 1000
+            self._gauge('fold_lag', fold_lag)
+            _LOG.info('Folding %d nodes, fold lag %.3fs',
+                      len(journalwritten), fold_lag)
+        return self._fold_sqlite_data(batchdata,
+                                      journalwritten,
+                                      lockednodes)
+
+    def _quarantine(self, rejected):
+        """
+        Move (node, data) journal nodes missing a NOT NULL column to
+        /quarantine/<txid>.<step>, out of the fold
+        """
+        _LOG.error('Quarantining %d journal nodes missing columns: %s',
+                   len(rejected), [node for (node, _) in rejected])
+        try:
+            self.zk.create('/quarantine', makepath=True, acl=self.acl)
+        except kazoo.exceptions.NodeExistsError:
+            pass
+        for (node, data) in rejected:
+            transaction = self.zk.transaction()
+            transaction.create(
+                '/quarantine/' + '.'.join(node.split('/')[1:]),
+                value=data, acl=self.acl)
+            transaction.delete(node)
+            results = transaction.commit()
+            if any((isinstance(e, Exception) for e in results)):
+                _LOG.error('Error quarantining %s - %r', node, results)
 
     def _fold_sqlite_data(self, batchdata,
                           journalwritten,
                           journalemptynodes):
-        conn = sqlite3.connect(":memory:")
-        try:
-            with conn:
-                conn.execute(SQLITE_CREATE)
-                conn.executemany(
-                    SQLITE_INSERT, batchdata)
-        except sqlite3.IntegrityError:
-            _LOG.exception('Error in inserting data to sqlite')
-            conn.close()
-            return
-        fdata = '\n'.join(conn.iterdump())
-        conn.close()
+        """
+        Commit the fold chunks, return the number of nodes and of txids
+        committed
+        """
+        committed = []
+        for (snapshot, nodes) in zkfold.fold_chunks(
+                batchdata, journalwritten, self.codec, self._fold_txn_size,
+                self.maxtxnsize, self.binary):
+            if self._commit_fold(snapshot, nodes):
+                committed.extend(nodes)
+        self._delete_empty_nodes(journalemptynodes)
+        txids = set(node.split('/')[1] for node in committed)
+        return (len(committed), len(txids))
+
+    def _fold_txn_size(self, snapshot, nodes):
+        return zkfold.fold_txn_size(snapshot, nodes, self.zk.chroot or '',
+                                    self.acl)
+
+    def _commit_fold(self, snapshot, nodes):
         childnode = '/history/sqlite-db#'
         transaction = self.zk.transaction()
-        db_node = transaction.create(
-            childnode, value=zlib.compress(fdata.encode()),
+        transaction.create(
+            childnode, value=snapshot,
             acl=self.acl, sequence=True)
-        _LOG.info(
-            'Uploaded compressed snapshot DB: to: %s',
-            db_node)
         # Delete uploaded nodes from zk.
-        for oldjournal in journalwritten:
+        for oldjournal in nodes:
             transaction.delete(oldjournal)
         results = transaction.commit()
         if any((isinstance(e, Exception) for e in results)):
             _LOG.error('Transaction commit error - %r', results)
-        self._delete_empty_nodes(journalemptynodes)
+            return False
+        _LOG.info(
+            'Uploaded compressed snapshot DB: to: %s (%d nodes)',
+            results[0], len(nodes))
+        return True
 
     def _delete_empty_nodes(self, journalemptynodes):
         for enode in journalemptynodes:
@@ -336,157 +768,72 @@ class ZookeeperJournal(basejournal.BaseJournal):
                 _LOG.exception('Error in zk delete %s', err)
                 continue
 
-    def _check_history_node(self, txid):
-        for data in HISTORY_CACHE.values():
-            (status, code) = self._get_history_data(data, txid)
-            if code is not None:
-                return (status, code)
-        if self.zk.exists('/history'):
-            entries = self.zk.get_children('/history')
-            entries.sort(key=functools.cmp_to_key(entry_cmp), reverse=True)
-            (status, code) = self._check_history_update_cache(entries, txid)
-            if code is not None:
-                return (status, code)
-        return (None, None)
-
-    def _get_history_data(self, sqlite_data, txid):
-        conn = sqlite3.connect(":memory:")
-        fdata = zlib.decompress(sqlite_data).decode()
-        conn.executescript(fdata)
-        conn.row_factory = sqlite3.Row
-        result = conn.execute(SQLITE_SELECT, (txid, 'commit'))
-        row = result.fetchone()
-        if row is not None:
-            actual_data = {key: row[key] for key in row.keys()}
-            conn.close()
-            actual_data['payload'] = json.loads(actual_data['payload'])
-            return (actual_data, http.client.OK)
-        result = conn.execute(SQLITE_SELECT, (txid, 'abort'))
-        row = result.fetchone()
-        if row is not None:
-            actual_data = {key: row[key] for key in row.keys()}
-            conn.close()
-            actual_data['payload'] = json.loads(actual_data['payload'])
-            return (actual_data, http.client.OK)
-        result = conn.execute(SQLITE_SELECT, (txid, 'begin'))
-        row = result.fetchone()
-        if row is not None:
-            actual_data = None
-            conn.close()
-            return (actual_data, http.client.PROCESSING)
-        return (None, None)
-
-    def _check_history_update_cache(self, entries, txid):
-        _LOG.debug('number of entries %d', len(entries))
-        if not entries:
-            HISTORY_CACHE.clear()
-            return (None, None)
-        _LOG.debug('entries are %r', entries)
-        if len(entries) > self.cachesize:
-            cache_oldest = entries[self.cachesize - 1]
-        else:
-            cache_oldest = entries[-1]
-        # cleanup cache first
-        for key in list(HISTORY_CACHE.keys()):
-            if entry_cmp(key, cache_oldest) < 0:
-                del HISTORY_CACHE[key]
-        # check for data and fill the cache
-        status = None
-        code = None
-        current_cache_size = len(HISTORY_CACHE)
-        for entry in entries:
-            if entry in HISTORY_CACHE:
-                continue
-            data, _ = self.zk.get('/history/' + entry)
-            if current_cache_size < self.cachesize:
-                HISTORY_CACHE[entry] = data
-                current_cache_size += 1
-            if code is None:
-                (status, code) = self._get_history_data(data, txid)
-            if code is not None and current_cache_size >= self.cachesize:
-                break
-        if code is not None:
-            return (status, code)
-        return (None, None)
+    def export(self, since=None, until=None, sincetime=None, untiltime=None):
+        """
+        Iterate the rows of the /history snapshots with sequence id from
+        since to until (excluded), created from sincetime to untiltime
+        (epoch seconds, excluded), one snapshot in memory at a time.
+        Snapshots merged by compaction keep the sequence id of the newest
+        one, only an export resuming inside a merged run sees its rows
+        again.
+        """
+        if not self.zk.exists('/history'):
+            return iter(())
+        entries = self.zk.get_children('/history')
+        entries.sort(key=functools.cmp_to_key(zkhistory.entry_cmp))
+        return zkexport.export_rows(self, entries, since, until,
+                                    sincetime, untiltime)
 
-    def dump(self, nfspath, interval, outfile, nfsregex):
+    def dump(self, nfspath, interval, outfile, nfsregex, history=None):
         """
-        Dump sqlite node to NFS
+        Dump sqlite node to NFS, and to the history store if given
         """
-        lockfile = os.path.join(
-            nfspath, self.zk.chroot.replace('/', '') + '.lock')
         while True:
-            with open(lockfile, 'w') as f:
+            with self._dump_lock(nfspath) as locked:
                 try:
-                    fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    try:
-                        if self.zk.exists('/history'):
-                            oldjournal = self.zk.get_children('/history')
-                            oldjournal.sort(
-                                key=functools.cmp_to_key(entry_cmp))
-                            self._dump_sqlite_to_csv(
-                                oldjournal, nfspath, outfile, nfsregex)
-                    except kazoo.exceptions.SessionExpiredError:
-                        _LOG.exception('Zookeeper down - session expired')
-                    except kazoo.exceptions.KazooException as err:
-                        _LOG.exception('Error in zk create %s', err)
-                except IOError as err:
-                    if err.errno == errno.EAGAIN:
-                        # this is a lock fail, just skip
-                        pass
-                    elif err.errno == errno.EACCES:
-                        # this is a lock fail, just skip
-                        pass
-                    else:
-                        # this is another file operation exception
-                        _LOG.exception(
-                            'Error in acquiring lock for dump function')
+                    if locked and self.zk.exists('/history'):
+                        oldjournal = self.zk.get_children('/history')
+                        oldjournal.sort(
+                            key=functools.cmp_to_key(zkhistory.entry_cmp))
+                        zkexport.dump_snapshots(
+                            self, oldjournal, nfspath, self._outfile(outfile),
+                            nfsregex, history)
+                except kazoo.exceptions.SessionExpiredError:
+                    _LOG.exception('Zookeeper down - session expired')
+                except kazoo.exceptions.KazooException as err:
+                    _LOG.exception('Error in zk create %s', err)
+                except IOError:
+                    _LOG.exception('Error in dump to NFS')
             time.sleep(interval)
 
-    def _dump_sqlite_to_csv(self, journals, nfspath, outfile, nfsregex):
-        lastid = self._getlastid(nfspath, outfile, nfsregex)
-        for journal in journals:
-            jseqid = _get_journal_seqid(journal)
-            if sequence_cmp(lastid, jseqid) < 0:
-                csvfilename = outfile + '#' + jseqid + '.csv'
-                csvfile = os.path.join(nfspath, csvfilename)
-                try:
-                    with open(csvfile, "a") as outputfile:
-                        writer = csv.DictWriter(
-                            outputfile,
-                            fieldnames=CSV_COLUMNS)
-                        writer.writeheader()
-                except IOError as err:
-                    _LOG.exception('Error in writing to NFS %s', err)
-                    continue
-                conn = sqlite3.connect(":memory:")
+    def _dump_lock(self, nfspath):
+        """
+        NFS dump lock context, yielding whether it was acquired.
+        Dump and compaction of /history both run under this lock.
+        """
+        lockname = self.zk.chroot.replace('/', '')
+        if self.shard:
+            lockname = '{0}-{1}'.format(lockname, self.shard)
+        return zkexport.dump_lock(os.path.join(nfspath, lockname + '.lock'))
+
+    def compact(self, nfspath, interval, targetsize, outfile, nfsregex):
+        """
+        Merge adjacent small sqlite nodes not yet dumped
+        into nodes of up to targetsize bytes
+        """
+        targetsize = min(targetsize, self.maxtxnsize)
+        while True:
+            with self._dump_lock(nfspath) as locked:
                 try:
-                    data, _ = self.zk.get('/history/' + journal)
+                    if locked and self.zk.exists('/history'):
+                        lastid = zkexport.last_dumped(
+                            nfspath, self._outfile(outfile), nfsregex)
+                        zkcompact.compact_history(self, lastid, targetsize)
+                except kazoo.exceptions.SessionExpiredError:
+                    _LOG.exception('Zookeeper down - session expired')
                 except kazoo.exceptions.KazooException as err:
-                    _LOG.exception('Error in zk %s', err)
-                    continue
-                fdata = zlib.decompress(data).decode()
-                conn.executescript(fdata)
-                conn.row_factory = sqlite3.Row
-                for row in conn.execute(SQLITE_SELECT_ALL):
-                    actual_data = {key: row[key] for key in row.keys()}
-                    self._convert_dict_csv(csvfile,
-                                           actual_data)
-                conn.close()
-                lastid = jseqid
-                gzipcsvfile = csvfile + '.gz'
-                try:
-                    with open(
-                            csvfile, 'rb') as f_in, gzip.open(
-                                gzipcsvfile, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                # W0703: (broad-except)
-                except Exception:  # pylint: disable=W0703
-                    _LOG.exception('failed to gzip %s', csvfile)
-                    os.chmod(csvfile, 0o644)
-                else:
-                    os.chmod(gzipcsvfile, 0o644)
-                    os.remove(csvfile)
+                    _LOG.exception('Error in zk compaction %s', err)
+            time.sleep(interval)
 
     def cleanup(self, nfspath, interval, age, outfile, nfsregex):
         """
@@ -497,13 +844,14 @@ class ZookeeperJournal(basejournal.BaseJournal):
         while True:  # pylint: disable=R1702
             try:
                 if self.zk.exists('/history'):
-                    lastid = self._getlastid(nfspath, outfile, nfsregex)
+                    lastid = zkexport.last_dumped(
+                        nfspath, self._outfile(outfile), nfsregex)
                     oldjournal = self.zk.get_children('/history')
                     for journal in oldjournal:
                         _, stat = self.zk.get('/history/' + journal)
                         if (time.time() - stat.ctime / 1000) > age:
-                            jseqid = _get_journal_seqid(journal)
-                            if sequence_cmp(jseqid, lastid) <= 0:
+                            jseqid = zkhistory.snapshot_seqid(journal)
+                            if zkhistory.sequence_cmp(jseqid, lastid) <= 0:
                                 self.zk.delete('/history/' + journal)
                             else:
                                 _LOG.info("Node:%s not dumped ", journal)
@@ -515,74 +863,48 @@ class ZookeeperJournal(basejournal.BaseJournal):
                 _LOG.exception('Error in zk delete %s', err)
             time.sleep(interval)
 
-    def _getlastid(self, nfspath, outfile, nfsregex):
-        lastid = None
-        pattern = '{0}/{1}*'.format(nfspath, outfile)
-        files = glob.glob(pattern)
-        for jfile in files:
-            result = nfsregex.match(jfile)
-            if result:
-                if lastid is None:
-                    lastid = result.groups()[0]
-                if int(lastid) < int(result.groups()[0]):
-                    lastid = result.groups()[0]
-        return lastid
-
-    def _convert_dict_csv(self, csvfile, dict_data):
-        # Converting journal data to splunk specific data
-        dict_data['role'] = dict_data['as_role']
-        dict_data['pk'] = dict_data['resourcepk']
-        del dict_data['as_role']
-        del dict_data['resourcepk']
-        del dict_data['resourcegroup']
-        try:
-            with open(csvfile, "a") as outfile:
-                writer = csv.DictWriter(outfile, fieldnames=CSV_COLUMNS)
-                writer.writerow(dict_data)
-        except IOError as err:
-            _LOG.exception('Error in writing to NFS %s', err)
-
+    def _gauge(self, name, value):
+        """
+        Set a fold gauge, per shard for a sharded journal
+        """
+        if self.shard:
+            name = '{0}-{1}'.format(name, self.shard)
+        metrics.gauge(name, value)
 
-def _get_journal_seqid(journal):
-    result = SQLITE_NODE_REGEX.match(journal)
-    if result:
-        return result.groups()[0]
-    else:
-        return None
+    def _outfile(self, outfile):
+        """
+        Dump file prefix, per shard for a sharded journal
+        """
+        if self.shard:
+            return '{0}-{1}'.format(outfile, self.shard)
+        return outfile
 
 
-def entry_cmp(sqlite_file1, sqlite_file2):
+def _journals(children):
     """
-    Compare two sqlite file entries
-    in zookeeper to know the ordering
+    Txid nodes among the root children
     """
-    seq_id1 = _get_journal_seqid(sqlite_file1)
-    seq_id2 = _get_journal_seqid(sqlite_file2)
-    return sequence_cmp(seq_id1, seq_id2)
+    return [x for x in children
+            if x not in RESERVED_NODES and '_lock' not in x]
 
 
-def sequence_cmp(seqid1, seqid2):
+def _pipeline(requests, concurrency):
     """
-    Serial number arithmetic
+    Start (key, start) async requests with at most concurrency in
+    flight, yield (key, result or exception) in order
     """
-    if seqid1 == seqid2:
-        return 0
-    if seqid1 is None:
-        return -1
-    if seqid2 is None:
-        return 1
-    seq_id1 = int(seqid1)
-    seq_id2 = int(seqid2)
-    if (
-            (
-                seq_id1 < seq_id2 and (
-                    seq_id2 - seq_id1) < 2**(SERIAL_BITS - 1)
-            ) or
-            (
-                seq_id1 > seq_id2 and (
-                    seq_id1 - seq_id2) > 2**(SERIAL_BITS - 1)
-            )
-    ):
-        return -1
-    else:
-        return 1
+    inflight = collections.deque()
+    for (key, start) in requests:
+        inflight.append((key, start()))
+        if len(inflight) >= concurrency:
+            yield _async_result(*inflight.popleft())
+    while inflight:
+        yield _async_result(*inflight.popleft())
+
+
+def _async_result(key, result):
+    try:
+        return (key, result.get())
+    except (kazoo.exceptions.KazooException,
+            kazoo.handlers.threading.KazooTimeoutError) as err:
+        return (key, err)
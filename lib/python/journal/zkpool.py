@@ -0,0 +1,169 @@
+"""
+Pool of zookeeper sessions
+
+Requests go to the connected session with the fewest requests in
+flight. A session failing MAX_FAILURES requests in a row is left aside
+for UNHEALTHY_INTERVAL seconds, or until it reconnects, unless no other
+session is up. Sessions are started, and started again once lost, by a
+background thread so requests never wait for a connection.
+"""
+import collections
+import contextlib
+import functools
+import itertools
+import logging
+import threading
+import time
+
+import kazoo.exceptions
+import kazoo.handlers.threading
+from kazoo.client import KazooState
+from journal.zk import utils as zkutils
+
+_LOG = logging.getLogger(__name__)
+
+POOL_SIZE = 2
+START_TIMEOUT = 1
+# Pause between starts of the sessions lost
+RESTART_INTERVAL = 10
+MAX_FAILURES = 3
+UNHEALTHY_INTERVAL = 30
+# Errors telling about the session, not the request
+SESSION_ERRORS = (
+    kazoo.exceptions.ConnectionClosedError,
+    kazoo.exceptions.ConnectionLoss,
+    kazoo.exceptions.OperationTimeoutError,
+    kazoo.exceptions.SessionExpiredError,
+    kazoo.handlers.threading.KazooTimeoutError,
+)
+
+
+class SessionPool():
+    """
+    Zookeeper sessions used least loaded first
+    """
+    def __init__(self, zkurl, kwargs=None, size=None, sessions=None):
+        """
+        sessions are already created sessions joining the pool, they
+        are started and stopped by their owner
+        """
+        self.zkurl = zkurl
+        self.adopted = list(sessions or [])
+        self.sessions = self.adopted + [
+            zkutils.connect(zkurl, **(kwargs or {}))
+            for _ in range((size or POOL_SIZE) - len(self.adopted))
+        ]
+        for zk in self.sessions:
+            zk.add_listener(functools.partial(self._listener, zk))
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+        self.starter = None
+        # By id() of session
+        self.inflight = collections.Counter()
+        self.failures = collections.Counter()
+        self.failed = {}
+
+    def _listener(self, zk, state):
+        if state == KazooState.CONNECTED:
+            with self.lock:
+                self.failures.pop(id(zk), None)
+
+    def start(self):
+        """
+        Start the thread starting the sessions, if not running
+        """
+        with self.lock:
+            if self.starter is not None and self.starter.is_alive():
+                return
+            self.starter = threading.Thread(target=self._run,
+                                            name='zk-sessions', daemon=True)
+            self.starter.start()
+
+    def _run(self):
+        while True:
+            self._start_lost()
+            time.sleep(RESTART_INTERVAL)
+
+    def _start_lost(self):
+        """
+        Start the sessions not started, or not running anymore
+        """
+        for zk in self.sessions:
+            # Sessions not LOST reconnect on their own
+            if zk.state != KazooState.LOST or zk in self.adopted:
+                continue
+            try:
+                zk.start(timeout=START_TIMEOUT)
+            except (kazoo.exceptions.KazooException,
+                    kazoo.handlers.threading.KazooTimeoutError) as err:
+                _LOG.warning('Error starting zookeeper session to %s - %s',
+                             self.zkurl, err)
+
+    def healthy(self, zk):
+        """
+        Whether zk is connected and not failing
+        """
+        if not zk.connected:
+            return False
+        if self.failures[id(zk)] < MAX_FAILURES:
+            return True
+        return time.time() - self.failed.get(id(zk), 0) > UNHEALTHY_INTERVAL
+
+    def _acquire(self):
+        with self.lock:
+            count = len(self.sessions)
+            first = next(self.turn)
+            # In turn between equally loaded sessions
+            ordered = [self.sessions[(first + offset) % count]
+                       for offset in range(count)]
+            candidates = ([zk for zk in ordered if self.healthy(zk)] or
+                          [zk for zk in ordered if zk.connected])
+            if not candidates:
+                return None
+            zk = min(candidates, key=lambda zk: self.inflight[id(zk)])
+            self.inflight[id(zk)] += 1
+            return zk
+
+    def _release(self, zk, failed):
+        with self.lock:
+            self.inflight[id(zk)] -= 1
+            if failed:
+                self.failures[id(zk)] += 1
+                self.failed[id(zk)] = time.time()
+            else:
+                self.failures.pop(id(zk), None)
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Least loaded connected session, None if none is; session
+        errors raised while using it count against its health
+        """
+        zk = self._acquire()
+        if zk is None:
+            self.start()
+            yield None
+            return
+        failed = False
+        try:
+            yield zk
+        except SESSION_ERRORS:
+            failed = True
+            raise
+        finally:
+            self._release(zk, failed)
+
+    def stop(self):
+        """
+        Close the sessions
+        """
+        for zk in self.sessions:
+            if zk in self.adopted:
+                continue
+            zk.stop()
+            zk.close()
+
+
+__all__ = (
+    'SessionPool',
+)